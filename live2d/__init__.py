@@ -36,15 +36,18 @@ Author: Benjamin Barad <benjamin.barad@gmail.com>/<baradb@gene.com>
 """
 
 import asyncio
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import errno
 from functools import partial
+from math import ceil
 import json
 import logging
-import multiprocessing
 import os
 import shutil
+import signal
 import sys
+import time
 
 import tornado.ioloop
 from tornado.options import OptionParser
@@ -54,6 +57,7 @@ import uvloop
 
 from .controls import initialize, load_config, get_new_gallery, dump_json, update_settings, generate_job_finished_message, change_warp_directory, generate_settings_message, initialize_logger, update_config_from_warp
 from . import processing_functions
+from . import scheduling
 
 
 def define_options():
@@ -68,6 +72,33 @@ def define_options():
     options.define('tail_log_period_ms', default=15000, type=int, help='How long to wait between sending the latest log lines to the clients, in ms')
     options.define('websocket_ping_interval', default=30, type=int, help='Period between ping pongs to keep connections alive, in seconds', group='settings')
     options.define('process_pool_size', default=32, type=int, help='Total number of logical processors to use for multi-process refine2d jobs')
+    options.define('refine_chunks_per_process', default=4, type=int, help='How many chunks per process each refine2d job is split into at first. Chunks are handed out to processes as they free up and shrink towards the end of the stack. 1 classifies one contiguous slice per process.')
+    options.define('refine_chunk_min_particles', default=100, type=int, help='Smallest number of particles to put in a refine2d chunk')
+    options.define('merge_max_dump_files', default=0, type=int, help='Most refine2d chunks (and so dump files for merge2d to read) per cycle. merge2d reads them all one after another at the end of every cycle. 0 for twice refine_chunks_per_process per refine2d process, -1 for no limit.')
+    options.define('refine_chunk_timeout_s', default=3600, type=float, help='Seconds after which a refine2d chunk is killed and retried. 0 for no limit.')
+    options.define('refine_chunk_retries', default=2, type=int, help='How many times to retry a failed refine2d chunk before failing the cycle')
+    options.define('refine_speculation_factor', default=3.0, type=float, help='A refine2d chunk running this many times longer than the median chunk (per particle) gets a duplicate run, and whichever finishes first is kept. 0 disables duplicates.')
+    options.define('abinit_thread_count', default=0, type=int, help='Threads for the single refine2d process that generates ab initio class seeds. 0 uses all of process_pool_size.')
+    options.define('startup_threads_per_process', default=1, type=int, help='Threads per refine2d process in startup cycles. Each process takes this many slots of process_pool_size, or of the worker agent it runs on.')
+    options.define('refinement_threads_per_process', default=1, type=int, help='Threads per refine2d process in refinement cycles')
+    options.define('tune_layouts', default=False, type=bool, help='Time the candidate threads per process layouts on real cycles, and use the fastest one for each box size and particle count from then on. Results are kept in layout_tuning.json in the .live2d folder.')
+    options.define('worker_agents', default=[], type=str, multiple=True, help='live2d-worker agents on other machines to also run refine2d jobs on, as host:port:slots entries. The working directory must be mounted at the same path on their machines.')
+    options.define('worker_agent_secret', default="", type=str, help='Secret shared with the worker_agents, which refuse jobs without it')
+    options.define('import_thread_count', default=8, type=int, help='Number of warp particle stacks to copy into the combined stack at once')
+    options.define('ingest_period_ms', default=60000, type=int, help='How long to wait between background imports of new warp particles into the combined stack, in ms. 0 disables background ingestion, so particles are only imported by jobs.')
+    options.define('ingest_niceness', default=10, type=int, help='Niceness added to the background ingestion process, to leave the CPU to refine2d')
+    options.define('stack_pyramid_bins', default=[], type=int, multiple=True, help='Binning factors to keep Fourier cropped copies of the combined stack at, so low resolution cycles classify smaller images (e.g. 2,4). Empty to only use the full size stack.')
+    options.define('subset_startup_fraction', default=0.25, type=float, help='Startup cycles that classify less than this fraction of the particles classify a compact random subset stack instead of skipping through the whole combined stack. 0 disables subset stacks.')
+    options.define('incremental_refinement', default=False, type=bool, help='Refinement cycles classify only new particles, unsettled particles and a rotating sample of the rest, from a compact subset stack, so cycle time follows the rate new particles arrive rather than the size of the dataset.')
+    options.define('incremental_revisit_fraction', default=0.1, type=float, help='Fraction of the settled particles incremental refinement cycles revisit, in rotation')
+    options.define('incremental_score_change_factor', default=3.0, type=float, help='Particles whose score changed by more than this many times the median score change count as unsettled in incremental refinement')
+    options.define('incremental_max_fraction', default=0.5, type=float, help='Incremental refinement cycles that would classify more than this fraction of the particles classify all of them instead')
+    options.define('converge_early_stop', default=False, type=bool, help='End a startup or refinement block early once its cycles stop changing the classification, by the converge_* thresholds')
+    options.define('converge_min_cycles', default=2, type=int, help='Cycles to always run in a block before it can end early')
+    options.define('converge_class_change', default=0.02, type=float, help='Largest fraction of particles changing class between cycles for a block to count as converged')
+    options.define('converge_occupancy_drift', default=0.02, type=float, help='Largest change in the distribution of particles over classes between cycles (total variation distance, 0-1) for a block to count as converged')
+    options.define('converge_score_change', default=0, type=float, help='Largest mean absolute score change for a block to count as converged. 0 ignores score changes.')
+    options.define('stack_preallocation_mb', default=4096, type=int, help='Size of the chunks of disk space reserved for the combined stack as it grows, in MB. 0 disables preallocation.')
     # Settings related to actually operating the webpage
     options.parse_config_file(os.path.join(config_folder, "server_settings.conf"), final=False)
     options.parse_command_line()
@@ -77,6 +108,12 @@ def define_options():
 install_directory = os.path.realpath(os.path.dirname(__file__))
 starting_directory = os.path.realpath(sys.path[0])
 stack_label = "combined_stack"
+shadow_label = "combined_stack_shadow"
+subset_label = "startup_subset"
+refine_subset_label = "refine_subset"
+shadow_import = {}
+ingestion_state = {}
+cycle_timing = {}
 clients = set()
 class_path_dict = {}
 
@@ -153,7 +190,14 @@ class SocketHandler(WebSocketHandler):
                 live2dlog.info("=============")
                 live2dlog.info("Importing newest particles before halting")
                 assert update_config_from_warp(config)
-                _ = await tornado.ioloop.IOLoop.current().run_in_executor(executor, partial(processing_functions.import_new_particles, stack_label=stack_label, warp_folder=config["warp_folder"], warp_star_filename="allparticles_{}.star".format(config["settings"]["neural_net"]), working_directory=config["working_directory"], new_net=config["next_run_new_particles"]))
+                if config["next_run_new_particles"] and config["cycles"]:
+                    live2dlog.info("Complete particle reimport is needed and will be swapped in at the next full job trigger")
+                    start_shadow_import(config)
+                else:
+                    async with import_lock:
+                        _ = await import_particles(config)
+                async with import_lock:
+                    _ = await tornado.ioloop.IOLoop.current().run_in_executor(executor, partial(processing_functions.trim_combined_stack, stack_label, config["working_directory"]))
                 config["job_status"] = "stopped"
                 message = {}
                 message["type"] = "settings_update"
@@ -266,7 +310,7 @@ async def listen_for_particles(config, clients):
         current_particle_count = 0
     try:
         warp_stack_filename = os.path.join(config["warp_folder"], "allparticles_{}.star".format(config["settings"]["neural_net"]))
-        new_particle_count = await processing_functions.particle_count_difference(warp_stack_filename, current_particle_count)
+        new_particle_count = await processing_functions.particle_count_difference(warp_stack_filename, current_particle_count, working_directory=config["working_directory"])
         live2dlog.info(f"New Particles Detected: {new_particle_count}")
         if new_particle_count >= particle_count_to_fire:
             live2dlog.info(f"Job triggering automatically as {new_particle_count} particles have been added by Warp since last import.")
@@ -284,14 +328,217 @@ async def listen_for_particles(config, clients):
         raise
 
 
+async def import_particles(config, import_executor=None):
+    """Import new warp particles into the combined stack with :py:func:`processing_functions.import_new_particles`, and publish the number of committed particles and the matching offset in the combined star file in :py:data:`ingestion_state`. If the import rolled back particles that were already classified, ab initio classification is forced and a running job stops after its current cycle (see :py:func:`particles_moved`). Callers must hold :py:data:`import_lock`.
+
+    Args:
+        config (dict): the global config object
+        import_executor (:py:class:`concurrent.futures.Executor`): Executor to import in. Defaults to the job executor.
+    Returns:
+        int: Total number of particles in the combined stack.
+    """
+    loop = tornado.ioloop.IOLoop.current()
+    import_executor = import_executor or executor
+    total_particles = await loop.run_in_executor(import_executor, partial(processing_functions.import_new_particles, stack_label=stack_label, warp_folder=config["warp_folder"], warp_star_filename="allparticles_{}.star".format(config["settings"]["neural_net"]), working_directory=config["working_directory"], new_net=config["next_run_new_particles"], thread_count=options.import_thread_count, preallocation_bytes=options.stack_preallocation_mb*1024*1024))
+    rolled_back = await loop.run_in_executor(import_executor, partial(processing_functions.pop_import_rollback, stack_label, config["working_directory"]))
+    if rolled_back is not None and config["cycles"]:
+        live2dlog.warn(f"Particles from position {rolled_back} on were reimported into {stack_label}, so the existing classes no longer match them and classification will restart ab initio.")
+        config["force_abinit"] = True
+    star_offset = await loop.run_in_executor(import_executor, partial(processing_functions.committed_star_offset, stack_label, config["working_directory"], total_particles))
+    if options.stack_pyramid_bins:
+        await loop.run_in_executor(import_executor, partial(processing_functions.update_stack_pyramid, stack_label, config["working_directory"], options.stack_pyramid_bins))
+    ingestion_state.update({"working_directory": config["working_directory"], "particle_count": total_particles, "star_offset": star_offset, "time": str(datetime.datetime.now())})
+    live2dlog.info(f"{total_particles} particles are committed to {stack_label} ({star_offset} bytes of star file)")
+    return total_particles
+
+
+def particles_moved(config):
+    """Whether an import has moved particles since the running job started, so that its classes no longer match the combined stack (see :py:func:`import_particles`). Warp settings changes also force ab initio classification, but leave the combined stack alone until the rebuild is swapped in."""
+    return config["force_abinit"] and not config["next_run_new_particles"]
+
+
+def committed_particle_count(config):
+    """The number of particles committed to the combined stack by the last import, or None if nothing has been imported into this working directory since the server started."""
+    if not ingestion_state.get("working_directory") == config["working_directory"]:
+        return None
+    return ingestion_state["particle_count"]
+
+
+async def ingest_particles(config):
+    """Import newly finished warp stacks into the combined stack in the background while jobs are listening or running, so jobs can start classifying the committed particles straight away instead of importing first.
+    Runs in its own low priority process, and is skipped while a job is importing or a full reimport is pending.
+
+    Args:
+        config (dict): the global config object
+    """
+    if config["ingesting"] or config["next_run_new_particles"] or import_lock.locked():
+        return
+    if config["job_status"] not in ("listening", "running"):
+        return
+    if not os.path.isfile(os.path.join(config["warp_folder"], "allparticles_{}.star".format(config["settings"]["neural_net"]))):
+        return
+    config["ingesting"] = True
+    try:
+        async with import_lock:
+            await import_particles(config, ingest_executor)
+    except OSError as err:
+        if err.errno not in (errno.ENODATA, errno.EAGAIN):
+            live2dlog.exception("Background particle ingestion failed")
+        live2dlog.debug(f"No particles ingested: {err}")
+    except Exception:
+        live2dlog.exception("Background particle ingestion failed")
+    finally:
+        config["ingesting"] = False
+
+
+def start_shadow_import(config):
+    """Start rebuilding the combined stack from scratch under :py:data:`shadow_label` in the background, after warp's neural net, box size or cutoff has changed, unless a rebuild is already running. Classification carries on with the existing stack until :py:func:`swap_in_shadow_import` swaps the rebuild in.
+
+    Args:
+        config (dict): the global config object
+    Returns:
+        :py:class:`concurrent.futures.Future`: The running or finished rebuild.
+    """
+    warp_settings = [config["settings"]["neural_net"], config["settings"]["box_size"], config["settings"]["warp_value_cutoff"]]
+    future = shadow_import.get("future")
+    if future is not None and (not future.done() or shadow_import["warp_settings"] == warp_settings):
+        return future
+    live2dlog.info("Rebuilding the particle stack for the new warp settings in the background")
+    shadow_import["warp_settings"] = warp_settings
+    shadow_import["future"] = shadow_executor.submit(processing_functions.import_new_particles, stack_label=shadow_label, warp_folder=config["warp_folder"], warp_star_filename="allparticles_{}.star".format(config["settings"]["neural_net"]), working_directory=config["working_directory"], new_net=True, thread_count=options.import_thread_count, preallocation_bytes=options.stack_preallocation_mb*1024*1024)
+    return shadow_import["future"]
+
+
+async def swap_in_shadow_import(config):
+    """Swap the background rebuild of the combined stack in if it has finished for the current warp settings, or start it if it hasn't been started.
+
+    Args:
+        config (dict): the global config object
+    Returns:
+        bool: True if the rebuilt stack was swapped in.
+    """
+    future = start_shadow_import(config)
+    if not future.done():
+        return False
+    # A finished rebuild is only returned if it was for the current warp settings.
+    shadow_import.clear()
+    try:
+        future.result()
+    except Exception:
+        live2dlog.exception("Background particle stack rebuild failed - it will be restarted on the next import")
+        return False
+    await tornado.ioloop.IOLoop.current().run_in_executor(executor, partial(processing_functions.swap_in_shadow_stack, stack_label, shadow_label, config["working_directory"]))
+    return True
+
+
+def max_dump_files(threads_per_process=1):
+    """Most refine2d chunks to split a cycle into, from ``merge_max_dump_files``, or None for no limit."""
+    if options.merge_max_dump_files < 0:
+        return None
+    return options.merge_max_dump_files or 2 * options.refine_chunks_per_process * scheduler.process_count(threads_per_process)
+
+
+async def run_refine_cycle(config, filename_number, refine_input, cycle_stack, particle_count, class_fraction, high_res_limit, bin_factor=1, threads_per_process=1):
+    """
+    Run the refine2d chunks and the merge2d of one classification cycle through the scheduler.
+
+    Each refine2d process runs ``threads_per_process`` threads and takes that many of the slots of the backend it runs on (``process_pool_size`` locally, or those of one of the ``worker_agents``). With ``tune_layouts`` on, the layout instead comes from ``layout_tuning.json``: the fastest stored layout for the cycle's box size, binning, resolution limit and particle count, or the next candidate layout still to be timed, whose throughput is then stored.
+
+    Args:
+        config (dict): the global configuration file.
+        filename_number (int): Cycle number the classes are refined from.
+        refine_input (function): :py:func:`live2d.processing_functions.refine_2d_input` with the cycle's settings filled in.
+        cycle_stack (str): Particle stack the cycle classifies.
+        particle_count (int): Number of particles in the stack.
+        class_fraction (float): Fraction of the particles refine2d classifies.
+        high_res_limit (float): High resolution limit of the cycle, in Å.
+        bin_factor (int): Binning of ``cycle_stack`` relative to the combined stack.
+        threads_per_process (int): Threads per process to use without a tuned layout.
+    Returns:
+        int: Number of chunks the particles were split into.
+        int: Threads per process used.
+    """
+    loop = tornado.ioloop.IOLoop.current()
+    if options.tune_layouts:
+        layout_filename = os.path.join(config_folder, "layout_tuning.json")
+        box_size = (await loop.run_in_executor(executor, processing_functions.read_particle_stack_header, os.path.join(config["working_directory"], cycle_stack)))[0]
+        bucket = scheduling.layout_bucket(box_size, int(particle_count * class_fraction), bin_factor=bin_factor, high_res_limit=high_res_limit)
+        candidates = scheduling.layout_candidates(options.process_pool_size)
+        threads_per_process = scheduling.choose_threads_per_process(layout_filename, bucket, candidates, threads_per_process, tune=True)
+    live2dlog.info(f"Running {scheduler.process_count(threads_per_process)} refine2d processes with {threads_per_process} threads each")
+    start_time = time.time()
+    if cycle_timing.get("refine_finished") is not None:
+        live2dlog.info("refine2d was idle for {0:.1f} seconds between cycles".format(start_time - cycle_timing["refine_finished"]))
+    results_list, chunks = await scheduler.map_chunks("refine2d", particle_count, lambda index, first, last, attempt: refine_input(index, first_particle=first, last_particle=last, attempt=attempt, thread_count=threads_per_process), chunks_per_slot=options.refine_chunks_per_process, min_chunk_size=options.refine_chunk_min_particles, chunk_files=lambda index, attempt: processing_functions.refine_2d_output_files(index, filename_number, config["working_directory"], attempt=attempt), timeout=options.refine_chunk_timeout_s or None, retries=options.refine_chunk_retries, speculation_factor=options.refine_speculation_factor, threads=threads_per_process, max_chunks=max_dump_files(threads_per_process))
+    cycle_timing["refine_finished"] = time.time()
+    if options.tune_layouts and threads_per_process in candidates:
+        best = scheduling.record_layout_trial(layout_filename, bucket, threads_per_process, particle_count * class_fraction / (time.time() - start_time), candidates)
+        if best is not None:
+            live2dlog.info(f"Best layout for {bucket} is {best} threads per process")
+    live2dlog.info(results_list[0].decode('utf-8'))
+    merge_start_time = time.time()
+    # merge2d runs locally, next to the dump files it reads, and a failed merge fails the cycle.
+    merge_output = await scheduler.run("merge2d", "merge2d", processing_functions.merge_2d_input(filename_number, config["working_directory"], process_count=len(chunks)), local=True)
+    if scheduler.slices["merge2d"]["state"] != "finished":
+        raise RuntimeError("merge2d failed with code {0}: {1}".format(scheduler.slices["merge2d"]["returncode"], merge_output.decode('utf-8')))
+    live2dlog.info(merge_output.decode('utf-8'))
+    live2dlog.info("merge2d combined {0} dump files in {1:.1f} seconds".format(len(chunks), time.time() - merge_start_time))
+    await loop.run_in_executor(executor, partial(processing_functions.remove_dump_files, config["working_directory"], process_count=len(chunks)))
+    return len(chunks), threads_per_process
+
+
+def block_converged(metrics, cycles_in_block):
+    """
+    Apply the early stop policy to the convergence metrics of a cycle (see :py:func:`live2d.processing_functions.convergence_metrics`).
+
+    Args:
+        metrics (dict): Convergence metrics of the cycle.
+        cycles_in_block (int): Number of cycles the block has run, including this one.
+    Returns:
+        bool: True if ``converge_early_stop`` is on and the block can end after this cycle.
+    """
+    if not options.converge_early_stop or cycles_in_block < options.converge_min_cycles:
+        return False
+    if metrics["class_change_fraction"] is None or metrics["class_change_fraction"] > options.converge_class_change:
+        return False
+    if metrics["occupancy_drift"] is None or metrics["occupancy_drift"] > options.converge_occupancy_drift:
+        return False
+    if options.converge_score_change > 0 and (metrics["mean_score_change"] is None or metrics["mean_score_change"] > options.converge_score_change):
+        return False
+    return True
+
+
+async def publish_cycle(config, cycle_number, photos, previous_publish=None):
+    """
+    Save the config and send the gallery of a finished cycle to the clients once its class images are exported.
+    Runs alongside the next cycle's refine2d, so the next cycle only waits for the merged classes and star file. Each cycle waits for the previous one to be published first, so galleries arrive in order.
+
+    Args:
+        config (dict): the global configuration file.
+        cycle_number (int): Number of the finished cycle.
+        photos (asyncio.Future): :py:func:`live2d.processing_functions.make_photos` running for the cycle.
+        previous_publish (asyncio.Task): Publication of the previous cycle.
+    """
+    if previous_publish is not None:
+        await previous_publish
+    try:
+        await photos
+        dump_json(config)
+        return_data = await get_new_gallery(config, {"gallery_number": cycle_number})
+        live2dlog.info("Sending new gallery to clients")
+        await message_all_clients(return_data)
+    except Exception:
+        live2dlog.exception(f"Failed to publish cycle_{cycle_number}")
+
+
 async def execute_job_loop(config):
     """The main job loop.
 
-    Combines new particles picked by warp into a single growing stack iteratively, then sends out a series of refine2d and merge2d jobs based on the settings entries of the config object. Uses multiprocessing to generate pools to split jobs into as many processes as are set by the process_count setting. Sends out processpoolexecutors where possible (and threadpoolexecutors elsewhere) to split off each individual cisTEM run from the main thread to keep the webapp responsive.
+    Combines new particles picked by warp into a single growing stack iteratively, then sends out a series of refine2d and merge2d jobs based on the settings entries of the config object. Runs refine2d and merge2d as subprocesses of the persistent :py:class:`live2d.scheduling.CistemScheduler`, splitting refine2d into as many slices as are set by the process_count setting. Sends out processpoolexecutors where possible (and threadpoolexecutors elsewhere) to split off each individual cisTEM run from the main thread to keep the webapp responsive.
 
     Webapp slowdowns still frequently happen at the beginning and end of cisTEM jobs - I believe these are actually related to disk and memory IO limitations, as cisTEM can hit those hard.
 
-    Results are written to the config classifications entry as they come in, and the config is written to file at the end of each cycle of classification.
+    Results are written to the config classifications entry as they come in, and the config is written to file at the end of each cycle of classification. Exporting a cycle's class images, saving the config and sending the gallery to clients (:py:func:`publish_cycle`) run alongside the next cycle's refine2d, which only waits for the merged classes and star file; the time refine2d sits idle between cycles is logged.
 
     Args:
         config (dict): the global configuration file.
@@ -302,6 +549,9 @@ async def execute_job_loop(config):
     try:
         loop = tornado.ioloop.IOLoop.current()
         process_count = options.process_pool_size
+        photos = None
+        publish_task = None
+        cycle_timing["refine_finished"] = None
         live2dlog.info("============================")
         live2dlog.info("Beginning Classification Job")
         live2dlog.info("============================")
@@ -321,12 +571,30 @@ async def execute_job_loop(config):
         # Import particles
         # live2dlog.info("importing particles")
         assert update_config_from_warp(config)
-        total_particles = await loop.run_in_executor(executor, partial(processing_functions.import_new_particles, stack_label=stack_label, warp_folder=config["warp_folder"], warp_star_filename="allparticles_{}.star".format(config["settings"]["neural_net"]), working_directory=config["working_directory"], new_net=config["next_run_new_particles"]))
-
-        config["next_run_new_particles"] = False
+        # import_lock is only taken to change the combined stack. The particles committed by background ingestion are only ever appended to, so the job can start from them without waiting for an ingestion that is still running.
+        reimport_pending = False
+        if config["next_run_new_particles"] and previous_classes_bool and os.path.isfile(os.path.join(config["working_directory"], "{}.mrcs".format(stack_label))):
+            async with import_lock:
+                swapped = await swap_in_shadow_import(config)
+            if swapped:
+                config["next_run_new_particles"] = False
+                ingestion_state.clear()
+            else:
+                live2dlog.info("Classifying the existing particles while the particle stack is rebuilt in the background")
+                reimport_pending = True
+        if reimport_pending:
+            total_particles = processing_functions.count_star_rows(os.path.join(config["working_directory"], "{}.star".format(stack_label)))
+        elif options.ingest_period_ms > 0 and not config["next_run_new_particles"] and committed_particle_count(config) is not None:
+            total_particles = committed_particle_count(config)
+            live2dlog.info(f"Starting from the {total_particles} particles committed by background ingestion")
+        else:
+            async with import_lock:
+                total_particles = await import_particles(config)
+            config["next_run_new_particles"] = False
         dump_json(config)
         # Generate new classes
-        if config["force_abinit"]:
+        # While the rebuilt stack is pending, force_abinit stays set so the swap is followed by ab initio classification.
+        if config["force_abinit"] and not reimport_pending:
             live2dlog.info("Classification type choice is disregarded because ab initio classification is required for these user settings.")
             config["settings"]["classification_type"] = "abinit"
             config["force_abinit"] = False
@@ -337,7 +605,7 @@ async def execute_job_loop(config):
         if previous_classes_bool and not merge_star:
             start_cycle_number += 1
         live2dlog.info(f"The classification type for this run will be {config['settings']['classification_type']}.")
-        new_star_file = await loop.run_in_executor(executor, partial(processing_functions.generate_star_file, stack_label=stack_label, working_directory=config["working_directory"], previous_classes_bool=previous_classes_bool, merge_star=merge_star, recent_class=recent_class, start_cycle_number=start_cycle_number))
+        new_star_file = await loop.run_in_executor(executor, partial(processing_functions.generate_star_file, stack_label=stack_label, working_directory=config["working_directory"], previous_classes_bool=previous_classes_bool, merge_star=merge_star, recent_class=recent_class, start_cycle_number=start_cycle_number, particle_limit=total_particles))
         particle_count, particles_per_process, class_fraction = await loop.run_in_executor(executor, partial(processing_functions.calculate_particle_statistics, filename=os.path.join(config["working_directory"], new_star_file), class_number=int(config["settings"]["class_number"]), particles_per_class=int(config["settings"]["particles_per_class"]), process_count=process_count))
         if config["settings"]["classification_type"] == "seeded":
             class_fraction = 1.0
@@ -346,7 +614,8 @@ async def execute_job_loop(config):
             live2dlog.info("============================")
             live2dlog.info("Preparing Initial 2D Classes")
             live2dlog.info("============================")
-            await loop.run_in_executor(executor, partial(processing_functions.generate_new_classes, start_cycle_number=start_cycle_number, class_number=int(config["settings"]["class_number"]), input_stack="{}.mrcs".format(stack_label), pixel_size=float(config["settings"]["pixel_size"]), mask_radius=config["settings"]["mask_radius"], low_res=300, high_res=int(config["settings"]["high_res_initial"]), new_star_file=new_star_file, working_directory=config["working_directory"], automask=config["settings"]["automask"], autocenter=config["settings"]["autocenter"]))
+            cycle_stack, cycle_pixel_size, cycle_star_file, _ = await loop.run_in_executor(executor, partial(processing_functions.prepare_pyramid_cycle, stack_label, config["working_directory"], new_star_file, start_cycle_number, int(config["settings"]["high_res_initial"]), float(config["settings"]["pixel_size"]), options.stack_pyramid_bins, particle_count, class_filename=False))
+            await loop.run_in_executor(executor, partial(processing_functions.generate_new_classes, start_cycle_number=start_cycle_number, class_number=int(config["settings"]["class_number"]), input_stack=cycle_stack, pixel_size=cycle_pixel_size, mask_radius=config["settings"]["mask_radius"], low_res=300, high_res=int(config["settings"]["high_res_initial"]), new_star_file=cycle_star_file, working_directory=config["working_directory"], automask=config["settings"]["automask"], autocenter=config["settings"]["autocenter"], thread_count=options.abinit_thread_count or process_count))
 
             await loop.run_in_executor(executor, processing_functions.make_photos, "cycle_{}".format(start_cycle_number), config["working_directory"])
             classified_count_per_class = [0]*(int(config["settings"]["class_number"])+1)  # All classes are empty for the initialization!
@@ -365,10 +634,24 @@ async def execute_job_loop(config):
             live2dlog.info("Of the total {} particles, {:.0f}% will be classified into {} classes".format(particle_count, class_fraction*100, config["settings"]["class_number"]))
             live2dlog.info("Classification will begin at {}Å and step up to {}Å resolution over {} iterative cycles of classification".format(config["settings"]["high_res_initial"], config["settings"]["high_res_final"], resolution_cycle_count))
             live2dlog.info("{0} particles per process will be classified by {1} processes.".format(particles_per_process*class_fraction, process_count))
+            subset_star_file = None
+            if 0 < class_fraction <= options.subset_startup_fraction and not config["kill_job"]:
+                block_star_file = new_star_file
+                subset_star_file, subset_count = await loop.run_in_executor(executor, partial(processing_functions.write_subset_stack, stack_label, config["working_directory"], new_star_file, class_fraction, subset_label=subset_label, bin_factors=options.stack_pyramid_bins))
+            converged = False
+            startup_cycles_run = resolution_cycle_count
             for cycle_number in range(resolution_cycle_count):
                 if config["kill_job"]:
                     live2dlog.info("Job Killed - Cycle Skipped")
                     continue
+                if converged:
+                    live2dlog.info(f"Classification converged after {cycle_number} startup cycles - moving on to refinement")
+                    startup_cycles_run = cycle_number
+                    break
+                if particles_moved(config):
+                    live2dlog.warn("Classified particles were reimported into the combined stack, so the rest of this job is skipped and the next job will start ab initio")
+                    startup_cycles_run = cycle_number
+                    break
                 low_res_limit = 300
                 high_res_limit = int(config["settings"]["high_res_initial"])-(((int(config["settings"]["high_res_initial"])-int(config["settings"]["high_res_final"]))/(resolution_cycle_count-1))*cycle_number)
                 filename_number = cycle_number + start_cycle_number
@@ -376,40 +659,53 @@ async def execute_job_loop(config):
                 live2dlog.info("Sending a new classification job out for processing")
                 live2dlog.info("===================================================")
                 live2dlog.info("High Res Limit: {0:.2}".format(high_res_limit))
-                live2dlog.info("Fraction of Particles: {0:.2}".format(class_fraction))
-                live2dlog.info(f"Number of Particles: {particle_count}")
+                if subset_star_file:
+                    cycle_label, cycle_input_star, cycle_particle_count, cycle_particles_per_process, cycle_class_fraction = subset_label, subset_star_file, subset_count, int(ceil(subset_count / process_count)), 1.0
+                else:
+                    cycle_label, cycle_input_star, cycle_particle_count, cycle_particles_per_process, cycle_class_fraction = stack_label, new_star_file, particle_count, particles_per_process, class_fraction
+                live2dlog.info("Fraction of Particles: {0:.2}".format(cycle_class_fraction))
+                live2dlog.info(f"Number of Particles: {cycle_particle_count}")
                 live2dlog.info(f"Dispatching job at {datetime.datetime.now()}")
-                pool = multiprocessing.Pool(processes=process_count)
-                refine_job = partial(processing_functions.refine_2d_subjob, round=filename_number, input_star_filename=new_star_file, input_stack="{}.mrcs".format(stack_label), particles_per_process=particles_per_process, mask_radius=config["settings"]["mask_radius"], low_res_limit=low_res_limit, high_res_limit=high_res_limit, class_fraction=class_fraction, particle_count=particle_count, pixel_size=float(config["settings"]["pixel_size"]), angular_search_step=15, max_search_range=49.5, process_count=process_count, working_directory=config["working_directory"], automask=config["settings"]["automask"], autocenter=config["settings"]["autocenter"])
-                results_list = await loop.run_in_executor(executor2, pool.map, refine_job, range(process_count))
-
-                pool.close()
-                live2dlog.info(results_list[0].decode('utf-8'))
-                await loop.run_in_executor(executor, partial(processing_functions.merge_2d_subjob, filename_number, config["working_directory"], process_count=process_count))
-                await loop.run_in_executor(executor, processing_functions.make_photos, "cycle_{}".format(filename_number+1), config["working_directory"])
-                new_star_file = await loop.run_in_executor(executor, partial(processing_functions.merge_star_files, filename_number, process_count=process_count, working_directory=config["working_directory"]))
-                classified_count_per_class = await loop.run_in_executor(executor, processing_functions.count_particles_per_class, new_star_file)
-                new_cycle = {"name": "cycle_{}".format(filename_number+1), "number": filename_number+1, "settings": config["settings"], "high_res_limit": high_res_limit, "block_type": "startup", "cycle_number_in_block": cycle_number+1, "time": str(datetime.datetime.now()), "process_count": process_count, "particle_count": total_particles, "particle_count_per_class": classified_count_per_class, "fraction_used": class_fraction}
+                cycle_stack, cycle_pixel_size, cycle_star_file, cycle_classes = await loop.run_in_executor(executor, partial(processing_functions.prepare_pyramid_cycle, cycle_label, config["working_directory"], cycle_input_star, filename_number, high_res_limit, float(config["settings"]["pixel_size"]), options.stack_pyramid_bins, cycle_particle_count))
+                refine_input = partial(processing_functions.refine_2d_input, round=filename_number, input_star_filename=cycle_star_file, input_classes=cycle_classes, input_stack=cycle_stack, particles_per_process=cycle_particles_per_process, mask_radius=config["settings"]["mask_radius"], low_res_limit=low_res_limit, high_res_limit=high_res_limit, class_fraction=cycle_class_fraction, particle_count=cycle_particle_count, pixel_size=cycle_pixel_size, angular_search_step=15, max_search_range=49.5, working_directory=config["working_directory"], automask=config["settings"]["automask"], autocenter=config["settings"]["autocenter"])
+                chunk_count, threads_per_process = await run_refine_cycle(config, filename_number, refine_input, cycle_stack, cycle_particle_count, cycle_class_fraction, high_res_limit, bin_factor=int(round(cycle_pixel_size / float(config["settings"]["pixel_size"]))), threads_per_process=options.startup_threads_per_process)
+                new_star_file, classified_count_per_class, classified_particle_count = await loop.run_in_executor(executor, partial(processing_functions.merge_star_files, filename_number, process_count=chunk_count, working_directory=config["working_directory"], count_classes=True))
+                if subset_star_file:
+                    # Keep the subset results for the next startup cycle, and map them back onto all the particles for everything else.
+                    subset_star_file = os.path.join(config["working_directory"], "cycle_{}_{}.star".format(filename_number+1, subset_label))
+                    os.replace(new_star_file, subset_star_file)
+                    classified_particle_count = await loop.run_in_executor(executor, partial(processing_functions.map_subset_star, subset_star_file, block_star_file, os.path.join(config["working_directory"], "{}_positions.npy".format(subset_label)), new_star_file))
+                    classified_count_per_class = await loop.run_in_executor(executor, processing_functions.count_particles_per_class, new_star_file)
+                metrics = await loop.run_in_executor(executor, processing_functions.convergence_metrics, new_star_file, os.path.join(config["working_directory"], "cycle_{}.star".format(filename_number)))
+                live2dlog.info("Convergence: {}".format(metrics))
+                new_cycle = {"name": "cycle_{}".format(filename_number+1), "number": filename_number+1, "settings": config["settings"], "high_res_limit": high_res_limit, "block_type": "startup", "cycle_number_in_block": cycle_number+1, "time": str(datetime.datetime.now()), "process_count": process_count, "chunk_count": chunk_count, "threads_per_process": threads_per_process, "particle_count": classified_particle_count, "particle_count_per_class": classified_count_per_class, "fraction_used": class_fraction, "convergence": metrics}
                 config["cycles"].append(new_cycle)
-                dump_json(config)
-                return_data = await get_new_gallery(config, {"gallery_number": filename_number+1})
-                live2dlog.info("Sending new gallery to clients")
-                await message_all_clients(return_data)
+                converged = block_converged(metrics, cycle_number+1)
+                photos = loop.run_in_executor(publish_executor, processing_functions.make_photos, "cycle_{}".format(filename_number+1), config["working_directory"])
+                publish_task = asyncio.ensure_future(publish_cycle(config, filename_number+1, photos, previous_publish=publish_task))
 
                 # IMPORT NEW PARTICLES
                 live2dlog.info("Getting new particles between jobs")
                 assert update_config_from_warp(config)
                 if config["next_run_new_particles"] is True:
-                    live2dlog.info("Complete particle reimport is needed and will be deferred until the next full job trigger")
+                    live2dlog.info("Complete particle reimport is needed and will be swapped in at the next full job trigger")
+                    start_shadow_import(config)
                     continue
-                total_particles = await loop.run_in_executor(executor, partial(processing_functions.import_new_particles, stack_label=stack_label, warp_folder=config["warp_folder"], warp_star_filename="allparticles_{}.star".format(config["settings"]["neural_net"]), working_directory=config["working_directory"], new_net=config["next_run_new_particles"]))
+                if options.ingest_period_ms > 0 and committed_particle_count(config) is not None:
+                    total_particles = committed_particle_count(config)
+                else:
+                    async with import_lock:
+                        total_particles = await import_particles(config)
                 dump_json(config)
-                new_star_file = await loop.run_in_executor(executor, partial(processing_functions.generate_star_file, stack_label=stack_label, working_directory=config["working_directory"], previous_classes_bool=True, merge_star=True, recent_class=config["cycles"][-1]["name"], start_cycle_number=start_cycle_number))
+                new_star_file = await loop.run_in_executor(executor, partial(processing_functions.generate_star_file, stack_label=stack_label, working_directory=config["working_directory"], previous_classes_bool=True, merge_star=True, recent_class=config["cycles"][-1]["name"], start_cycle_number=start_cycle_number, particle_limit=total_particles))
+                if subset_star_file:
+                    # New particles are appended, so the subset positions still index the regenerated star.
+                    block_star_file = new_star_file
                 particle_count, particles_per_process, class_fraction = await loop.run_in_executor(executor, partial(processing_functions.calculate_particle_statistics, filename=os.path.join(config["working_directory"], new_star_file), class_number=int(config["settings"]["class_number"]), particles_per_class=int(config["settings"]["particles_per_class"]), process_count=process_count))
                 if config["settings"]["classification_type"] == "seeded":
                     class_fraction = 1.0
 
-            start_cycle_number = start_cycle_number + resolution_cycle_count
+            start_cycle_number = start_cycle_number + startup_cycles_run
 
         # Refinement Cycles
         refinement_cycle_count = int(config["settings"]["run_count_refine"])
@@ -419,10 +715,17 @@ async def execute_job_loop(config):
         live2dlog.info("==========================================================")
         live2dlog.info("All {} particles will be classified into {} classes at resolution {}Å".format(particle_count, config["settings"]["class_number"], config["settings"]["high_res_final"]))
         live2dlog.info("{0} particles per process will be classified by {1} processes.".format(particles_per_process, process_count))
+        converged = False
         for cycle_number in range(refinement_cycle_count):
             if config["kill_job"]:
                 live2dlog.info("Job Killed - Cycle Skipped")
                 continue
+            if converged:
+                live2dlog.info(f"Classification converged after {cycle_number} refinement cycles - ending the job early")
+                break
+            if particles_moved(config):
+                live2dlog.warn("Classified particles were reimported into the combined stack, so the rest of this job is skipped and the next job will start ab initio")
+                break
             live2dlog.info("===================================================")
             live2dlog.info("Sending a new classification job out for processing")
             live2dlog.info("===================================================")
@@ -430,40 +733,62 @@ async def execute_job_loop(config):
             high_res_limit = float(config["settings"]["high_res_final"])
             filename_number = cycle_number + start_cycle_number
             live2dlog.info("High Res Limit: {0}".format(high_res_limit))
-            live2dlog.info("Fraction of Particles: {0:.2}".format(class_fraction))
-            live2dlog.info(f"Number of Particles: {particle_count}")
+            cycle_label, cycle_input_star, cycle_particle_count, fraction_used = stack_label, new_star_file, particle_count, class_fraction
+            incremental = False
+            if options.incremental_refinement:
+                rows = await loop.run_in_executor(executor, partial(processing_functions.select_incremental_rows, new_star_file, os.path.join(config["working_directory"], "cycle_{}.star".format(filename_number)), os.path.join(config["working_directory"], "cycle_{}.star".format(filename_number-1)), filename_number, revisit_fraction=options.incremental_revisit_fraction, score_change_factor=options.incremental_score_change_factor))
+                if 0 < len(rows) <= options.incremental_max_fraction * particle_count:
+                    incremental = True
+                    block_star_file = new_star_file
+                    cycle_input_star, cycle_particle_count = await loop.run_in_executor(executor, partial(processing_functions.write_subset_stack, stack_label, config["working_directory"], new_star_file, None, subset_label=refine_subset_label, bin_factors=options.stack_pyramid_bins, rows=rows))
+                    cycle_label, fraction_used = refine_subset_label, cycle_particle_count / particle_count
+                else:
+                    live2dlog.info("Classifying all particles this cycle")
+            live2dlog.info("Fraction of Particles: {0:.2}".format(fraction_used))
+            live2dlog.info(f"Number of Particles: {cycle_particle_count}")
             live2dlog.info(f"Dispatching job at {datetime.datetime.now()}")
-            pool = multiprocessing.Pool(processes=int(process_count))
-            refine_job = partial(processing_functions.refine_2d_subjob, round=filename_number, input_star_filename=new_star_file, input_stack="{}.mrcs".format(stack_label), particles_per_process=particles_per_process, mask_radius=config["settings"]["mask_radius"], low_res_limit=low_res_limit, high_res_limit=high_res_limit, class_fraction=class_fraction, particle_count=particle_count, pixel_size=float(config["settings"]["pixel_size"]), angular_search_step=15, max_search_range=49.5, process_count=process_count, working_directory=config["working_directory"], automask=config["settings"]["automask"], autocenter=config["settings"]["autocenter"])
-            results_list = await loop.run_in_executor(executor2, pool.map, refine_job, range(process_count))
-            pool.close()
-            live2dlog.info(results_list[30].decode('utf-8'))
-            await loop.run_in_executor(executor, partial(processing_functions.merge_2d_subjob, filename_number, config["working_directory"], process_count=int(process_count)))
-            await loop.run_in_executor(executor, processing_functions.make_photos, "cycle_{}".format(filename_number+1), config["working_directory"])
-            new_star_file = await loop.run_in_executor(executor, partial(processing_functions.merge_star_files, filename_number, process_count=process_count, working_directory=config["working_directory"]))
-            classified_count_per_class = await loop.run_in_executor(executor, processing_functions.count_particles_per_class, new_star_file)
-            new_cycle = {"name": "cycle_{}".format(filename_number+1), "number": filename_number+1, "settings": config["settings"], "high_res_limit": high_res_limit, "block_type": "refinement", "cycle_number_in_block": cycle_number+1, "time": str(datetime.datetime.now()), "process_count": process_count, "particle_count": total_particles, "particle_count_per_class": classified_count_per_class, "fraction_used": class_fraction}
+            cycle_stack, cycle_pixel_size, cycle_star_file, cycle_classes = await loop.run_in_executor(executor, partial(processing_functions.prepare_pyramid_cycle, cycle_label, config["working_directory"], cycle_input_star, filename_number, high_res_limit, float(config["settings"]["pixel_size"]), options.stack_pyramid_bins, cycle_particle_count))
+            refine_input = partial(processing_functions.refine_2d_input, round=filename_number, input_star_filename=cycle_star_file, input_classes=cycle_classes, input_stack=cycle_stack, particles_per_process=particles_per_process, mask_radius=config["settings"]["mask_radius"], low_res_limit=low_res_limit, high_res_limit=high_res_limit, class_fraction=class_fraction, particle_count=cycle_particle_count, pixel_size=cycle_pixel_size, angular_search_step=15, max_search_range=49.5, working_directory=config["working_directory"], automask=config["settings"]["automask"], autocenter=config["settings"]["autocenter"])
+            chunk_count, threads_per_process = await run_refine_cycle(config, filename_number, refine_input, cycle_stack, cycle_particle_count, class_fraction, high_res_limit, bin_factor=int(round(cycle_pixel_size / float(config["settings"]["pixel_size"]))), threads_per_process=options.refinement_threads_per_process)
+            new_star_file, classified_count_per_class, classified_particle_count = await loop.run_in_executor(executor, partial(processing_functions.merge_star_files, filename_number, process_count=chunk_count, working_directory=config["working_directory"], count_classes=True))
+            if incremental:
+                # Put the reclassified particles back among the rest, and count the classes over all of them.
+                refine_subset_star = os.path.join(config["working_directory"], "cycle_{}_{}.star".format(filename_number+1, refine_subset_label))
+                os.replace(new_star_file, refine_subset_star)
+                classified_particle_count = await loop.run_in_executor(executor, partial(processing_functions.map_subset_star, refine_subset_star, block_star_file, os.path.join(config["working_directory"], "{}_positions.npy".format(refine_subset_label)), new_star_file))
+                classified_count_per_class = await loop.run_in_executor(executor, processing_functions.count_particles_per_class, new_star_file)
+            metrics = await loop.run_in_executor(executor, processing_functions.convergence_metrics, new_star_file, os.path.join(config["working_directory"], "cycle_{}.star".format(filename_number)), rows if incremental else None)
+            live2dlog.info("Convergence: {}".format(metrics))
+            new_cycle = {"name": "cycle_{}".format(filename_number+1), "number": filename_number+1, "settings": config["settings"], "high_res_limit": high_res_limit, "block_type": "refinement", "cycle_number_in_block": cycle_number+1, "time": str(datetime.datetime.now()), "process_count": process_count, "chunk_count": chunk_count, "threads_per_process": threads_per_process, "particle_count": classified_particle_count, "particle_count_per_class": classified_count_per_class, "fraction_used": fraction_used, "convergence": metrics}
             config["cycles"].append(new_cycle)
-            dump_json(config)
-            return_data = await get_new_gallery(config, {"gallery_number": filename_number+1})
-            live2dlog.info("Sending new gallery to clients")
-            await message_all_clients(return_data)
+            converged = block_converged(metrics, cycle_number+1)
+            photos = loop.run_in_executor(publish_executor, processing_functions.make_photos, "cycle_{}".format(filename_number+1), config["working_directory"])
+            publish_task = asyncio.ensure_future(publish_cycle(config, filename_number+1, photos, previous_publish=publish_task))
 
             # IMPORT NEW PARTICLES
             live2dlog.info("Getting new particles between jobs")
             assert update_config_from_warp(config)
             if config["next_run_new_particles"] is True:
-                live2dlog.info("Complete particle reimport is needed and will be deferred until the next full job trigger")
+                live2dlog.info("Complete particle reimport is needed and will be swapped in at the next full job trigger")
+                start_shadow_import(config)
                 continue
-            total_particles = await loop.run_in_executor(executor, partial(processing_functions.import_new_particles, stack_label=stack_label, warp_folder=config["warp_folder"], warp_star_filename="allparticles_{}.star".format(config["settings"]["neural_net"]), working_directory=config["working_directory"], new_net=config["next_run_new_particles"]))
+            if options.ingest_period_ms > 0 and committed_particle_count(config) is not None:
+                total_particles = committed_particle_count(config)
+            else:
+                async with import_lock:
+                    total_particles = await import_particles(config)
             dump_json(config)
-            new_star_file = await loop.run_in_executor(executor, partial(processing_functions.generate_star_file, stack_label=stack_label, working_directory=config["working_directory"], previous_classes_bool=True, merge_star=True, recent_class=config["cycles"][-1]["name"], start_cycle_number=start_cycle_number))
+            new_star_file = await loop.run_in_executor(executor, partial(processing_functions.generate_star_file, stack_label=stack_label, working_directory=config["working_directory"], previous_classes_bool=True, merge_star=True, recent_class=config["cycles"][-1]["name"], start_cycle_number=start_cycle_number, particle_limit=total_particles))
             particle_count, particles_per_process, _ = await loop.run_in_executor(executor, partial(processing_functions.calculate_particle_statistics, filename=os.path.join(config["working_directory"], new_star_file), class_number=int(config["settings"]["class_number"]), particles_per_class=int(config["settings"]["particles_per_class"]), process_count=process_count))
             class_fraction = 1.0
 
+        if publish_task is not None:
+            await publish_task
         if config["settings"]["classification_type"] == "abinit":
             config["settings"]["classification_type"] = "seeded"
         if config["kill_job"]:
+            async with import_lock:
+                await loop.run_in_executor(executor, partial(processing_functions.trim_combined_stack, stack_label, config["working_directory"]))
             config["job_status"] = "stopped"
             config["kill_job"] = False
         else:
@@ -474,6 +799,11 @@ async def execute_job_loop(config):
         await message_all_clients(return_message)
     except Exception:
         live2dlog.exception("Job Loop Failed")
+        try:
+            async with import_lock:
+                await tornado.ioloop.IOLoop.current().run_in_executor(executor, partial(processing_functions.trim_combined_stack, stack_label, config["working_directory"]))
+        except Exception:
+            live2dlog.exception(f"Couldn't trim {stack_label}.mrcs")
         if config["kill_job"]:
             config["job_status"] = "stopped"
             config["kill_job"] = False
@@ -521,9 +851,17 @@ def main():
     config["job_status"] = "stopped"
     config["kill_job"] = False
     config["counting"] = False
+    config["ingesting"] = False
     class_path_dict["path"] = os.path.join(config["working_directory"], "class_images")
     global live2dlog
     live2dlog = initialize_logger(config)
+    try:
+        if processing_functions.finish_shadow_swap(stack_label, config["working_directory"]):
+            live2dlog.warn(f"Finished swapping in the rebuilt {stack_label}, which was interrupted.")
+        # Preallocated space is only trimmed when a job stops, so clean up after a crash.
+        processing_functions.trim_combined_stack(stack_label, config["working_directory"])
+    except (OSError, ValueError):
+        live2dlog.exception(f"Couldn't recover {stack_label}.mrcs after the last session")
 
     global options
     options = define_options()
@@ -537,9 +875,17 @@ def main():
     print('Listening on http://localhost:%i' % options.port)
 
     global executor
-    global executor2
     executor = ProcessPoolExecutor(max_workers=1)
-    executor2 = ThreadPoolExecutor(max_workers=1)
+    global publish_executor
+    publish_executor = ProcessPoolExecutor(max_workers=1)
+    global scheduler
+    scheduler = scheduling.CistemScheduler(concurrency=options.process_pool_size, backends=scheduling.parse_worker_agents(options.worker_agents, options.worker_agent_secret))
+    global shadow_executor
+    shadow_executor = ProcessPoolExecutor(max_workers=1)
+    global ingest_executor
+    ingest_executor = ProcessPoolExecutor(max_workers=1, initializer=os.nice, initargs=(options.ingest_niceness,))
+    global import_lock
+    import_lock = asyncio.Lock()
 
     tailed_callback = tornado.ioloop.PeriodicCallback(lambda: tail_log(config, clients), options.tail_log_period_ms)
     tailed_callback.start()
@@ -547,7 +893,22 @@ def main():
     listening_callback = tornado.ioloop.PeriodicCallback(lambda: listen_for_particles(config, clients), options.listening_period_ms)
     listening_callback.start()
 
-    tornado.ioloop.IOLoop.current().start()
+    if options.ingest_period_ms > 0:
+        ingest_callback = tornado.ioloop.PeriodicCallback(lambda: ingest_particles(config), options.ingest_period_ms)
+        ingest_callback.start()
+
+    # Stop the server cleanly on SIGTERM as well as on ctrl-C, so the spare space at the end of the stack is always trimmed.
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, tornado.ioloop.IOLoop.current().stop)
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        # Let any import that is still copying particles commit them first.
+        executor.shutdown(wait=True)
+        ingest_executor.shutdown(wait=True)
+        try:
+            processing_functions.trim_combined_stack(stack_label, config["working_directory"])
+        except (OSError, ValueError):
+            live2dlog.exception(f"Couldn't trim {stack_label}.mrcs")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+
+#
+# Copyright 2019 Genentech Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Worker agent check for Live 2D Classification
+=============================================
+Starts a few worker agents (see :py:mod:`live2d.worker_agent`) on localhost ports and runs a batch of chunks through them with :py:class:`live2d.scheduling.CistemScheduler`, the way a Live2D server does, as a reproducible stand-in for a cluster. Run it with ``python -m live2d.agent_check --agents 2 --slots 2``.
+
+The chunks are small python scripts, run by the agents with the same python as the check, so no cisTEM2 installation is needed. The scheduler is told each agent has twice the slots it really has, so that the agents' own limits are exercised. The check passes if every chunk comes back with its own output, every agent ran some of them, no agent ran more threads at once than it has slots, and the agents run a ``cat`` job with a path inside their root but refuse one with the wrong secret and ones with an absolute or a relative path outside their root.
+
+Author: Benjamin Barad <benjamin.barad@gmail.com>/<baradb@gene.com>
+"""
+import argparse
+import asyncio
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import scheduling
+
+
+def chunk_script(index, first, last):
+    """Python script for one chunk, which takes a moment and then prints its particle range and when it started and finished."""
+    return "import time\nstart = time.time()\ntime.sleep(0.2)\nprint({0}, {1}, {2}, start, time.time())\n".format(index, first, last)
+
+
+def peak_threads(outputs, threads):
+    """Most threads running at once on an agent, from the start and finish times its chunks printed."""
+    events = []
+    for out in outputs:
+        start, finish = [float(value) for value in out.split()[3:5]]
+        events += [(start, threads), (finish, -threads)]
+    peak, current = 0, 0
+    for _, change in sorted(events):
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+async def check_agents(ports, slots, threads, root, secret, particle_count=2000):
+    """
+    Run a batch of chunks through running agents and check the results.
+
+    Args:
+        ports (list): Ports of the agents on localhost.
+        slots (int): Slots of each agent.
+        threads (int): Threads (and so agent slots) each chunk takes.
+        root (str): Root folder of the agents.
+        secret (str): Secret shared with the agents.
+        particle_count (int): Number of particles to split into chunks.
+    Returns:
+        list: Problems found, empty if the check passed.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    problems = []
+    agents = ["localhost:{0}:{1}".format(port, 2 * slots) for port in ports]
+    scheduler = scheduling.CistemScheduler(concurrency=0, backends=scheduling.parse_worker_agents(agents, secret))
+    live2dlog.info("Running {0} particles through {1} agents with {2} threads per chunk".format(particle_count, len(agents), threads))
+    results, chunks = await scheduler.map_chunks(sys.executable, particle_count, lambda index, first, last, attempt: chunk_script(index, first, last), min_chunk_size=10, threads=threads, retries=0)
+    for index, ((first, last), out) in enumerate(zip(chunks, results)):
+        if not out.split()[:3] == [str(index).encode(), str(first).encode(), str(last).encode()]:
+            problems.append("Chunk {0} came back as {1!r}".format(index, out))
+    for backend, _ in scheduler.backends[1:]:
+        outputs = [out for index, out in enumerate(results) if scheduler.slices["{0}_{1}".format(sys.executable, index)]["backend"] == backend.name]
+        if not outputs:
+            problems.append("Agent {} didn't run any chunks".format(backend.name))
+        elif peak_threads(outputs, min(threads, slots)) > slots:
+            problems.append("Agent {0} ran {1} threads at once with {2} slots".format(backend.name, peak_threads(outputs, min(threads, slots)), slots))
+    inside_root = os.path.join(root, "chunk_0")
+    try:
+        out, returncode = await scheduling.AgentBackend("localhost", ports[0], secret).execute("cat", inside_root, {})
+        if not (returncode == 0 and out.decode('utf-8') == inside_root):
+            problems.append("Agent ran a job with a path inside its root as {0!r}, code {1}".format(out, returncode))
+    except PermissionError as err:
+        problems.append("Agent refused a job with a path inside its root: {}".format(err))
+    for label, backend, input_text in (("wrong secret", scheduling.AgentBackend("localhost", ports[0], secret + "x"), inside_root), ("path outside the root", scheduling.AgentBackend("localhost", ports[0], secret), os.path.dirname(root)), ("relative path outside the root", scheduling.AgentBackend("localhost", ports[0], secret), os.path.join("..", os.path.basename(root) + "_sibling"))):
+        try:
+            await backend.execute("cat", input_text, {})
+            problems.append("Agent ran a job with a {}".format(label))
+        except PermissionError as err:
+            live2dlog.info("Refused a job with a {0}: {1}".format(label, err))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check Live2D worker agents by starting some on localhost and running chunks through them.")
+    parser.add_argument("--agents", default=2, type=int, help="Number of agents to start")
+    parser.add_argument("--slots", default=2, type=int, help="Slots of each agent")
+    parser.add_argument("--threads", default=1, type=int, help="Threads each chunk takes")
+    parser.add_argument("--first-port", default=9301, type=int, help="Port of the first agent, the others take the ports after it")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    secret = secrets.token_hex(16)
+    ports = [args.first_port + index for index in range(args.agents)]
+    with tempfile.TemporaryDirectory() as root:
+        root = os.path.realpath(root)
+        environment = dict(os.environ, LIVE2D_WORKER_SECRET=secret)
+        agents = [subprocess.Popen([sys.executable, "-m", "{}.worker_agent".format(__package__), "--port", str(port), "--slots", str(args.slots), "--programs", sys.executable, "cat", "--root", root], env=environment) for port in ports]
+        try:
+            time.sleep(2)
+            problems = asyncio.get_event_loop().run_until_complete(check_agents(ports, args.slots, args.threads, root, secret))
+        finally:
+            for agent in agents:
+                agent.terminate()
+                agent.wait()
+    for problem in problems:
+        logging.getLogger("live_2d").error(problem)
+    if problems:
+        sys.exit(1)
+    logging.getLogger("live_2d").info("Worker agents check passed")
+
+
+if __name__ == "__main__":
+    main()
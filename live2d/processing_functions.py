@@ -29,13 +29,19 @@ Author: Benjamin Barad <benjamin.barad@gmail.com>/<baradb@gene.com>
 """
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import errno
+import hashlib
 import io
+import json
 import logging
 from math import ceil
+import mmap
 import os
+import re
 import shutil
 import subprocess
+import sys
 import time
 
 import mrcfile
@@ -71,6 +77,96 @@ def isheader(string):
     return False
 
 
+def read_star_header(star_filename):
+    """
+    Read the column names of a star file with one single data loop, and find the byte offset where its data lines begin.
+
+    Args:
+        star_filename (str): Filename of a star file with one single data loop.
+    Returns:
+        list: Column names with the leading _ stripped.
+        int: Byte offset of the first data line, or ``None`` if the file has no data lines yet.
+    """
+    columns = []
+    with open(star_filename, "rb") as f:
+        pos = 0
+        for line in iter(f.readline, b""):
+            if line.startswith(b"_"):
+                columns.append(line.split()[0][1:].decode())
+            elif not isheader(line):
+                return columns, pos
+            pos = f.tell()
+    return columns, None
+
+
+_blank_line = re.compile(rb"^[ \t\r]*\n", re.MULTILINE)
+_count_block_size = 64*1024*1024
+
+
+def _count_data_lines(mm, start, stop):
+    """Count the non-blank newline-terminated lines of a memory mapped file between two byte offsets that both fall on line boundaries."""
+    rows = 0
+    while start < stop:
+        end = mm.rfind(b"\n", start, min(start+_count_block_size, stop)) + 1
+        if end <= start:
+            end = stop
+        block = mm[start:end]
+        rows += block.count(b"\n") - len(_blank_line.findall(block))
+        start = end
+    return rows
+
+
+_star_row_counters = {}
+_counter_tail_bytes = 256
+
+
+def count_star_rows(star_filename, incremental=False):
+    """
+    Count the data rows of a star file by counting newlines in a :py:mod:`mmap`.
+
+    For star files that only ever grow by appending, like warp's, ``incremental`` scans only the bytes appended since the previous call. The inode, byte offset, row count and the last few bytes before the offset are remembered per filename, and the whole file is rescanned if it shrinks, its inode changes or those bytes no longer match, as happens when it is rewritten in place. A trailing row that has not been newline-terminated yet is counted but not remembered, so it is scanned again next time.
+
+    Args:
+        star_filename (str): Filename of a star file with one single data loop.
+        incremental (bool): Remember where counting stopped, for a star file that is only appended to.
+    Returns:
+        int: Number of data rows in the star file.
+    """
+    stat = os.stat(star_filename)
+    counter = _star_row_counters.get(star_filename) if incremental else None
+    if counter is not None and (counter["inode"] != stat.st_ino or counter["offset"] > stat.st_size):
+        counter = None
+    with open(star_filename, "rb") as f:
+        if counter is not None:
+            tail_start = max(counter["offset"] - _counter_tail_bytes, 0)
+            f.seek(tail_start)
+            tail = f.read(counter["offset"] - tail_start)
+            if counter.setdefault("tail", tail) != tail:
+                counter = None
+        if counter is None:
+            _star_row_counters.pop(star_filename, None)
+            _, data_start = read_star_header(star_filename)
+            if data_start is None:
+                return 0
+            counter = {"inode": stat.st_ino, "offset": data_start, "rows": 0}
+        size = os.fstat(f.fileno()).st_size
+        if size > counter["offset"]:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                last_newline = mm.rfind(b"\n", counter["offset"])
+                if last_newline >= 0:
+                    counter["rows"] += _count_data_lines(mm, counter["offset"], last_newline+1)
+                    counter["offset"] = last_newline+1
+                    counter["tail"] = mm[max(counter["offset"] - _counter_tail_bytes, 0):counter["offset"]]
+                unterminated = mm[counter["offset"]:size]
+        else:
+            unterminated = b""
+    if incremental:
+        _star_row_counters[star_filename] = counter
+    if unterminated.strip():
+        return counter["rows"] + 1
+    return counter["rows"]
+
+
 def count_particles_per_class(star_filename):
     """Generate a list with the number of counts for a given class in that index.
     Adapted from https://stackoverflow.com/questions/46759464/fast-way-to-count-occurrences-of-all-values-in-a-pandas-dataframe
@@ -88,9 +184,9 @@ def count_particles_per_class(star_filename):
             pos = f.tell()
             cur_line = f.readline()
         f.seek(pos)
-        df = pandas.read_csv(f, delim_whitespace=True)
+        df = pandas.read_csv(f, sep=r"\s+", header=None)
         class_row = df.iloc[:, -1]
-        cr = class_row.ravel()
+        cr = class_row.to_numpy(copy=True)
         cr[cr < 0] = 0
         class_counter = np.bincount(cr)
         class_counter_list = [int(i) for i in class_counter]
@@ -98,68 +194,266 @@ def count_particles_per_class(star_filename):
     return class_counter_list
 
 
-def load_star_as_dataframe(star_filename, retry_count = 5):
+class _BoundedReader(io.RawIOBase):
+    """Read-only view of the next ``length`` bytes of an open binary file."""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        count = self.f.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+        self.remaining -= count
+        return count
+
+
+def peak_memory_mb():
+    """Peak resident memory of the current process in MB, or ``None`` where :py:mod:`resource` is unavailable (windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def load_star_as_dataframe(star_filename, retry_count=5, columns=None, dtypes=None, offset=None, stop=None, chunk_size=100000):
     """Generate a pandas dataframe from a star file with one single data loop.
-    Written for high efficiency. Star headers have the leading _ stripped and are turned into the pandas header.
+    The data lines are streamed through :py:func:`pandas.read_csv` in chunks of ``chunk_size`` rows, keeping only the requested columns, so memory use is bounded by the size of the result rather than the size of the file. Star headers have the leading _ stripped and are turned into the pandas header.
     Extra comment lines after the header loop_ are currently unsupported and should be removed. before loading.
 
     Args:
         star_filename (str): Filename of the star file from Warp (relion style).
         retry_count (int): How many times to retry in case of stale file errors.
+        columns (list): Column names (without the leading _) to load. All columns are loaded if not given.
+        dtypes (dict): Explicit dtypes for some or all of the loaded columns. Others are inferred.
+        offset (int): Byte offset of the first data row to load. Defaults to the first row in the file.
+        stop (int): Byte offset to stop reading at, which should fall at the end of a line. Defaults to the end of the file.
+        chunk_size (int): Number of rows parsed at a time.
     Return:
         :py:class:`pandas.Dataframe`: Pandas dataframe from the star file.
     """
     live2dlog = logging.getLogger("live_2d")
+    start_time = time.time()
     i = 0
-    data = None
-    # Load into memory all at once to avoid stale file errors. Requires serious memory availability.
-    while (i<retry_count):
+    while True:
         try:
-            with open(star_filename) as f:
-                data=io.StringIO(f.read())
-                break
+            all_columns, data_start = read_star_header(star_filename)
+            start = data_start if offset is None else offset
+            with open(star_filename, "rb") as f:
+                end = os.fstat(f.fileno()).st_size if stop is None else stop
+                if start is None or end <= start:
+                    return pandas.DataFrame(columns=columns if columns else all_columns)
+                f.seek(start)
+                data = io.TextIOWrapper(io.BufferedReader(_BoundedReader(f, end - start), buffer_size=1024*1024), encoding="utf-8")
+                try:
+                    chunks = list(pandas.read_csv(data, sep=r"\s+", header=None, names=all_columns, usecols=columns, dtype=dtypes, chunksize=chunk_size))
+                except pandas.errors.EmptyDataError:
+                    return pandas.DataFrame(columns=columns if columns else all_columns)
+            break
         except OSError as err:
             i = i+1
             live2dlog.warn("Star read failed with error: {}".format(err))
             live2dlog.warn("Attempt Number {} of {}".format(i, retry_count))
+            if i >= retry_count:
+                raise IOError("Failed to read starfile after {} retries".format(retry_count))
             time.sleep(2)
-    if not data:
-        raise IOError("Failed to read starfile after {} retries".format(retry_count))
-    pos = 0
-    columns = []
-    cur_line = data.readline()
-    while not cur_line.startswith("loop_"):
-        cur_line = data.readline()
-    cur_line = data.readline()
-    while cur_line.startswith("_"):
-        pos = data.tell()
-        columns.append(cur_line.split()[0][1:])
-        cur_line = data.readline()
-    data.seek(pos)
-    df = pandas.read_csv(data, delim_whitespace=True, names=columns)
-    data.close()
+    df = pandas.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    if columns:
+        df = df[columns]
+    peak_memory = peak_memory_mb()
+    if peak_memory is not None:
+        live2dlog.info("Loaded {} rows of {} in {:.1f}s (peak memory use {:.0f} MB)".format(len(df), os.path.basename(star_filename), time.time() - start_time, peak_memory))
     return df
 
 
-async def particle_count_difference(warp_stack, previous_number):
+def load_star_rows(star_filename, offset, retry_count=5, columns=None, dtypes=None):
+    """Generate a pandas dataframe from the data rows of a star file starting at a byte offset.
+    Only newline-terminated rows are loaded, so a row that is still being written is left for the next call.
+
+    Args:
+        star_filename (str): Filename of the star file from Warp (relion style).
+        offset (int): Byte offset of the first row to load.
+        retry_count (int): How many times to retry in case of stale file errors.
+        columns (list): Column names (without the leading _) to load. All columns are loaded if not given.
+        dtypes (dict): Explicit dtypes for some or all of the loaded columns.
+    Return:
+        :py:class:`pandas.Dataframe`: Pandas dataframe of the rows after ``offset``.
+        int: Byte offset just past the last row loaded.
+    """
+    with open(star_filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        end = offset
+        if size > offset:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = mm.rfind(b"\n", offset) + 1
+    if end <= offset:
+        return load_star_as_dataframe(star_filename, retry_count=retry_count, columns=columns, dtypes=dtypes, offset=offset, stop=offset), offset
+    df = load_star_as_dataframe(star_filename, retry_count=retry_count, columns=columns, dtypes=dtypes, offset=offset, stop=end)
+    return df, end
+
+
+particle_cache_columns = {
+    "defocus_u": "rlnDefocusU",
+    "defocus_v": "rlnDefocusV",
+    "defocus_angle": "rlnDefocusAngle",
+    "pixel_size": "rlnDetectorPixelSize",
+    "voltage": "rlnVoltage",
+    "cs": "rlnSphericalAberration",
+    "amplitude_contrast": "rlnAmplitudeContrast",
+}
+
+
+def particle_cache_directory(warp_star, working_directory):
+    """Folder in the working directory where the particle cache for a warp star file is kept."""
+    return os.path.join(working_directory, "particle_cache", os.path.splitext(os.path.basename(warp_star))[0])
+
+
+def _write_npy_rows(filename, start_row, values):
+    """Write a 1D array into a ``.npy`` file starting at a given row, truncating anything after it and rewriting the header in place when it fits."""
+    if not os.path.isfile(filename):
+        np.save(filename, values)
+        return
+    with open(filename, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        start_row = min(start_row, shape[0])
+        values = np.asarray(values, dtype=dtype)
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (start_row + len(values),)})
+        if version == (1, 0) and header.tell() == data_offset:
+            f.truncate(data_offset + start_row*dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(values.tobytes())
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+        f.seek(data_offset)
+        old_values = np.frombuffer(f.read(start_row*dtype.itemsize), dtype=dtype)
+    np.save(filename + ".tmp.npy", np.concatenate([old_values, values]))
+    os.replace(filename + ".tmp.npy", filename)
+
+
+def load_particle_cache(warp_star, working_directory):
+    """Load the particle cache for a warp star file, as it was last updated.
+
+    Args:
+        warp_star (str): Filename of the warp ``allparticles_`` star file.
+        working_directory (str): Folder where the cache is kept.
+    Returns:
+        dict: ``rows`` (number of cached particles), ``columns`` (read-only memory mapped arrays keyed like :py:data:`particle_cache_columns`, plus ``stack_index``), ``stack_names`` (list of particle stack filenames that ``stack_index`` refers to) and ``meta`` (the source file state the cache matches). Empty if there is no cache.
+    """
+    cache_directory = particle_cache_directory(warp_star, working_directory)
+    try:
+        with open(os.path.join(cache_directory, "meta.json")) as f:
+            meta = json.load(f)
+        with open(os.path.join(cache_directory, "stack_names.json")) as f:
+            stack_names = json.load(f)
+        columns = {}
+        for name in list(particle_cache_columns) + ["stack_index"]:
+            array = np.load(os.path.join(cache_directory, "{}.npy".format(name)), mmap_mode="r" if meta["rows"] else None)
+            columns[name] = array[:meta["rows"]]
+    except (OSError, ValueError, KeyError):
+        return {}
+    if not meta.get("source") == warp_star:
+        return {}
+    return {"rows": meta["rows"], "columns": columns, "stack_names": stack_names, "meta": meta}
+
+
+def update_particle_cache(warp_star, working_directory):
+    """Bring the columnar particle cache for a warp star file up to date and return it.
+
+    The cache keeps one memory mappable ``.npy`` array per column that live2d needs from the warp star file (see :py:data:`particle_cache_columns`), plus the particle stack filenames as an index into ``stack_names.json``. ``meta.json`` records the size, mtime and inode of the source file along with the byte offset and number of rows cached. If the source file is unchanged nothing is read; if rows have been appended only they are parsed and appended to the arrays; if the file was replaced or rewritten the cache is rebuilt.
+
+    Args:
+        warp_star (str): Filename of the warp ``allparticles_`` star file.
+        working_directory (str): Folder where the cache is kept.
+    Returns:
+        dict: The updated cache, as returned by :py:func:`load_particle_cache`.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    cache_directory = particle_cache_directory(warp_star, working_directory)
+    stat = os.stat(warp_star)
+    cache = load_particle_cache(warp_star, working_directory)
+    meta = cache.get("meta", {})
+    if meta.get("inode") == stat.st_ino and meta.get("size") == stat.st_size and meta.get("mtime") == stat.st_mtime:
+        return cache
+    columns, data_start = read_star_header(warp_star)
+    valid = bool(cache) and meta.get("inode") == stat.st_ino and meta.get("columns") == columns and meta.get("offset", 0) <= stat.st_size
+    if valid and meta["tail"]:
+        with open(warp_star, "rb") as f:
+            f.seek(meta["offset"] - len(meta["tail"].encode("latin-1")))
+            valid = f.read(len(meta["tail"].encode("latin-1"))) == meta["tail"].encode("latin-1")
+    if valid:
+        rows, offset, stack_names = meta["rows"], meta["offset"], cache["stack_names"]
+    else:
+        live2dlog.info(f"Building the particle cache for {os.path.basename(warp_star)} from scratch.")
+        os.makedirs(cache_directory, exist_ok=True)
+        rows, offset, stack_names = 0, data_start, []
+    if offset is None:
+        return {}
+    new_particles, new_offset = load_star_rows(warp_star, offset, columns=list(particle_cache_columns.values()) + ["rlnImageName"], dtypes=dict({column: np.float64 for column in particle_cache_columns.values()}, rlnImageName=str))
+    for name, column in particle_cache_columns.items():
+        _write_npy_rows(os.path.join(cache_directory, "{}.npy".format(name)), rows, new_particles[column].to_numpy(dtype=np.float64))
+    stack_codes, new_stack_names = pandas.factorize(new_particles["rlnImageName"].str.rsplit("@").str.get(-1))
+    stack_name_indices = {name: index for index, name in enumerate(stack_names)}
+    stack_name_map = np.array([stack_name_indices.setdefault(name, len(stack_name_indices)) for name in new_stack_names], dtype=np.int32)
+    stack_names = stack_names + list(new_stack_names[stack_name_map >= len(stack_names)])
+    _write_npy_rows(os.path.join(cache_directory, "stack_index.npy"), rows, stack_name_map[stack_codes])
+    with open(os.path.join(cache_directory, "stack_names.json"), "w") as f:
+        json.dump(stack_names, f)
+    tail = b""
+    if new_offset > 0:
+        with open(warp_star, "rb") as f:
+            f.seek(max(new_offset - _counter_tail_bytes, 0))
+            tail = f.read(new_offset - f.tell())
+    meta = {"source": warp_star, "size": stat.st_size, "mtime": stat.st_mtime, "inode": stat.st_ino, "columns": columns, "rows": rows + len(new_particles), "offset": new_offset, "tail": tail.decode("latin-1")}
+    with open(os.path.join(cache_directory, "meta.json.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(cache_directory, "meta.json.tmp"), os.path.join(cache_directory, "meta.json"))
+    return load_particle_cache(warp_star, working_directory)
+
+
+def count_warp_particles(warp_stack, working_directory=None):
+    """Count the particles in a warp star file with :py:func:`count_star_rows`, scanning only the lines appended since the last count.
+
+    Args:
+        warp_stack (str): Filename of the current exported warp particles star file.
+        working_directory (str): Folder with the particle cache for ``warp_stack``. If given, the first count after a restart picks up where the cache left off, provided the cached end of the file still matches.
+    Returns:
+        int: Number of particles in the star file.
+    """
+    if working_directory and warp_stack not in _star_row_counters:
+        meta = load_particle_cache(warp_stack, working_directory).get("meta", {})
+        if "tail" in meta and meta.get("inode") == os.stat(warp_stack).st_ino:
+            _star_row_counters[warp_stack] = {"inode": meta["inode"], "offset": meta["offset"], "rows": meta["rows"], "tail": meta["tail"].encode("latin-1")}
+    return count_star_rows(warp_stack, incremental=True)
+
+
+async def particle_count_difference(warp_stack, previous_number, working_directory=None):
     """Quickly determine the difference in number of particles
-    Efficiently counts the number of non-header lines in a star file and subtracts the previous number counted. Used primarily as a tool for automated job triggering when sufficient new particles have been picked by warp.
+    Counts the number of non-header lines in a star file with :py:func:`count_warp_particles`, off the event loop, and subtracts the previous number counted. Only lines appended since the last check are scanned, so this stays cheap as the session grows. Used primarily as a tool for automated job triggering when sufficient new particles have been picked by warp.
 
     Args:
         warp_stack (str): Filename of the current exported warp particles star file.
         previous_number (int): Number of particles in the latest classification run.
+        working_directory (str): Folder with the particle cache for ``warp_stack``. If given, the first count after a restart picks up where the cache left off instead of scanning the whole file.
     Return:
         int: Number of particles that have not been previously classified.
     """
-    with open(warp_stack, "r") as f:
-        i = 0
-        j = 0
-        for i, l in enumerate(f):
-            if isheader(l):
-                j += 1
-            pass
-        total_particle_count = i+1-j
-        difference = total_particle_count - previous_number
+    total_particle_count = await asyncio.get_event_loop().run_in_executor(None, count_warp_particles, warp_stack, working_directory)
+    difference = total_particle_count - previous_number
 
     return difference
 
@@ -187,16 +481,403 @@ def make_photos(basename, working_directory):
     return photo_dir
 
 
-def import_new_particles(stack_label, warp_folder, warp_star_filename, working_directory, new_net=False):
+cistem_star_columns = [
+    "_cisTEMPositionInStack",
+    "_cisTEMAnglePsi",
+    "_cisTEMXShift",
+    "_cisTEMYShift",
+    "_cisTEMDefocus1",
+    "_cisTEMDefocus2",
+    "_cisTEMDefocusAngle",
+    "_cisTEMPhaseShift",
+    "_cisTEMOccupancy",
+    "_cisTEMLogP",
+    "_cisTEMSigma",
+    "_cisTEMScore",
+    "_cisTEMScoreChange",
+    "_cisTEMPixelSize",
+    "_cisTEMMicroscopeVoltagekV",
+    "_cisTEMMicroscopeCsMM",
+    "_cisTEMAmplitudeContrast",
+    "_cisTEMBeamTiltX",
+    "_cisTEMBeamTiltY",
+    "_cisTEMImageShiftX",
+    "_cisTEMImageShiftY",
+    "_cisTEMBest2DClass",
+]
+
+
+def format_cistem_star_rows(particles):
+    """Format warp particles as unclassified cisTEM star file data lines.
+    Warp's CTF and optics values are the same for every particle from a micrograph, so each distinct combination is formatted once and shared by its particles, and only the position in the stack is formatted per particle.
+
+    Args:
+        particles (:py:class:`pandas.Dataframe`): Warp particle rows, indexed by position in the combined stack (from 0).
+    Returns:
+        :py:class:`numpy.ndarray`: One data line (without newline) per particle.
+    """
+    ctf_columns = ["rlnDefocusU", "rlnDefocusV", "rlnDefocusAngle", "rlnDetectorPixelSize", "rlnVoltage", "rlnSphericalAberration", "rlnAmplitudeContrast"]
+    group_numbers = particles.groupby(ctf_columns, sort=False).ngroup().to_numpy()
+    suffixes = np.array(["\t".join([
+        "",
+        "0.00",
+        "-0.00",
+        "-0.00",
+        str(row.rlnDefocusU),
+        str(row.rlnDefocusV),
+        str(row.rlnDefocusAngle),
+        "0.0",
+        "100.0",
+        "-500",
+        "1.0",
+        "20.0",
+        "0.0",
+        "{:.4f}".format(row.rlnDetectorPixelSize),
+        str(row.rlnVoltage),
+        str(row.rlnSphericalAberration),
+        str(row.rlnAmplitudeContrast),
+        "0.0",
+        "0.0",
+        "0.0",
+        "0.0",
+        "0",
+    ]) for row in particles.drop_duplicates(ctf_columns).itertuples(index=False)], dtype=object)
+    positions = (particles.index.to_numpy() + 1).astype(str).astype(object)
+    return positions + suffixes[group_numbers]
+
+
+def star_offset_index_filename(star_filename):
+    """Filename of the saved row-offset index for a star file."""
+    return os.path.splitext(star_filename)[0] + "_offsets.npy"
+
+
+def build_star_offset_index(star_filename):
+    """
+    Scan a star file for the byte offset of each of its data rows and save them as its row-offset index.
+
+    Args:
+        star_filename (str): Filename of a star file with one single data loop and no blank lines between data rows.
+    Returns:
+        :py:class:`numpy.ndarray`: Byte offset of the start of each data row, followed by the offset just past the last one.
+    """
+    data_start, data_end = star_data_range(star_filename)
+    offsets = [np.array([data_start], dtype=np.uint64)]
+    with open(star_filename, "rb") as f:
+        if data_end > data_start:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for block_start in range(data_start, data_end, _count_block_size):
+                    block = np.frombuffer(mm[block_start:min(block_start+_count_block_size, data_end+1)], dtype=np.uint8)
+                    offsets.append((np.flatnonzero(block == ord("\n")) + block_start + 1).astype(np.uint64))
+    offsets = np.concatenate(offsets)
+    if data_end > data_start and offsets[-1] <= data_end:
+        # The last row has no newline yet.
+        offsets = np.append(offsets, np.uint64(data_end))
+    np.save(star_offset_index_filename(star_filename), offsets)
+    return offsets
+
+
+def load_star_offset_index(star_filename):
+    """
+    Load the saved row-offset index for a star file, rebuilding it with :py:func:`build_star_offset_index` if it is missing or doesn't match the file.
+
+    Args:
+        star_filename (str): Filename of a star file with one single data loop.
+    Returns:
+        :py:class:`numpy.ndarray`: Byte offset of the start of each data row, followed by the offset just past the last one.
+    """
+    try:
+        offsets = np.load(star_offset_index_filename(star_filename), mmap_mode="r")
+        if len(offsets) and int(offsets[-1]) == os.path.getsize(star_filename):
+            return offsets
+    except (OSError, ValueError):
+        pass
+    logging.getLogger("live_2d").info(f"Rebuilding the row offset index for {os.path.basename(star_filename)}")
+    return build_star_offset_index(star_filename)
+
+
+def write_combined_star(star_filename, particles, append=True, chunk_size=100000):
+    """Write warp particles out to the cisTEM formatted star file that accompanies the combined stack, keeping its row-offset index (see :py:func:`load_star_offset_index`) up to date.
+    Appending only writes the rows for the particles given. A full rewrite goes to a new file that replaces the old one, so anything tracking the old file by inode (like :py:func:`count_star_rows`) notices the change.
+
+    Args:
+        star_filename (str): Filename of the combined star file.
+        particles (:py:class:`pandas.Dataframe`): Warp particle rows, indexed by position in the combined stack (from 0).
+        append (bool): Append to the existing star file instead of writing a new one with a header.
+        chunk_size (int): Number of rows formatted at a time, to bound memory use.
+    """
+    output_filename = star_filename if append else star_filename + ".tmp"
+    index_filename = star_offset_index_filename(star_filename)
+    if append:
+        offsets = load_star_offset_index(star_filename)
+        index_length = len(offsets)
+        del offsets
+    with open(output_filename, "ab" if append else "wb") as file:
+        if not append:
+            file.write(b" \ndata_\n \nloop_\n")
+            file.write("\n".join(["{} #{}".format(value, index+1) for index, value in enumerate(cistem_star_columns)]).encode())
+            file.write(b"\n")
+            np.save(index_filename + ".tmp.npy", np.array([file.tell()], dtype=np.uint64))
+            index_filename = index_filename + ".tmp.npy"
+            index_length = 1
+        position = file.tell()
+        for start in range(0, len(particles), chunk_size):
+            rows = format_cistem_star_rows(particles.iloc[start:start+chunk_size])
+            file.write("\n".join(rows.tolist()).encode())
+            file.write(b"\n")
+            row_ends = position + np.cumsum(np.fromiter((len(row) + 1 for row in rows), dtype=np.uint64, count=len(rows)))
+            _write_npy_rows(index_filename, index_length, row_ends)
+            index_length += len(rows)
+            position = int(row_ends[-1])
+    if not append:
+        os.replace(output_filename, star_filename)
+        os.replace(index_filename, star_offset_index_filename(star_filename))
+
+
+def read_particle_stack_header(source_filename):
+    """Read the dimensions and data layout of a particle stack from its mrc header, without mapping its data.
+
+    Args:
+        source_filename (str): Particle ``.mrcs`` stack.
+    Returns:
+        tuple: x, y and z size, :py:class:`numpy.dtype` of the data, and byte offset of the data in the file.
+    """
+    # Only the header is read, so mrcfile doesn't warn that a preallocated combined stack is larger than expected.
+    with mrcfile.open(source_filename, header_only=True, permissive=True) as mrcs:
+        return int(mrcs.header.nx), int(mrcs.header.ny), int(mrcs.header.nz), mrcfile.utils.data_dtype_from_header(mrcs.header), mrcs.header.nbytes + int(mrcs.header.nsymbt)
+
+
+def particle_stack_ready(source_filename, wanted_z):
+    """Check without waiting whether warp has finished writing a particle stack.
+
+    Args:
+        source_filename (str): Warp ``.mrcs`` particle stack.
+        wanted_z (int): Number of particles the warp star file lists for this stack.
+    Returns:
+        bool: True if the header matches the star file and all of the data is on disk.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    filename = os.path.basename(source_filename)
+    try:
+        x, y, z, dtype, data_offset = read_particle_stack_header(source_filename)
+    except (OSError, ValueError) as err:
+        live2dlog.warn(f"File {filename} can't be read yet ({err}).")
+        return False
+    if not z == wanted_z:
+        live2dlog.warn(f"File {filename} has a header that doesn't match the number of particles in the star file: {z}, {wanted_z}")
+        return False
+    if os.path.getsize(source_filename) < data_offset + x*y*z*dtype.itemsize:
+        live2dlog.warn(f"File {filename} seems to not be done writing from Warp.")
+        return False
+    return True
+
+
+def set_stack_particle_count(filename, particle_count):
+    """Set the number of sections (``nz`` and ``mz``) in an mrc stack header in place, whatever the size of the file."""
+    with mrcfile.open(filename, header_only=True, permissive=True) as mrcs:
+        count = np.array(particle_count, dtype=mrcs.header.nz.dtype).tobytes()
+    with open(filename, "r+b") as f:
+        for header_offset in (8, 36):
+            f.seek(header_offset)
+            f.write(count)
+
+
+def reserve_stack_capacity(fd, required_size, chunk_size):
+    """
+    Make sure a growing stack file has at least a given size, reserving disk space in whole chunks with :py:func:`os.posix_fallocate` so the file is laid out in a few large extents instead of one per import.
+
+    Args:
+        fd (int): File descriptor of the stack, open for writing.
+        required_size (int): Size in bytes the file needs to be.
+        chunk_size (int): Size of the chunks to grow the file by. If 0, or if the filesystem can't preallocate, the file is left to grow as it is written.
+    Returns:
+        int: Size of the file.
+    """
+    current_size = os.fstat(fd).st_size
+    if current_size >= required_size or not chunk_size or not hasattr(os, "posix_fallocate"):
+        return current_size
+    new_size = current_size + -(-(required_size - current_size) // chunk_size) * chunk_size
+    try:
+        os.posix_fallocate(fd, current_size, new_size - current_size)
+    except OSError as err:
+        if err.errno not in (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS):
+            raise
+        return current_size
+    logging.getLogger("live_2d").info("Reserved {:.1f} GB more disk space for the combined stack.".format((new_size - current_size)/1024**3))
+    return new_size
+
+
+def trim_combined_stack(stack_label, working_directory):
+    """
+    Cut the preallocated space past the committed particles off the end of a combined stack, when a job stops and when the server starts.
+    While an import is running, or after it crashed, the stack is longer than its header says. If the import manifest has committed more particles than the header counts, because an import stopped before fixing the header, the header is fixed to the manifest first so the committed particles are kept.
+
+    Args:
+        stack_label (str): Name of combined stack file (without a suffix)
+        working_directory (str): Folder with the combined stack.
+    Returns:
+        int: Number of bytes freed.
+    """
+    combined_filename = os.path.join(working_directory, "{}.mrcs".format(stack_label))
+    if not os.path.isfile(combined_filename):
+        return 0
+    x, y, z, dtype, data_offset = read_particle_stack_header(combined_filename)
+    manifest = load_import_manifest(stack_label, working_directory)
+    if manifest is not None and manifest["particles"] > z and os.path.getsize(combined_filename) >= data_offset + x*y*manifest["particles"]*dtype.itemsize:
+        logging.getLogger("live_2d").info("Counting the {} particles committed to {}.mrcs by an interrupted import in its header".format(manifest["particles"], stack_label))
+        set_stack_particle_count(combined_filename, manifest["particles"])
+        z = manifest["particles"]
+    committed_size = data_offset + x*y*z*dtype.itemsize
+    freed = os.path.getsize(combined_filename) - committed_size
+    if freed > 0:
+        os.truncate(combined_filename, committed_size)
+        logging.getLogger("live_2d").info("Trimmed {:.1f} GB of reserved space off the end of {}.mrcs".format(freed/1024**3, stack_label))
+    return max(freed, 0)
+
+
+def copy_particle_stack(source_filename, destination, destination_offset, dtype, frame_shape):
+    """Copy all the particles of a finished warp particle stack to a byte offset in the combined stack.
+
+    Args:
+        source_filename (str): Warp ``.mrcs`` particle stack.
+        destination (int): File descriptor of the combined stack, open for writing.
+        destination_offset (int): Byte offset in the combined stack for the first particle.
+        dtype (:py:class:`numpy.dtype`): Data type of the combined stack.
+        frame_shape (tuple): (y, x) size of each particle.
+    Returns:
+        int: Number of bytes copied.
+    """
+    x, y, z, source_dtype, data_offset = read_particle_stack_header(source_filename)
+    if not (y, x) == tuple(frame_shape):
+        raise IOError(errno.EIO, f"File {os.path.basename(source_filename)} has particles of size {x}x{y}, which doesn't match the combined stack.")
+    count = x*y*z*dtype.itemsize
+    with open(source_filename, "rb") as f:
+        if source_dtype == dtype:
+            copy_bytes(f, destination, data_offset, count, destination_offset=destination_offset)
+        else:
+            f.seek(data_offset)
+            data = np.fromfile(f, dtype=source_dtype, count=x*y*z).astype(dtype)
+            os.pwrite(destination, data.tobytes(), destination_offset)
+    return count
+
+
+def import_manifest_filename(stack_label, working_directory):
+    """Filename of the import manifest for a combined stack (see :py:func:`import_new_particles`)."""
+    return os.path.join(working_directory, "{}_import.json".format(stack_label))
+
+
+def load_import_manifest(stack_label, working_directory):
+    """Load the import manifest for a combined stack.
+
+    Args:
+        stack_label (str): Name of combined stack file (without a suffix)
+        working_directory (str): Folder with the combined stack.
+    Returns:
+        dict: The manifest, or None if there isn't a readable one.
+    """
+    try:
+        with open(import_manifest_filename(stack_label, working_directory)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_import_manifest(stack_label, working_directory, manifest):
+    """Atomically replace the import manifest for a combined stack."""
+    manifest_filename = import_manifest_filename(stack_label, working_directory)
+    with open(manifest_filename + ".tmp", "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+
+
+def pop_import_rollback(stack_label, working_directory):
+    """Collect and clear the rollback recorded in the import manifest for a combined stack by :py:func:`import_new_particles`.
+
+    Args:
+        stack_label (str): Name of combined stack file (without a suffix)
+        working_directory (str): Folder with the combined stack.
+    Returns:
+        int: First particle position that was cut back or regenerated since the last call, or None if particles have only been appended.
+    """
+    manifest = load_import_manifest(stack_label, working_directory)
+    if manifest is None or "rolled_back" not in manifest:
+        return None
+    rolled_back = manifest.pop("rolled_back")
+    write_import_manifest(stack_label, working_directory, manifest)
+    return rolled_back
+
+
+def source_file_state(filename):
+    """Size and mtime of a file, to notice when it is rewritten, or None if it is missing."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def truncate_star_rows(star_filename, row_count):
+    """
+    Cut a star file and its row-offset index back to at most a given number of complete data rows, dropping any partly written last row.
+
+    Args:
+        star_filename (str): Filename of a star file with one single data loop.
+        row_count (int): Number of data rows to keep.
+    Returns:
+        int: Number of data rows left in the star file.
+    """
+    offsets = load_star_offset_index(star_filename)
+    complete_rows = len(offsets) - 1
+    if complete_rows:
+        with open(star_filename, "rb") as f:
+            f.seek(int(offsets[-1]) - 1)
+            if not f.read(1) == b"\n":
+                complete_rows -= 1
+    kept_rows = min(row_count, complete_rows)
+    if kept_rows < len(offsets) - 1:
+        end = int(offsets[kept_rows])
+        del offsets
+        os.truncate(star_filename, end)
+        _write_npy_rows(star_offset_index_filename(star_filename), kept_rows + 1, np.array([], dtype=np.uint64))
+    return kept_rows
+
+
+def particle_stack_runs(stack_index, start, stop):
+    """Split a range of warp star rows into runs of consecutive rows from the same particle stack.
+
+    Args:
+        stack_index (:py:class:`numpy.ndarray`): Particle stack of each warp star row, from the particle cache.
+        start (int): First row.
+        stop (int): Row after the last row.
+    Returns:
+        list: [first row, number of rows] for each run.
+    """
+    if stop <= start:
+        return []
+    boundaries = np.flatnonzero(np.diff(np.asarray(stack_index[start:stop]))) + 1
+    starts = np.concatenate([[0], boundaries]) + start
+    ends = np.concatenate([boundaries, [stop - start]]) + start
+    return [[int(run_start), int(run_end - run_start)] for run_start, run_end in zip(starts, ends)]
+
+
+def import_new_particles(stack_label, warp_folder, warp_star_filename, working_directory, new_net=False, thread_count=8, checkpoint_seconds=5, preallocation_bytes=4*1024**3):
     """Iteratively combine new particle stacks generated by warp into a single monolithic stackfile that is appropriate for use with cisTEM2. Simultaneously generate a cisTEM formatted star file.
 
-    Uses a memory mapped mrc file. This does not allow easy appending, so the function directly accesses the memory map once it is created as a numpy mmap, then reloads as an mrcfile mmap to fix the header.
+    The combined stack offset of every new warp stack is computed up front from the star file counts, and the stacks are then copied into place by a pool of threads with positional writes (see :py:func:`copy_particle_stack`), before the header is fixed with :py:mod:`mrcfile`.
+    Stacks that warp hasn't finished writing (see :py:func:`particle_stack_ready`) don't hold up the import: they are deferred and picked up by a later import once they are complete, so the combined stack is not always in the same order as the warp star file.
+
+    The combined stack file is grown in large preallocated chunks, so it is usually longer than the particles in it; the header only ever counts committed particles, and :py:func:`trim_combined_stack` cuts off the spare space at the end of a session.
+    Progress is recorded in the import manifest, ``{stack_label}_import.json``, which lists every imported stack with its size, mtime, warp star rows, combined stack particle range and byte range, along with the deferred stacks. It is checkpointed while stacks are copied, once the data it covers has been synced to disk, so an interrupted import resumes after the last committed stack instead of trusting the combined stack's header. Stacks that warp has rewritten since they were imported are noticed from their size and mtime, and the combined stack is cut back to before the first of them so they are imported again. The first particle position that was cut back or regenerated is kept in the manifest as ``rolled_back``, since particles from there on may have moved, until :py:func:`pop_import_rollback` collects it.
     Args:
         stack_label (str): Name of combined stack file (without a suffix)
         warp_folder (str): Base folder where Warp outputs.
         warp_star_filename (str): Filename for exported particles starfile. Generally, use the ``allparticles_`` starfile.
         working_directory (str): Folder where combined stacks and star files will be written.
         new_net (bool): Flag for changes to warp that require recombination of all stacks instead of only new ones.
+        thread_count (int): Number of warp stacks to check and copy at once.
+        checkpoint_seconds (float): Minimum time between manifest checkpoints while copying.
+        preallocation_bytes (int): Size of the chunks of disk space reserved for the combined stack as it grows (see :py:func:`reserve_stack_capacity`). 0 to grow it only as far as each import needs.
     Returns:
         int: Total number of particles in the combined stack.
     """
@@ -207,142 +888,626 @@ def import_new_particles(stack_label, warp_folder, warp_star_filename, working_d
     start_time = time.time()
     # starting_directory = os.getcwd()
     combined_filename = os.path.join(working_directory, "{}.mrcs".format(stack_label))
+    star_filename = os.path.join(working_directory, "{}.star".format(stack_label))
+    warp_star = os.path.join(warp_folder, warp_star_filename)
     previous_file = os.path.isfile(combined_filename)
     if new_net:
         # Hack to overwrite the old file if you switch to a new neural net.
         live2dlog.info("Due to config changes, forcing complete reimport of particles.")
         previous_file = False
+    # Any other reimport moves particles that may already have been classified.
+    existing_stack = previous_file
     # os.chdir(warp_folder)
-    total_particles = load_star_as_dataframe(os.path.join(warp_folder, warp_star_filename))
-    stacks_filenames = total_particles["rlnImageName"].str.rsplit("@").str.get(-1)
+    cache = update_particle_cache(warp_star, working_directory)
+    if not cache.get("rows"):
+        raise IOError(errno.ENODATA, f"No particles have been exported by warp to {warp_star} yet.")
+    warp_particle_count = cache["rows"]
+    stack_index = cache["columns"]["stack_index"]
+
+    # RESUME FROM THE LAST COMMITTED STACK IN THE MANIFEST
+    manifest = None
+    if previous_file:
+        manifest = load_import_manifest(stack_label, working_directory)
+        if manifest is None and os.path.isfile(star_filename):
+            x, y, combined_count, data_dtype, data_offset = read_particle_stack_header(combined_filename)
+            frame_bytes = x * y * data_dtype.itemsize
+            if count_star_rows(star_filename) == combined_count:
+                # Combined stacks from before the manifest are in warp star order.
+                live2dlog.info(f"Building an import manifest for the existing {stack_label}.mrcs")
+                manifest = {"warp_inode": cache["meta"]["inode"], "warp_rows": combined_count, "particles": 0, "files": [], "deferred": []}
+                for run_start, run_count in particle_stack_runs(stack_index, 0, min(combined_count, warp_particle_count)):
+                    filename = cache["stack_names"][stack_index[run_start]]
+                    manifest["files"].append({"filename": filename, "state": source_file_state(os.path.join(warp_folder, filename)), "warp_rows": [run_start, run_count], "particles": [manifest["particles"], run_count], "bytes": [int(data_offset + manifest["particles"]*frame_bytes), int(run_count*frame_bytes)]})
+                    manifest["particles"] += run_count
+        if manifest is None:
+            live2dlog.warn(f"There is no import manifest matching {stack_label}.mrcs, so it will be regenerated from the full warp star file.")
+            previous_file = False
+        elif manifest["warp_rows"] > warp_particle_count or not manifest.get("warp_inode") == cache["meta"]["inode"]:
+            live2dlog.warn(f"The warp star file has been rewritten, so {stack_label} will be regenerated from the full warp star file.")
+            previous_file = False
+    if previous_file:
+        with ThreadPoolExecutor(max_workers=thread_count) as check_pool:
+            file_states = list(check_pool.map(source_file_state, [os.path.join(warp_folder, entry["filename"]) for entry in manifest["files"]]))
+        for index, (entry, file_state) in enumerate(zip(manifest["files"], file_states)):
+            if not file_state == entry["state"]:
+                live2dlog.warn("File {} has been rewritten by warp since it was imported, so it and the {} stacks imported after it will be imported again.".format(entry["filename"], len(manifest["files"]) - index - 1))
+                manifest["deferred"] = sorted(manifest["deferred"] + [entry["warp_rows"] for entry in manifest["files"][index:]])
+                manifest["particles"] = entry["particles"][0]
+                manifest["rolled_back"] = min(manifest.get("rolled_back", manifest["particles"]), manifest["particles"])
+                if os.path.isfile(star_filename):
+                    # The star rows of the rolled back stacks go too, so the reimported rows are appended in stack order.
+                    truncate_star_rows(star_filename, manifest["particles"])
+                manifest["files"] = manifest["files"][:index]
+                break
+        if not manifest["files"]:
+            previous_file = False
+    if previous_file:
+        x, y, combined_count, data_dtype, data_offset = read_particle_stack_header(combined_filename)
+        committed_size = data_offset + manifest["particles"] * x * y * data_dtype.itemsize
+        if os.path.getsize(combined_filename) < committed_size:
+            live2dlog.warn(f"{stack_label}.mrcs is shorter than its import manifest, so it will be regenerated from the full warp star file.")
+            previous_file = False
+        elif not combined_count == manifest["particles"]:
+            # Anything copied after the last committed stack is left in the preallocated space to be overwritten.
+            live2dlog.info("Resuming {}.mrcs from the {} particles committed in its import manifest.".format(stack_label, manifest["particles"]))
+            set_stack_particle_count(combined_filename, manifest["particles"])
+    if not previous_file:
+        if os.path.isfile(import_manifest_filename(stack_label, working_directory)):
+            os.remove(import_manifest_filename(stack_label, working_directory))
+        manifest = {"warp_inode": cache["meta"]["inode"], "warp_rows": 0, "particles": 0, "files": [], "deferred": []}
+        if existing_stack:
+            manifest["rolled_back"] = 0
+
+    # CHECK WHICH STACKS WARP HAS FINISHED WRITING
+    runs = []
+    for run in manifest["deferred"] + particle_stack_runs(stack_index, manifest["warp_rows"], warp_particle_count):
+        if runs and runs[-1][0] + runs[-1][1] == run[0] and stack_index[runs[-1][0]] == stack_index[run[0]]:
+            runs[-1][1] += run[1]
+        else:
+            runs.append(list(run))
+    run_filenames = [cache["stack_names"][stack_index[run_start]] for run_start, _ in runs]
+    with ThreadPoolExecutor(max_workers=thread_count) as check_pool:
+        ready = list(check_pool.map(particle_stack_ready, [os.path.join(warp_folder, filename) for filename in run_filenames], [run_count for _, run_count in runs]))
+    ready_runs = [run for run, run_ready in zip(runs, ready) if run_ready]
+    ready_filenames = [filename for filename, run_ready in zip(run_filenames, ready) if run_ready]
+    deferred = [run for run, run_ready in zip(runs, ready) if not run_ready]
+    if deferred:
+        live2dlog.info("Deferring {} particles from {} stacks that warp is still writing.".format(sum(run_count for _, run_count in deferred), len(deferred)))
+    if not previous_file and not ready_runs:
+        raise IOError(errno.EAGAIN, f"None of the particle stacks exported by warp to {warp_star} are finished yet.")
+    manifest["warp_rows"] = warp_particle_count
+    manifest["deferred"] = sorted(deferred + ready_runs)
 
     # MAKE PRELIMINARY STACK IF ITS NOT THERE
     if not previous_file:
         live2dlog.info("No previous particle stack is being appended.")
         live2dlog.info("Copying first mrcs file to generate seed for combined stack")
-        shutil.copy(os.path.join(warp_folder, stacks_filenames[0]), combined_filename)
+        shutil.copy(os.path.join(warp_folder, ready_filenames[0]), combined_filename)
 
     # GET INFO ABOUT STACKS
-    with mrcfile.mmap(combined_filename, "r", permissive=True) as mrcs:
-        prev_par = int(mrcs.header.nz)
-        live2dlog.info("Previous Particles: {}".format(prev_par))
-        new_particles_count = len(total_particles) - prev_par
-        live2dlog.info("Total Particles to Import: {}".format(new_particles_count))
-        # print(prev_par * mrcs.header.nx * mrcs.header.ny * mrcs.data.dtype.itemsize+ mrcs.header.nbytes + mrcs.extended_header.nbytes)
-        # print(mrcs.data.base.size())
-        offset = prev_par * mrcs.header.nx * mrcs.header.ny * mrcs.data.dtype.itemsize + mrcs.header.nbytes + mrcs.extended_header.nbytes
-        # live2dlog.info("Bytes Offset: {}".format(offset))
-        data_dtype = mrcs.data.dtype
-        # live2dlog.info("dtype: {}".format(data_dtype))
-        # live2dlog.info("dtype size: {}".format(data_dtype.itemsize))
-        shape = (new_particles_count, mrcs.header.ny, mrcs.header.nx)
-
-    # OPEN THE MEMMAP AND ITERATIVELY ADD NEW PARTICLES
-    mrcfile_raw = np.memmap(combined_filename, dtype=data_dtype, offset=offset, shape=shape, mode="r+")
-    new_offset = 0
-    new_filenames = stacks_filenames[prev_par:].unique()
-    filename_counts = stacks_filenames[prev_par:].value_counts()
-    for index, filename in enumerate(new_filenames):
-        try_number = 0
-        wanted_z = filename_counts[filename]
-        while(True):
-            with mrcfile.mmap(os.path.join(warp_folder, filename), "r+", permissive=True) as partial_mrcs:
-                x = partial_mrcs.header.nx
-                y = partial_mrcs.header.ny
-                z = partial_mrcs.header.nz
-                if not z == wanted_z:
-                    if try_number >= 12:
-                        raise IOError(errno.EIO, f"The data header didn't match the starfile: {z}, {wanted_z}")
-                    live2dlog.warn(f"File {filename} has a header that doesn't match the number of particles in the star file.")
-                    try_number += 1
-                    time.sleep(10)
-                    continue
-
-                if not x*y*wanted_z == partial_mrcs.data.size:
-                    if try_number >= 12:
-                        raise IOError(errno.ETIME, "Took too long for Warp to correct the file. Killing job.")
-                    live2dlog.warn(f"File {filename} seems to not be done writing from Warp. Waiting 10 seconds and trying again.")
-                    try_number += 1
-                    time.sleep(10)
-                    continue
-
-                mrcfile_raw[new_offset:new_offset+z, :, :] = partial_mrcs.data
-                live2dlog.info("Filename {} ({} of {}) contributing {} particles starting at {}".format(filename, index+1, len(new_filenames), z, new_offset))
-                # print("Filename {} ({} of {}) contributing {} particles starting at {}".format(filename, index+1, len(new_filenames), z, new_offset))
-                new_offset = new_offset+z
-                break
+    x, y, _, data_dtype, data_offset = read_particle_stack_header(combined_filename)
+    # live2dlog.info("dtype: {}".format(data_dtype))
+    # live2dlog.info("dtype size: {}".format(data_dtype.itemsize))
+    frame_shape = (y, x)
+    frame_bytes = frame_shape[0] * frame_shape[1] * data_dtype.itemsize
+    prev_par = manifest["particles"]
+    live2dlog.info("Previous Particles: {}".format(prev_par))
+    new_particles_count = sum(run_count for _, run_count in ready_runs)
+    live2dlog.info("Total Particles to Import: {}".format(new_particles_count))
+
+    def commit_stack(filename, run):
+        entry = {"filename": filename, "state": source_file_state(os.path.join(warp_folder, filename)), "warp_rows": run, "particles": [manifest["particles"], run[1]], "bytes": [int(data_offset + manifest["particles"]*frame_bytes), int(run[1]*frame_bytes)]}
+        manifest["files"].append(entry)
+        manifest["particles"] += run[1]
+        manifest["deferred"].remove(run)
 
-    mrcfile_raw.flush()
-    del mrcfile_raw
+    # COPY NEW PARTICLE STACKS INTO PLACE IN PARALLEL
+    if not previous_file:
+        # The seed stack is already in place.
+        commit_stack(ready_filenames[0], ready_runs[0])
+        ready_runs, ready_filenames = ready_runs[1:], ready_filenames[1:]
+    if ready_runs:
+        wanted_counts = [run_count for _, run_count in ready_runs]
+        particle_offsets = manifest["particles"] + np.concatenate([[0], np.cumsum(wanted_counts)[:-1]]).astype(int)
+        copy_start_time = time.time()
+        combined_fd = os.open(combined_filename, os.O_RDWR)
+        try:
+            reserve_stack_capacity(combined_fd, data_offset + (manifest["particles"] + sum(wanted_counts))*frame_bytes, preallocation_bytes)
+            with ThreadPoolExecutor(max_workers=thread_count) as copy_pool:
+                copies = [copy_pool.submit(copy_particle_stack, os.path.join(warp_folder, filename), combined_fd, data_offset + int(new_offset)*frame_bytes, data_dtype, frame_shape) for filename, new_offset in zip(ready_filenames, particle_offsets)]
+                last_checkpoint = time.time()
+                for index, (filename, run, new_offset, copy) in enumerate(zip(ready_filenames, ready_runs, particle_offsets, copies)):
+                    copy.result()
+                    commit_stack(filename, run)
+                    live2dlog.info("Filename {} ({} of {}) contributing {} particles starting at {}".format(filename, index+1, len(ready_filenames), run[1], new_offset))
+                    if time.time() - last_checkpoint > checkpoint_seconds:
+                        os.fsync(combined_fd)
+                        write_import_manifest(stack_label, working_directory, manifest)
+                        last_checkpoint = time.time()
+            os.fsync(combined_fd)
+        finally:
+            os.close(combined_fd)
+        copy_time = max(time.time() - copy_start_time, 1e-6)
+        live2dlog.info("Copied {} particles ({:.0f} MB) with {} threads at {:.1f} MB/s and {:.0f} particles/s".format(sum(wanted_counts), sum(wanted_counts)*frame_bytes/1e6, thread_count, sum(wanted_counts)*frame_bytes/1e6/copy_time, sum(wanted_counts)/copy_time))
+    write_import_manifest(stack_label, working_directory, manifest)
+    total_particle_count = manifest["particles"]
     # FIX THE HEADER
-    with mrcfile.mmap(combined_filename, "r+", permissive=True) as mrcs:
-        assert os.stat(combined_filename).st_size == mrcs.header.nbytes+mrcs.extended_header.nbytes + mrcs.header.nx*mrcs.header.ny*len(total_particles)*mrcs.data.dtype.itemsize
-        mrcs.header.nz = mrcs.header.mz = len(total_particles)
+    assert os.stat(combined_filename).st_size >= data_offset + total_particle_count*frame_bytes
+    set_stack_particle_count(combined_filename, total_particle_count)
 
     # WRITE OUT STAR FILE
-    live2dlog.info(f"Writing out new base star file for combined stacks at {stack_label}.star.")
-    with open(os.path.join(working_directory, "{}.star".format(stack_label)), "w") as file:
-        file.write(" \ndata_\n \nloop_\n")
-        input = ["{} #{}".format(value, index+1) for index, value in enumerate([
-            "_cisTEMPositionInStack",
-            "_cisTEMAnglePsi",
-            "_cisTEMXShift",
-            "_cisTEMYShift",
-            "_cisTEMDefocus1",
-            "_cisTEMDefocus2",
-            "_cisTEMDefocusAngle",
-            "_cisTEMPhaseShift",
-            "_cisTEMOccupancy",
-            "_cisTEMLogP",
-            "_cisTEMSigma",
-            "_cisTEMScore",
-            "_cisTEMScoreChange",
-            "_cisTEMPixelSize",
-            "_cisTEMMicroscopeVoltagekV",
-            "_cisTEMMicroscopeCsMM",
-            "_cisTEMAmplitudeContrast",
-            "_cisTEMBeamTiltX",
-            "_cisTEMBeamTiltY",
-            "_cisTEMImageShiftX",
-            "_cisTEMImageShiftY",
-            "_cisTEMBest2DClass",
-        ])]
-        file.write("\n".join(input))
-        file.write("\n")
-        for row in total_particles.itertuples(index=True):
-            row_data = [
-                str(row.Index+1),
-                "0.00",
-                "-0.00",
-                "-0.00",
-                str(row.rlnDefocusU),
-                str(row.rlnDefocusV),
-                str(row.rlnDefocusAngle),
-                "0.0",
-                "100.0",
-                "-500",
-                "1.0",
-                "20.0",
-                "0.0",
-                "{:.4f}".format(row.rlnDetectorPixelSize),
-                str(row.rlnVoltage),
-                str(row.rlnSphericalAberration),
-                str(row.rlnAmplitudeContrast),
-                "0.0",
-                "0.0",
-                "0.0",
-                "0.0",
-                "0",
-            ]
-            file.write("\t".join(row_data))
-            file.write("\n")
+    first_row = 0
+    if previous_file and os.path.isfile(star_filename):
+        first_row = truncate_star_rows(star_filename, total_particle_count)
+    new_rows = np.concatenate([np.arange(entry["warp_rows"][0], entry["warp_rows"][0] + entry["warp_rows"][1]) for entry in manifest["files"] if entry["particles"][0] + entry["particles"][1] > first_row] + [np.array([], dtype=int)])
+    new_rows = new_rows[len(new_rows) - (total_particle_count - first_row):]
+    new_particles = pandas.DataFrame({column: cache["columns"][name][new_rows] for name, column in particle_cache_columns.items()}, index=pandas.RangeIndex(first_row, total_particle_count))
+    if first_row == 0:
+        live2dlog.info(f"Writing out new base star file for combined stacks at {stack_label}.star.")
+    else:
+        live2dlog.info(f"Appending {len(new_particles)} new particles to {stack_label}.star.")
+    write_combined_star(star_filename, new_particles, append=first_row > 0)
+    star_rows = len(load_star_offset_index(star_filename)) - 1
+    if not star_rows == total_particle_count:
+        live2dlog.warn(f"{stack_label}.star has {star_rows} rows but its import manifest has {total_particle_count} particles, so it will be rewritten.")
+        all_rows = np.concatenate([np.arange(entry["warp_rows"][0], entry["warp_rows"][0] + entry["warp_rows"][1]) for entry in manifest["files"]])
+        write_combined_star(star_filename, pandas.DataFrame({column: cache["columns"][name][all_rows] for name, column in particle_cache_columns.items()}), append=False)
     # os.chdir(starting_directory)
     end_time = time.time()
     live2dlog.info("Total Time To Import New Particles: {:.1}s".format(end_time - start_time))
-    return len(total_particles)
+    return total_particle_count
 
 
-def generate_new_classes(start_cycle_number=0, class_number=50, input_stack="combined_stack.mrcs", pixel_size=1.2007, mask_radius=150, low_res=300, high_res=40, new_star_file="cycle_0.star", working_directory="~", automask=False, autocenter=True):
+def swap_in_shadow_stack(stack_label, shadow_label, working_directory):
+    """
+    Replace a combined stack and its star file, row-offset index and import manifest with ones built under a shadow label by :py:func:`import_new_particles`.
+
+    The files are renamed one at a time, so the renames are first listed in a swap journal, ``{stack_label}_swap.json``, and a swap that is interrupted part of the way through is finished by :py:func:`finish_shadow_swap` instead of leaving a stack that doesn't match its star file or manifest.
+
+    Args:
+        stack_label (str): Name of the combined stack being replaced (without a suffix)
+        shadow_label (str): Name of the combined stack that replaces it (without a suffix)
+        working_directory (str): Folder with both stacks.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    journal_filename = os.path.join(working_directory, "{}_swap.json".format(stack_label))
+    with open(journal_filename + ".tmp", "w") as f:
+        json.dump({"renames": [[shadow_label + suffix, stack_label + suffix] for suffix in (".mrcs", ".star", "_offsets.npy", "_import.json")]}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(journal_filename + ".tmp", journal_filename)
+    finish_shadow_swap(stack_label, working_directory)
+    live2dlog.info(f"Swapped in the rebuilt {stack_label} from {shadow_label}.")
+
+
+def finish_shadow_swap(stack_label, working_directory):
+    """
+    Carry out the renames listed in the swap journal written by :py:func:`swap_in_shadow_stack`, skipping any that were already done, and then remove the journal.
+
+    Args:
+        stack_label (str): Name of the combined stack being replaced (without a suffix)
+        working_directory (str): Folder with the combined stack.
+    Returns:
+        bool: True if there was a swap to finish.
+    """
+    journal_filename = os.path.join(working_directory, "{}_swap.json".format(stack_label))
+    try:
+        with open(journal_filename) as f:
+            journal = json.load(f)
+    except FileNotFoundError:
+        return False
+    for source, destination in journal["renames"]:
+        if os.path.exists(os.path.join(working_directory, source)):
+            os.replace(os.path.join(working_directory, source), os.path.join(working_directory, destination))
+    os.remove(journal_filename)
+    return True
+
+
+def pyramid_stack_label(stack_label, bin_factor):
+    """Name of the binned copy of a combined stack (without a suffix)."""
+    return "{}_bin{}".format(stack_label, bin_factor)
+
+
+def pyramid_box_size(box_size, bin_factor):
+    """Even box size of a stack binned by a given factor."""
+    return 2 * int(round(box_size / (2 * bin_factor)))
+
+
+def fourier_resample(images, box_size):
+    """
+    Resample a stack of square images to a new box size by cropping (binning) or zero padding their Fourier transforms, keeping the same pixel values on average.
+
+    Args:
+        images (:py:class:`numpy.ndarray`): Images to resample, with the box as the last two axes.
+        box_size (int): New box size.
+    Returns:
+        :py:class:`numpy.ndarray`: Resampled float32 images.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    old_box_size = images.shape[-1]
+    if box_size == old_box_size:
+        return images
+    transform = np.fft.rfft2(images)
+    resampled = np.zeros(images.shape[:-2] + (box_size, box_size//2 + 1), dtype=transform.dtype)
+    half = min(box_size, old_box_size) // 2
+    resampled[..., :half, :half+1] = transform[..., :half, :half+1]
+    resampled[..., -half:, :half+1] = transform[..., -half:, :half+1]
+    return (np.fft.irfft2(resampled, s=(box_size, box_size)) * (box_size**2 / old_box_size**2)).astype(np.float32)
+
+
+def _manifest_digest(files):
+    """Digest of a list of import manifest entries, to tell whether a binned stack still matches the start of the combined stack."""
+    return hashlib.sha1(json.dumps(files, sort_keys=True).encode()).hexdigest()
+
+
+def update_stack_pyramid(stack_label, working_directory, bin_factors, chunk_size=2000):
+    """
+    Bring binned copies of the combined stack up to date with the particles committed in its import manifest.
+
+    Each binned stack is Fourier cropped from the combined stack and only has new particles added to it, unless the combined stack was rolled back or rebuilt since (noticed from a digest of the import manifest entries it covers), in which case it is rebuilt. Progress is kept in ``{stack_label}_pyramid.json``.
+
+    Args:
+        stack_label (str): Name of combined stack file (without a suffix)
+        working_directory (str): Folder with the combined stack.
+        bin_factors (list): Binning factors to keep stacks for.
+        chunk_size (int): Number of particles resampled at a time, to bound memory use.
+    Returns:
+        dict: Number of particles in each binned stack, keyed by binning factor.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    manifest = load_import_manifest(stack_label, working_directory)
+    if manifest is None or not bin_factors:
+        return {}
+    combined_filename = os.path.join(working_directory, "{}.mrcs".format(stack_label))
+    pyramid_filename = os.path.join(working_directory, "{}_pyramid.json".format(stack_label))
+    try:
+        with open(pyramid_filename) as f:
+            pyramid = json.load(f)
+    except (OSError, ValueError):
+        pyramid = {}
+    x, y, _, dtype, data_offset = read_particle_stack_header(combined_filename)
+    with mrcfile.open(combined_filename, header_only=True, permissive=True) as mrcs:
+        voxel_size = float(mrcs.voxel_size.x)
+    particle_count = manifest["particles"]
+    combined = np.memmap(combined_filename, dtype=dtype, mode="r", offset=data_offset, shape=(particle_count, y, x)) if particle_count else None
+    counts = {}
+    for bin_factor in bin_factors:
+        box_size = pyramid_box_size(x, bin_factor)
+        if bin_factor <= 1 or box_size < 2:
+            continue
+        binned_filename = os.path.join(working_directory, "{}.mrcs".format(pyramid_stack_label(stack_label, bin_factor)))
+        level = pyramid.get(str(bin_factor), {})
+        binned_count = level.get("particles", 0)
+        if not os.path.isfile(binned_filename) or binned_count > particle_count or not level.get("digest") == _manifest_digest(manifest["files"][:level.get("files", 0)]):
+            binned_count = 0
+        if binned_count == 0:
+            live2dlog.info(f"Building the {bin_factor}x binned particle stack")
+            with mrcfile.new(binned_filename, overwrite=True) as mrcs:
+                mrcs.set_data(np.zeros((1, box_size, box_size), dtype=np.float32))
+                mrcs.voxel_size = voxel_size * x / box_size
+        _, _, _, _, binned_offset = read_particle_stack_header(binned_filename)
+        frame_bytes = box_size * box_size * 4
+        with open(binned_filename, "r+b") as f:
+            f.truncate(binned_offset + binned_count * frame_bytes)
+            for start in range(binned_count, particle_count, chunk_size):
+                binned = fourier_resample(combined[start:start+chunk_size], box_size)
+                os.pwrite(f.fileno(), binned.tobytes(), binned_offset + start * frame_bytes)
+        set_stack_particle_count(binned_filename, particle_count)
+        if particle_count > binned_count:
+            live2dlog.info("Binned {} particles {}x to a box of {}".format(particle_count - binned_count, bin_factor, box_size))
+        pyramid[str(bin_factor)] = {"particles": particle_count, "box_size": box_size, "files": len(manifest["files"]), "digest": _manifest_digest(manifest["files"])}
+        counts[bin_factor] = particle_count
+    del combined
+    with open(pyramid_filename + ".tmp", "w") as f:
+        json.dump(pyramid, f)
+    os.replace(pyramid_filename + ".tmp", pyramid_filename)
+    return counts
+
+
+def rescale_star_pixel_size(star_filename, pixel_size, chunk_size=100000):
+    """
+    Make a copy of a cisTEM star file with the pixel size of every particle changed, for classifying against a binned stack.
+
+    Args:
+        star_filename (str): cisTEM formatted star file.
+        pixel_size (float): New pixel size, in Å.
+        chunk_size (int): Number of rows rewritten at a time, to bound memory use.
+    Returns:
+        str: Filename of the star file with the new pixel size, which is ``star_filename`` itself if it already has it.
+    """
+    columns, data_start = read_star_header(star_filename)
+    if "cisTEMPixelSize" not in columns or data_start is None:
+        return star_filename
+    pixel_size_text = "{:.4f}".format(pixel_size)
+    pixel_size_column = columns.index("cisTEMPixelSize")
+    output_filename = "{}_{}A.star".format(os.path.splitext(star_filename)[0], pixel_size_text)
+    changed = False
+    with open(star_filename, "rb") as f, open(output_filename + ".tmp", "wb") as output_file:
+        output_file.write(f.read(data_start))
+        for rows in pandas.read_csv(f, sep=r"\s+", header=None, dtype=str, chunksize=chunk_size):
+            # Rows appended since an earlier rescale can have a different pixel size to the rest.
+            changed = changed or not np.allclose(rows[pixel_size_column].astype(float), float(pixel_size_text))
+            rows[pixel_size_column] = pixel_size_text
+            output_file.write(rows.to_csv(sep="\t", header=False, index=False).encode())
+    if not changed:
+        os.remove(output_filename + ".tmp")
+        return star_filename
+    os.replace(output_filename + ".tmp", output_filename)
+    return output_filename
+
+
+def prepare_pyramid_cycle(stack_label, working_directory, star_filename, cycle, high_res_limit, pixel_size, bin_factors, particle_count, class_filename=None):
+    """
+    Pick the smallest binned stack (see :py:func:`update_stack_pyramid`) whose Nyquist limit supports the resolution of a classification cycle, and get the star file and input classes ready for it.
+
+    The star file gets the binned pixel size (see :py:func:`rescale_star_pixel_size`) and the input class averages are Fourier resampled to the binned box size if they are a different size, into ``cycle_{cycle}_box{box_size}.mrc`` so the published classes are left alone. Mask radius and resolution limits are in Å, so they don't change.
+
+    Args:
+        stack_label (str): Name of combined stack file (without a suffix)
+        working_directory (str): Folder with the combined stack.
+        star_filename (str): Star file for the cycle.
+        cycle (int): Cycle number, for finding the input classes (``cycle_{cycle}.mrc``).
+        high_res_limit (float): High resolution limit of the cycle, in Å.
+        pixel_size (float): Pixel size of the combined stack, in Å.
+        bin_factors (list): Binning factors that stacks are kept for.
+        particle_count (int): Number of particles the cycle classifies.
+        class_filename (str): Input class averages to resample, if not ``cycle_{cycle}.mrc``. False for ab initio cycles, which have none.
+    Returns:
+        str: Filename of the particle stack to classify, relative to the working directory.
+        float: Pixel size of that stack, in Å.
+        str: Filename of the star file to classify.
+        str: Filename of the input class averages to refine, or None for ab initio cycles.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    stack_filename = "{}.mrcs".format(stack_label)
+    if class_filename is not False:
+        class_filename = os.path.join(working_directory, class_filename or "cycle_{}.mrc".format(cycle))
+    else:
+        class_filename = None
+    if not bin_factors:
+        return stack_filename, pixel_size, star_filename, class_filename
+    try:
+        with open(os.path.join(working_directory, "{}_pyramid.json".format(stack_label))) as f:
+            pyramid = json.load(f)
+    except (OSError, ValueError):
+        pyramid = {}
+    x, _, _, _, _ = read_particle_stack_header(os.path.join(working_directory, stack_filename))
+    box_size = x
+    for bin_factor in sorted(bin_factors, reverse=True):
+        level = pyramid.get(str(bin_factor), {})
+        binned_pixel_size = pixel_size * x / level.get("box_size", x)
+        if bin_factor > 1 and level.get("particles", 0) >= particle_count and 2 * binned_pixel_size <= high_res_limit:
+            stack_filename = "{}.mrcs".format(pyramid_stack_label(stack_label, bin_factor))
+            pixel_size = binned_pixel_size
+            box_size = level["box_size"]
+            break
+    live2dlog.info("Classifying at {}Å from {} with a pixel size of {:.4f}Å".format(high_res_limit, stack_filename, pixel_size))
+    star_filename = rescale_star_pixel_size(os.path.join(working_directory, star_filename), pixel_size)
+    if class_filename is not None and os.path.isfile(class_filename):
+        with mrcfile.open(class_filename, permissive=True) as mrcs:
+            classes = mrcs.data
+            class_box_size = classes.shape[-1]
+            if not class_box_size == box_size:
+                classes = fourier_resample(classes, box_size)
+        if not class_box_size == box_size:
+            resampled_filename = "{}_box{}.mrc".format(os.path.splitext(class_filename)[0], box_size)
+            live2dlog.info("Resampling {} from a box of {} to {}".format(os.path.basename(class_filename), class_box_size, box_size))
+            with mrcfile.new(resampled_filename + ".tmp", overwrite=True) as mrcs:
+                mrcs.set_data(classes)
+                mrcs.voxel_size = pixel_size
+            os.replace(resampled_filename + ".tmp", resampled_filename)
+            class_filename = resampled_filename
+    return stack_filename, pixel_size, star_filename, class_filename
+
+
+def write_subset_stack(stack_label, working_directory, star_filename, fraction, subset_label="startup_subset", bin_factors=None, seed=None, rows=None):
+    """
+    Write a random subset of the particles in a star file (or the rows picked by :py:func:`select_incremental_rows`) out to a compact, contiguous particle stack and a matching star file, so that cycles that only classify a small fraction of the particles read only the ones they classify.
+
+    The subset star file has the same rows renumbered to their position in the subset stack, and the original positions are saved to ``{subset_label}_positions.npy`` for :py:func:`map_subset_star`. The frames are block copied from the combined stack in position order. A minimal import manifest is written for the subset stack so that binned copies of it can be made with :py:func:`update_stack_pyramid`.
+
+    Args:
+        stack_label (str): Name of combined stack file (without a suffix)
+        working_directory (str): Folder with the combined stack.
+        star_filename (str): Star file for the particles to sample from.
+        fraction (float): Fraction of particles to sample.
+        subset_label (str): Name of the subset stack and star file (without a suffix)
+        bin_factors (list): Binning factors to also make binned copies of the subset stack at.
+        seed (int): Seed for the random sample.
+        rows (numpy.ndarray): Sorted star file row indices (from 0) to use instead of a random sample. ``fraction`` is ignored.
+    Returns:
+        str: Filename of the subset star file.
+        int: Number of particles in the subset.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    star_filename = os.path.join(working_directory, star_filename)
+    subset_star = os.path.join(working_directory, "{}.star".format(subset_label))
+    subset_stack = os.path.join(working_directory, "{}.mrcs".format(subset_label))
+    combined_filename = os.path.join(working_directory, "{}.mrcs".format(stack_label))
+    _, data_start = read_star_header(star_filename)
+    row_count = count_star_rows(star_filename)
+    if rows is None:
+        subset_count = min(row_count, max(1, int(ceil(fraction * row_count))))
+        rows = np.sort(np.random.default_rng(seed).choice(row_count, subset_count, replace=False))
+    subset_count = len(rows)
+    positions = np.zeros(subset_count, dtype=np.int64)
+    with open(star_filename, "rb") as f, open(subset_star, "wb") as output_file:
+        output_file.write(f.read(data_start))
+        subset_index = 0
+        row_index = 0
+        for line in f:
+            if subset_index == subset_count:
+                break
+            fields = line.split(None, 1)
+            if not fields:
+                continue
+            if row_index == rows[subset_index]:
+                positions[subset_index] = int(fields[0])
+                subset_index += 1
+                output_file.write("{}\t".format(subset_index).encode() + fields[1].rstrip(b"\n") + b"\n")
+            row_index += 1
+    np.save(os.path.join(working_directory, "{}_positions.npy".format(subset_label)), positions)
+
+    x, y, _, dtype, data_offset = read_particle_stack_header(combined_filename)
+    frame_bytes = x * y * dtype.itemsize
+    run_starts = np.flatnonzero(np.diff(positions, prepend=-1) != 1)
+    run_ends = np.append(run_starts[1:], subset_count)
+    with open(combined_filename, "rb") as f, open(subset_stack + ".tmp", "wb", buffering=0) as output_file:
+        copy_bytes(f, output_file, 0, data_offset)
+        for run_start, run_end in zip(run_starts, run_ends):
+            copy_bytes(f, output_file, data_offset + int(positions[run_start] - 1) * frame_bytes, int(run_end - run_start) * frame_bytes)
+    set_stack_particle_count(subset_stack + ".tmp", subset_count)
+    os.replace(subset_stack + ".tmp", subset_stack)
+    write_import_manifest(subset_label, working_directory, {"subset_of": os.path.basename(star_filename), "particles": subset_count, "files": [{"filename": os.path.basename(star_filename), "positions": hashlib.sha1(positions.tobytes()).hexdigest()}], "deferred": []})
+    live2dlog.info("Wrote {} of {} particles ({} contiguous runs) to {}.mrcs".format(subset_count, row_count, len(run_starts), subset_label))
+    if bin_factors:
+        update_stack_pyramid(subset_label, working_directory, bin_factors)
+    return subset_star, subset_count
+
+
+def read_star_columns(star_filename, names):
+    """
+    Read a few columns of a star file into numpy arrays.
+
+    Args:
+        star_filename (str): Filename of a star file with one single data loop.
+        names (list): Column names, without the leading _.
+    Returns:
+        list: An array for each column, in the order of ``names``.
+    """
+    columns, data_start = read_star_header(star_filename)
+    if data_start is None:
+        return [np.zeros(0) for _ in names]
+    with open(star_filename, "rb") as f:
+        f.seek(data_start)
+        data = pandas.read_csv(f, sep=r"\s+", header=None, usecols=[columns.index(name) for name in names])
+    return [data[columns.index(name)].to_numpy() for name in names]
+
+
+def convergence_metrics(star_filename, previous_star_filename, rows=None):
+    """
+    Measure how much a classification cycle changed from the one before, from their star files.
+
+    Particles are matched by row, so only the rows classified in both cycles are compared (new particles are appended at the end and start out unclassified). Cycles that only reclassify some of the particles, like incremental refinement cycles, pass their rows in, so the particles carried over unchanged don't dilute the metrics.
+
+    Args:
+        star_filename (str): Star file written by the cycle.
+        previous_star_filename (str): Star file written by the previous cycle.
+        rows (list): Sorted rows the cycle reclassified. None for all of them.
+    Returns:
+        dict: ``compared_particles``; ``class_change_fraction``, the fraction of them that changed class; ``mean_score_change``, the mean absolute ``_cisTEMScoreChange`` over the cycle's classified particles; and ``occupancy_drift``, the total variation distance between the two cycles' class occupancies (0 for identical, 1 for disjoint). Metrics that can't be measured are None.
+    """
+    classes, score_changes = read_star_columns(star_filename, ["cisTEMBest2DClass", "cisTEMScoreChange"])
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        classes, score_changes = classes[rows], score_changes[rows]
+    metrics = {"compared_particles": 0, "class_change_fraction": None, "mean_score_change": None, "occupancy_drift": None}
+    classified = classes > 0
+    if classified.any():
+        metrics["mean_score_change"] = float(np.abs(score_changes[classified]).mean())
+    if not os.path.isfile(previous_star_filename):
+        return metrics
+    previous_classes, = read_star_columns(previous_star_filename, ["cisTEMBest2DClass"])
+    if rows is not None:
+        # Rows past the end of the previous cycle are new particles, at the end of the sorted rows.
+        previous_classes = previous_classes[rows[rows < len(previous_classes)]]
+    compared = min(len(classes), len(previous_classes))
+    both_classified = classified[:compared] & (previous_classes[:compared] > 0)
+    metrics["compared_particles"] = int(both_classified.sum())
+    if metrics["compared_particles"]:
+        metrics["class_change_fraction"] = float((classes[:compared][both_classified] != previous_classes[:compared][both_classified]).mean())
+    previous_classified = previous_classes > 0
+    if classified.any() and previous_classified.any():
+        class_count = int(max(classes.max(), previous_classes.max())) + 1
+        occupancy = np.bincount(classes[classified].astype(np.int64), minlength=class_count) / classified.sum()
+        previous_occupancy = np.bincount(previous_classes[previous_classified].astype(np.int64), minlength=class_count) / previous_classified.sum()
+        metrics["occupancy_drift"] = float(np.abs(occupancy - previous_occupancy).sum() / 2)
+    return metrics
+
+
+def select_incremental_rows(star_filename, previous_star_filename, earlier_star_filename, cycle, revisit_fraction=0.1, score_change_factor=3.0):
+    """
+    Pick the particles an incremental refinement cycle needs to classify: new particles, unsettled particles, and a rotating sample of the settled ones.
+
+    * New particles are the rows appended after the previous cycle's star file, and any rows without a class.
+    * Unsettled particles either changed ``_cisTEMBest2DClass`` between the previous cycle and the one before it, or have a ``_cisTEMScoreChange`` more than ``score_change_factor`` times the median absolute score change.
+    * The rotating sample is every ``1/revisit_fraction``-th row, offset by the cycle number, so every settled particle is revisited every ``1/revisit_fraction`` cycles.
+
+    Args:
+        star_filename (str): Star file the cycle starts from (the previous cycle's results with new particles appended).
+        previous_star_filename (str): Star file written by the previous cycle.
+        earlier_star_filename (str): Star file written by the cycle before that. Class changes are skipped if it doesn't exist.
+        cycle (int): Cycle number, to rotate the sample.
+        revisit_fraction (float): Fraction of the settled particles to revisit each cycle.
+        score_change_factor (float): Multiple of the median absolute score change above which a particle counts as unsettled.
+    Returns:
+        numpy.ndarray: Sorted row indices (from 0) of the particles to classify.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    classes, score_changes = read_star_columns(star_filename, ["cisTEMBest2DClass", "cisTEMScoreChange"])
+    row_count = len(classes)
+    previous_count = count_star_rows(previous_star_filename) if os.path.isfile(previous_star_filename) else 0
+    row_indices = np.arange(row_count)
+    new = (row_indices >= previous_count) | (classes <= 0)
+
+    unsettled = np.zeros(row_count, dtype=bool)
+    old_score_changes = np.abs(score_changes[~new])
+    if len(old_score_changes) and np.median(old_score_changes) > 0:
+        unsettled |= np.abs(score_changes) > score_change_factor * np.median(old_score_changes)
+    if os.path.isfile(earlier_star_filename):
+        earlier_classes, = read_star_columns(earlier_star_filename, ["cisTEMBest2DClass"])
+        compared = min(len(earlier_classes), row_count)
+        unsettled[:compared] |= classes[:compared] != earlier_classes[:compared]
+    unsettled &= ~new
+
+    revisit = np.zeros(row_count, dtype=bool)
+    if revisit_fraction > 0:
+        period = max(int(round(1 / revisit_fraction)), 1)
+        revisit = (row_indices % period == cycle % period) & ~new & ~unsettled
+
+    rows = np.flatnonzero(new | unsettled | revisit)
+    live2dlog.info("Incremental refinement will classify {} of {} particles: {} new, {} unsettled and {} revisited".format(len(rows), row_count, int(new.sum()), int(unsettled.sum()), int(revisit.sum())))
+    return rows
+
+
+def map_subset_star(subset_star, full_star, positions_filename, output_filename):
+    """
+    Put the classification results for a subset of particles (see :py:func:`write_subset_stack`) back into the star file the subset was taken from, with their original positions in the combined stack.
+
+    Args:
+        subset_star (str): Star file classified against the subset stack.
+        full_star (str): Star file the subset was taken from.
+        positions_filename (str): Saved original positions of the subset particles.
+        output_filename (str): Filename for the star file with all the particles.
+    Returns:
+        int: Number of particles in the new star file.
+    """
+    positions = np.load(positions_filename).tolist() + [None]
+    _, subset_start = read_star_header(subset_star)
+    _, full_start = read_star_header(full_star)
+    row_count = 0
+    with open(subset_star, "rb") as subset_file, open(full_star, "rb") as full_file, open(output_filename + ".tmp", "wb") as output_file:
+        output_file.write(subset_file.read(subset_start))
+        subset_lines = (line for line in subset_file if line.strip())
+        full_file.seek(full_start)
+        subset_index = 0
+        for line in full_file:
+            fields = line.split(None, 1)
+            if not fields:
+                continue
+            position = int(fields[0])
+            if position == positions[subset_index]:
+                subset_index += 1
+                subset_fields = next(subset_lines).split(None, 1)
+                output_file.write("{}\t".format(position).encode() + subset_fields[1].rstrip(b"\n") + b"\n")
+            else:
+                output_file.write(line.rstrip(b"\n") + b"\n")
+            row_count += 1
+    os.replace(output_filename + ".tmp", output_filename)
+    return row_count
+
+
+def generate_new_classes(start_cycle_number=0, class_number=50, input_stack="combined_stack.mrcs", pixel_size=1.2007, mask_radius=150, low_res=300, high_res=40, new_star_file="cycle_0.star", working_directory="~", automask=False, autocenter=True, thread_count=1):
     """
     Call out to cisTEM2 ``refine2d`` using :py:func:`subprocess.Popen` to generate a new set of *Ab Initio* classes.
 
@@ -358,6 +1523,7 @@ def generate_new_classes(start_cycle_number=0, class_number=50, input_stack="com
         working_directory (str): Directory where data will output.
         automask (bool): Automatically mask class averages
         autocenter (bool): Automatically center class averages to center of mass.
+        thread_count (int): Number of threads for ``refine2d`` to use.
     Returns:
         str: STDOUT of :py:func:`subprocess.Popen` call to ``refine2d``.
     """
@@ -396,42 +1562,33 @@ def generate_new_classes(start_cycle_number=0, class_number=50, input_stack="com
         autocenter_text,  # Autocenter
         "No",  # Dump Dats
         "No.dat",  # Datfilename
-        "1",  # max threads
+        str(thread_count),  # max threads
     ])
     p = subprocess.Popen("refine2d", stdout=subprocess.PIPE, stdin=subprocess.PIPE)
     out, _ = p.communicate(input=input.encode('utf-8'))
     live2dlog.info(out.decode('utf-8'))
 
 
-def refine_2d_subjob(process_number, round=0, input_star_filename="class_0.star", input_stack="combined_stack.mrcs", particles_per_process=100, mask_radius=150, low_res_limit=300, high_res_limit=40, class_fraction=1.0, particle_count=20000, pixel_size=1, angular_search_step=15.0, max_search_range=49.5, smoothing_factor=1.0, process_count=32, working_directory="~", automask=False, autocenter=True):
+def refine_2d_input(process_number, round=0, input_star_filename="class_0.star", input_stack="combined_stack.mrcs", particles_per_process=100, mask_radius=150, low_res_limit=300, high_res_limit=40, class_fraction=1.0, particle_count=20000, pixel_size=1, angular_search_step=15.0, max_search_range=49.5, smoothing_factor=1.0, working_directory="~", automask=False, autocenter=True, first_particle=None, last_particle=None, attempt=0, thread_count=1, input_classes=None):
     """
-    Call out to cisTEM2 ``refine2d`` using :py:func:`subprocess.Popen` to generate a new partial set of *Refined* classes for a slice of a particle stack (used in parallel with other slices).
+    Build the stdin text for a cisTEM2 ``refine2d`` run that classifies one slice of a particle stack. Takes the same arguments as :py:func:`refine_2d_subjob`, plus:
 
     Args:
-        start_cycle_number (int): Iteration number of the classification (indexes from 0 in :py:func:`execute_job_loop`)
-        input_stack (str): Filename of combined monolithic particle stack
-        particles_per_process (int): Number of particles to classify in this job.
-        process_count (int): How many processes have run before this one (assumes other processes have classified the same number of particles).
-        mask_radius (int): Radius in Å to use for mask (default 150).
-        low_res (float): Low resolution cutoff for classification, in Å.
-        high_res (float): High resolution cutoff for classification, in Å.
-        class_fraction (float): Fraction of particles [0-1] in a section to classify. Values below 1 improve speed but have lower SNR in final classes.
-        particle_count (int): Total number of particles in dataset.
-        pixel_size (int): Pixel size of image files, in Å.
-        angular_search_step (float): Angular step in degrees for the classification.
-        max_search_range (float): XY search range in Å for the classification.
-        working_directory (str): Directory where data will output.
-        automask (bool): Automatically mask class averages
-        autocenter (bool): Automatically center class averages to center of mass.
+        first_particle (int): First particle (1-indexed) of the slice, for slices that aren't a fixed ``particles_per_process`` long. The output files are still numbered by ``process_number``, so slices need numbering in particle order for :py:func:`merge_star_files`.
+        last_particle (int): Last particle (inclusive) of the slice.
+        attempt (int): Attempt number, for retried or duplicated runs of the same slice, which write to their own output files (see :py:func:`refine_2d_output_files`).
+        thread_count (int): Number of threads for ``refine2d`` to use.
+        input_classes (str): Input class averages, if not ``cycle_{round}.mrc`` (see :py:func:`prepare_pyramid_cycle`).
     Returns:
-        str: STDOUT of :py:func:`subprocess.Popen` call to ``refine2d``.
+        str: Newline separated answers to the ``refine2d`` prompts.
     """
-    start_time = time.time()
-    live2dlog = logging.getLogger("live_2d")
     start = process_number*particles_per_process+1
     stop = (process_number+1)*particles_per_process
     if stop > particle_count:
         stop = particle_count
+    if first_particle is not None:
+        start, stop = first_particle, last_particle
+    partial_star_filename, dump_filename = refine_2d_output_files(process_number, round, working_directory, attempt=attempt)
 
     automask_text = "No"
     if automask is True:
@@ -440,11 +1597,11 @@ def refine_2d_subjob(process_number, round=0, input_star_filename="class_0.star"
     if autocenter is True:
         autocenter_text = "Yes"
 
-    input = "\n".join([
+    return "\n".join([
         os.path.join(working_directory, input_stack),  # Input MRCS stack
         os.path.join(working_directory, input_star_filename),  # Input Star file
-        os.path.join(working_directory, "cycle_{0}.mrc".format(round)),  # Input MRC classes
-        os.path.join(working_directory, "partial_classes_{0}_{1}.star".format(round+1, process_number)),  # Output Star file
+        os.path.join(working_directory, input_classes or "cycle_{0}.mrc".format(round)),  # Input MRC classes
+        partial_star_filename,  # Output Star file
         os.path.join(working_directory, "cycle_{0}.mrc".format(round+1)),  # Output MRC classes
         "0",  # number of classes to generate for the first time - only use when starting a NEW classification
         str(start),  # First particle in stack to use
@@ -467,12 +1624,57 @@ def refine_2d_subjob(process_number, round=0, input_star_filename="class_0.star"
         automask_text,  # Automask
         autocenter_text,  # Autocenter
         "Yes",  # Dump Dat
-        os.path.join(working_directory, "dump_file_{0}.dat".format(process_number+1)),
-        "1",  # Max threads
+        dump_filename,
+        str(thread_count),  # Max threads
     ])
 
-    # if process_number=0:
-    #     live2dlog.info(input)
+
+def refine_2d_output_files(process_number, round, working_directory, attempt=0):
+    """
+    Filenames of the partial star file and dump file written by one ``refine2d`` slice.
+
+    Args:
+        process_number (int): Number of the slice.
+        round (int): Iteration number of the classification.
+        working_directory (str): Directory where data will output.
+        attempt (int): Attempt number. Attempts after the first get an ``_attempt{n}`` suffix so they can run alongside each other.
+    Returns:
+        str: Partial star filename.
+        str: Dump filename.
+    """
+    suffix = "" if attempt == 0 else "_attempt{}".format(attempt)
+    return (os.path.join(working_directory, "partial_classes_{0}_{1}{2}.star".format(round+1, process_number, suffix)),
+            os.path.join(working_directory, "dump_file_{0}{1}.dat".format(process_number+1, suffix)))
+
+
+def refine_2d_subjob(process_number, round=0, input_star_filename="class_0.star", input_stack="combined_stack.mrcs", particles_per_process=100, mask_radius=150, low_res_limit=300, high_res_limit=40, class_fraction=1.0, particle_count=20000, pixel_size=1, angular_search_step=15.0, max_search_range=49.5, smoothing_factor=1.0, process_count=32, working_directory="~", automask=False, autocenter=True):
+    """
+    Call out to cisTEM2 ``refine2d`` using :py:func:`subprocess.Popen` to generate a new partial set of *Refined* classes for a slice of a particle stack (used in parallel with other slices).
+    The job loop runs the same ``refine2d`` input through :py:mod:`live2d.scheduling` instead; this blocking version is kept for use outside the web server.
+
+    Args:
+        start_cycle_number (int): Iteration number of the classification (indexes from 0 in :py:func:`execute_job_loop`)
+        input_stack (str): Filename of combined monolithic particle stack
+        particles_per_process (int): Number of particles to classify in this job.
+        process_count (int): How many processes have run before this one (assumes other processes have classified the same number of particles).
+        mask_radius (int): Radius in Å to use for mask (default 150).
+        low_res (float): Low resolution cutoff for classification, in Å.
+        high_res (float): High resolution cutoff for classification, in Å.
+        class_fraction (float): Fraction of particles [0-1] in a section to classify. Values below 1 improve speed but have lower SNR in final classes.
+        particle_count (int): Total number of particles in dataset.
+        pixel_size (int): Pixel size of image files, in Å.
+        angular_search_step (float): Angular step in degrees for the classification.
+        max_search_range (float): XY search range in Å for the classification.
+        working_directory (str): Directory where data will output.
+        automask (bool): Automatically mask class averages
+        autocenter (bool): Automatically center class averages to center of mass.
+    Returns:
+        str: STDOUT of :py:func:`subprocess.Popen` call to ``refine2d``.
+    """
+    start_time = time.time()
+    live2dlog = logging.getLogger("live_2d")
+    input = refine_2d_input(process_number, round=round, input_star_filename=input_star_filename, input_stack=input_stack, particles_per_process=particles_per_process, mask_radius=mask_radius, low_res_limit=low_res_limit, high_res_limit=high_res_limit, class_fraction=class_fraction, particle_count=particle_count, pixel_size=pixel_size, angular_search_step=angular_search_step, max_search_range=max_search_range, smoothing_factor=smoothing_factor, working_directory=working_directory, automask=automask, autocenter=autocenter)
+
     p = subprocess.Popen("refine2d", shell=True, stdout=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.PIPE)
     out, _ = p.communicate(input=input.encode('utf-8'))
     end_time = time.time()
@@ -481,54 +1683,156 @@ def refine_2d_subjob(process_number, round=0, input_star_filename="class_0.star"
     return(out)
 
 
-def merge_star_files(cycle: int, process_count: int, working_directory: str):
+def copy_bytes(source, destination, offset, count, destination_offset=None):
+    """
+    Copy a byte range of one open file into another without passing the data through python.
+    Uses :py:func:`os.copy_file_range` where available, then :py:func:`os.sendfile`, and falls back to large buffered block copies.
+
+    Args:
+        source (file): Binary file object to copy from.
+        destination (file or int): Unbuffered binary file object (or file descriptor) to copy to.
+        offset (int): Byte offset in ``source`` to start copying from.
+        count (int): Number of bytes to copy.
+        destination_offset (int): Byte offset in ``destination`` to copy to, written positionally without moving its file position and so safe to use from several threads at once. Defaults to its current position.
+    """
+    destination_fd = destination if isinstance(destination, int) else destination.fileno()
+    end = offset + count
+    for kernel_copy in ("copy_file_range", "sendfile"):
+        if not hasattr(os, kernel_copy) or (kernel_copy == "sendfile" and destination_offset is not None):
+            continue
+        try:
+            while offset < end:
+                if kernel_copy == "copy_file_range":
+                    copied = os.copy_file_range(source.fileno(), destination_fd, end - offset, offset, destination_offset)
+                else:
+                    copied = os.sendfile(destination_fd, source.fileno(), offset, end - offset)
+                if copied == 0:
+                    raise IOError(errno.EIO, f"Unexpected end of file copying {source.name}")
+                offset += copied
+                if destination_offset is not None:
+                    destination_offset += copied
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF):
+                raise
+    while offset < end:
+        block = os.pread(source.fileno(), min(16*1024*1024, end - offset), offset)
+        if not block:
+            raise IOError(errno.EIO, f"Unexpected end of file copying {source.name}")
+        if destination_offset is None:
+            os.write(destination_fd, block)
+        else:
+            os.pwrite(destination_fd, block, destination_offset)
+            destination_offset += len(block)
+        offset += len(block)
+
+
+def star_data_range(star_filename):
+    """
+    Find the byte range covering the data lines of a star file, leaving out the header and any trailing whitespace.
+
+    Args:
+        star_filename (str): Filename of a star file with one single data loop.
+    Returns:
+        int: Byte offset of the first data line.
+        int: Byte offset just past the last non-whitespace character of the last data line (before its newline).
+    """
+    _, data_start = read_star_header(star_filename)
+    with open(star_filename, "rb") as f:
+        data_end = os.fstat(f.fileno()).st_size
+        if data_start is None:
+            return data_end, data_end
+        while data_end > data_start:
+            f.seek(max(data_end - 4096, data_start))
+            block = f.read(data_end - f.tell())
+            stripped = block.rstrip()
+            data_end = data_end - len(block) + len(stripped)
+            if stripped:
+                break
+    return data_start, data_end
+
+
+def merge_star_files(cycle: int, process_count: int, working_directory: str, count_classes=False):
     """
     Combine output partial class star files from a parallelized ``refine2d`` job into a single monolithic cisTEM2 classification star file.
+    The header length of each partial file is found once and the data lines are then copied in bulk with :py:func:`copy_bytes`.
+
+    With ``count_classes``, the ``_cisTEMBest2DClass`` column of each partial file is also histogrammed while the file is still in the page cache, so that :py:func:`count_particles_per_class` doesn't need to reread the merged file.
 
     Args:
         cycle (int): Iteration number for finding the partial classes and writing out the result.
         process_count (int): Number of processes used for parallelizing the ``refine2d`` job.
         working_directory (str): directory where new classes will be output.
+        count_classes (bool): Also count the particles per class and in total.
     Returns:
         str: path to new classification star file.
+        list: (only with ``count_classes``) List of counts for each class in its respective index, and unclassified count in index 0.
+        int: (only with ``count_classes``) Total number of particles in the new star file.
     """
     live2dlog = logging.getLogger("live_2d")
     filename = os.path.join(working_directory, "cycle_{}.star".format(cycle+1))
-    with open(filename, 'wb') as outfile:
+    class_counter = np.zeros(1, dtype=np.int64)
+    particle_count = 0
+    with open(filename, 'wb', buffering=0) as outfile:
         for process_number in range(process_count):
-            with open(os.path.join(working_directory, "partial_classes_{}_{}.star".format(cycle+1, process_number)), 'rb') as infile:
+            partial_filename = os.path.join(working_directory, "partial_classes_{}_{}.star".format(cycle+1, process_number))
+            data_start, data_end = star_data_range(partial_filename)
+            with open(partial_filename, 'rb') as infile:
                 if process_number == 0:
-                    for line in infile:
-                        outfile.write(line)
-                else:
-                    for line in infile:
-                        if not isheader(line):
-                            outfile.write(line)
+                    copy_bytes(infile, outfile, 0, data_start)
+                copy_bytes(infile, outfile, data_start, data_end - data_start)
+                if count_classes and data_end > data_start:
+                    infile.seek(data_start)
+                    data = infile.read(data_end - data_start)
+                    columns, _ = read_star_header(partial_filename)
+                    class_column = columns.index("cisTEMBest2DClass") if "cisTEMBest2DClass" in columns else len(columns) - 1
+                    classes = pandas.read_csv(io.BytesIO(data), sep=r"\s+", header=None, usecols=[class_column]).iloc[:, 0].to_numpy(dtype=np.int64)
+                    partial_counter = np.bincount(np.maximum(classes, 0))
+                    if len(partial_counter) > len(class_counter):
+                        class_counter = np.pad(class_counter, (0, len(partial_counter) - len(class_counter)), "constant")
+                    class_counter[:len(partial_counter)] += partial_counter
+                    particle_count += len(classes)
+            if data_end > data_start:
+                outfile.write(b"\n")
             try:
-                os.remove(os.path.join(working_directory, "partial_classes_{}_{}.star".format(cycle+1, process_number)))
+                os.remove(partial_filename)
             except Exception:
                 live2dlog.warn("Failed to remove file partial_classes_{}_{}.star".format(cycle+1, process_number))
     live2dlog.info("Finished writing cycle_{}.star".format(cycle+1))
-    return filename
+    if not count_classes:
+        return filename
+    class_counter_list = [int(i) for i in class_counter]
+    live2dlog.info(f"Particles per class: {class_counter_list}")
+    return filename, class_counter_list, particle_count
 
 
-def merge_2d_subjob(cycle, working_directory, process_count=32):
+def merge_2d_input(cycle, working_directory, process_count=32):
     """
-    Call out to cisTEM2 ``merge2d`` using :py:func:`subprocess.Popen` to complete a new set of *Refined* class ``.mrc`` files from partial classes output from ``refine2d``.
+    Build the stdin text for a cisTEM2 ``merge2d`` run that combines the dump files of a parallelized ``refine2d`` job.
 
     Args:
         cycle (int): Iteration number for finding the partial classes and writing out the result.
+        working_directory (str): Directory holding the dump files.
         process_count (int): Number of processes used for parallelizing the ``refine2d`` job.
+    Returns:
+        str: Newline separated answers to the ``merge2d`` prompts.
     """
-    live2dlog = logging.getLogger("live_2d")
-    input = "\n".join([
+    return "\n".join([
         os.path.join(working_directory, "cycle_{0}.mrc".format(cycle+1)),
         os.path.join(working_directory, "dump_file_.dat"),
         str(process_count)
     ])
-    p = subprocess.Popen("merge2d", shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-    out, _ = p.communicate(input=input.encode('utf-8'))
-    live2dlog.info(out.decode('utf-8'))
+
+
+def remove_dump_files(working_directory, process_count=32):
+    """
+    Delete the ``refine2d`` dump files once ``merge2d`` has consumed them.
+
+    Args:
+        working_directory (str): Directory holding the dump files.
+        process_count (int): Number of processes used for parallelizing the ``refine2d`` job.
+    """
+    live2dlog = logging.getLogger("live_2d")
     for i in range(process_count):
         try:
             os.remove(os.path.join(working_directory, "dump_file_{}.dat".format(i+1)))
@@ -536,6 +1840,22 @@ def merge_2d_subjob(cycle, working_directory, process_count=32):
             live2dlog.warn("Failed to remove file dump_file_{}.dat".format(i+1))
 
 
+def merge_2d_subjob(cycle, working_directory, process_count=32):
+    """
+    Call out to cisTEM2 ``merge2d`` using :py:func:`subprocess.Popen` to complete a new set of *Refined* class ``.mrc`` files from partial classes output from ``refine2d``.
+
+    Args:
+        cycle (int): Iteration number for finding the partial classes and writing out the result.
+        process_count (int): Number of processes used for parallelizing the ``refine2d`` job.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    input = merge_2d_input(cycle, working_directory, process_count=process_count)
+    p = subprocess.Popen("merge2d", shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+    out, _ = p.communicate(input=input.encode('utf-8'))
+    live2dlog.info(out.decode('utf-8'))
+    remove_dump_files(working_directory, process_count=process_count)
+
+
 def calculate_particle_statistics(filename, class_number=50, particles_per_class=300, process_count=32):
     """
     Determine fraction of total particles to classify for ab initio classifications, and number of particles that will be classified per process, and total number of particles in the monolithic stack.
@@ -550,14 +1870,7 @@ def calculate_particle_statistics(filename, class_number=50, particles_per_class
         int: Number of particles per process.
         float: Fraction of particles in each process to actually classify.
     """
-    with open(filename, "r") as f:
-        i = 0
-        j = 0
-        for i, l in enumerate(f):
-            if isheader(l):
-                j += 1
-            pass
-        particle_count = i+1-j
+    particle_count = count_star_rows(filename)
     particles_per_process = int(ceil(particle_count / process_count))
 
     class_fraction = particles_per_class * class_number / particle_count
@@ -567,40 +1880,34 @@ def calculate_particle_statistics(filename, class_number=50, particles_per_class
     return particle_count, particles_per_process, class_fraction
 
 
-def append_new_particles(old_particles, new_particles, output_filename):
+def append_new_particles(old_particles, new_particles, output_filename, particle_limit=None):
     """
     Merge new particles in an unclassified cisTEM2 star file onto the end of a star file generated during classification, to allow iterative refinement to incorporate new particles.
+    The old file is block copied, and the new particles are found in the monolithic star file by their byte offset from its row-offset index (see :py:func:`load_star_offset_index`) and block copied after it.
 
     Args:
         old_particles (str): Output particle star file from classification.
         new_particles (str): Monolithic star file containing all particles including new ones.
         output_filename (str): Filename for new combined star file.
+        particle_limit (int): Only take particles up to this position in the monolithic star file, such as the ones committed when a job started. Defaults to all of them.
     Returns:
         int: Total number of particles in new star file.
     """
-    with open(output_filename, 'w') as append_file:
-        old_header_length = 0
-        with open(old_particles) as f:
-            for i, l in enumerate(f):
-                append_file.write(l)
-                if isheader(l):
-                    old_header_length += 1
-        old_particle_count = i+1-old_header_length
-        new_particles_count = 0
-        new_header_length = 0
-        with open(new_particles) as f2:
-            for i, l in enumerate(f2):
-                if isheader(l):
-                    new_header_length += 1
-                    continue
-                if i == new_header_length + old_particle_count:
-                    # live2dlog.info(i)
-                    pass
-                if i > new_header_length + old_particle_count:
-                    append_file.write(l)
-                    new_particles_count += 1
+    old_particle_count = count_star_rows(old_particles)
+    _, old_data_end = star_data_range(old_particles)
+    offsets = load_star_offset_index(new_particles)
+    available_count = len(offsets) - 1 if particle_limit is None else min(particle_limit, len(offsets) - 1)
+    new_particles_count = max(available_count - old_particle_count, 0)
+    with open(output_filename, 'wb', buffering=0) as append_file:
+        with open(old_particles, 'rb') as f:
+            copy_bytes(f, append_file, 0, old_data_end)
+        append_file.write(b"\n")
+        if new_particles_count:
+            with open(new_particles, 'rb') as f2:
+                copy_bytes(f2, append_file, int(offsets[old_particle_count]), int(offsets[available_count]) - int(offsets[old_particle_count]))
     return new_particles_count+old_particle_count
 
+
 # def find_previous_classes(config):
 #     file_list = glob.glob("classes_*.star")
 #     if len(file_list) > 0:
@@ -614,7 +1921,23 @@ def append_new_particles(old_particles, new_particles, output_filename):
 #     return previous_classes_bool, recent_class, cycle_number
 
 
-def generate_star_file(stack_label, working_directory, previous_classes_bool=False, merge_star=True, recent_class="cycle_0", start_cycle_number=0):
+def copy_star_rows(star_filename, output_filename, particle_limit=None):
+    """Copy a star file, optionally only up to a given number of data rows (using its row-offset index, see :py:func:`load_star_offset_index`)."""
+    if particle_limit is None:
+        shutil.copy(star_filename, output_filename)
+        return
+    offsets = load_star_offset_index(star_filename)
+    with open(star_filename, "rb") as f, open(output_filename, "wb", buffering=0) as output_file:
+        copy_bytes(f, output_file, 0, int(offsets[min(particle_limit, len(offsets) - 1)]))
+
+
+def committed_star_offset(stack_label, working_directory, particle_count):
+    """Byte offset in the combined star file just past the row of the last of a number of committed particles."""
+    offsets = load_star_offset_index(os.path.join(working_directory, "{}.star".format(stack_label)))
+    return int(offsets[min(particle_count, len(offsets) - 1)])
+
+
+def generate_star_file(stack_label, working_directory, previous_classes_bool=False, merge_star=True, recent_class="cycle_0", start_cycle_number=0, particle_limit=None):
     """Logic to either append particles or generate a whole new class.
     Uses :py:func:`find_previous_classes` and :py:func:`append_new_particles` and :py:func:`import_new_particles` to do all the heavy lifting.
 
@@ -625,6 +1948,7 @@ def generate_star_file(stack_label, working_directory, previous_classes_bool=Fal
         merge_star (bool): Should previous classifications be used?
         recent_class (str): Base name (without extension) of most recently completed classification output.
         start_cycle_number (int): Cycle number for naming new file if ``merge_star`` is ``false``
+        particle_limit (int): Only use particles up to this position in the combined stack, so that particles imported in the background while the star file is generated are left for the next cycle. Defaults to all of them.
     Returns:
         str: filename of new combined star file.
     """
@@ -633,17 +1957,17 @@ def generate_star_file(stack_label, working_directory, previous_classes_bool=Fal
     if previous_classes_bool and not merge_star:
         live2dlog.info("Previous classes will not be used, and a new star will be written at cycle_{}.star".format(start_cycle_number))
         new_star_file = os.path.join(working_directory, "cycle_{}.star".format(start_cycle_number))
-        shutil.copy(star_file, new_star_file)
+        copy_star_rows(star_file, new_star_file, particle_limit)
     elif previous_classes_bool:
         live2dlog.info("It looks like previous jobs have been run in this directory. The most recent output star file is: {}.star".format(recent_class))
         new_star_file = os.path.join(working_directory, "{}_appended.star".format(recent_class))
         live2dlog.info("The new particle information will be appended to the end of that star file and saved as {}".format("{}_appended.star".format(recent_class)))
-        total_particles = append_new_particles(old_particles=os.path.join(working_directory, "{}.star".format(recent_class)), new_particles=star_file, output_filename=new_star_file)
+        total_particles = append_new_particles(old_particles=os.path.join(working_directory, "{}.star".format(recent_class)), new_particles=star_file, output_filename=new_star_file, particle_limit=particle_limit)
         live2dlog.info(f"Total particles in new cycle: {total_particles}")
     else:
         live2dlog.info("No previous classification cycles were found. A new classification star file will be generated at cycle_0.star")
         new_star_file = os.path.join(working_directory, "cycle_0.star")
-        shutil.copy(star_file, new_star_file)
+        copy_star_rows(star_file, new_star_file, particle_limit)
     return new_star_file
 
 
@@ -0,0 +1,610 @@
+#! /usr/bin/env python
+
+#
+# Copyright 2019 Genentech Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Scheduling of cisTEM2 jobs for Live 2D Classification
+=====================================================
+Runs the cisTEM2 command line programs of a classification cycle (``refine2d`` slices and ``merge2d``) as asyncio subprocesses on the server's event loop, or on worker agents on other machines, with at most a fixed number running at once.
+
+The stdin text for each program is built by :py:mod:`live2d.processing_functions` (see :py:func:`live2d.processing_functions.refine_2d_input` and :py:func:`live2d.processing_functions.merge_2d_input`), so the scheduler only needs to know the program name.
+
+Author: Benjamin Barad <benjamin.barad@gmail.com>/<baradb@gene.com>
+"""
+import asyncio
+import base64
+from functools import partial
+import json
+import logging
+from math import ceil, log2
+import os
+from statistics import median
+import time
+
+
+async def run_program(program, input_text, state):
+    """
+    Run a cisTEM2 program as a local subprocess, feeding it ``input_text`` on stdin. The process is killed if the coroutine is cancelled.
+
+    Args:
+        program (str): cisTEM2 executable to run (found on the ``PATH``).
+        input_text (str): Newline separated answers to the program's prompts.
+        state (dict): Job state, gets the ``pid`` of the process.
+    Returns:
+        bytes: STDOUT of the program.
+        int: Return code of the program.
+    """
+    process = await asyncio.create_subprocess_exec(program, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+    state["pid"] = process.pid
+    try:
+        out, _ = await process.communicate(input=input_text.encode('utf-8'))
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return out, process.returncode
+
+
+class LocalBackend():
+    """
+    Runs jobs as subprocesses of the server. This is the default backend.
+    """
+    name = "local"
+    remote = False
+
+    async def execute(self, program, input_text, state):
+        """
+        Run a job with :py:func:`run_program`.
+
+        Args:
+            program (str): cisTEM2 executable to run.
+            input_text (str): stdin text of the job.
+            state (dict): Job state.
+        Returns:
+            bytes: STDOUT of the program.
+            int: Return code of the program.
+        """
+        return await run_program(program, input_text, state)
+
+
+class AgentBackend():
+    """
+    Runs jobs on a worker agent (``live2d-worker``, see :py:mod:`live2d.worker_agent`) over TCP, one connection per job.
+    The agent runs the program with the same stdin text, so the Live2D working directory has to be mounted at the same path on the agent's machine. Closing the connection early, as happens when a job is cancelled or times out, makes the agent kill the program.
+
+    Args:
+        host (str): Hostname of the agent.
+        port (int): Port the agent listens on.
+        secret (str): Secret shared with the agent.
+    """
+    remote = True
+
+    def __init__(self, host, port, secret=""):
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.name = "{0}:{1}".format(host, port)
+
+    async def execute(self, program, input_text, state):
+        """
+        Send a job to the agent and wait for its result.
+
+        Args:
+            program (str): cisTEM2 executable to run.
+            input_text (str): stdin text of the job.
+            state (dict): Job state, with the ``threads`` the job takes on the agent. Gets the agent's ``host``, ``pid`` and run time in ``agent_seconds``.
+        Returns:
+            bytes: STDOUT of the program.
+            int: Return code of the program.
+        Raises:
+            PermissionError: If the agent refuses the job.
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(json.dumps({"program": program, "input": input_text, "slots": state.get("threads", 1), "secret": self.secret}).encode('utf-8') + b"\n")
+            await writer.drain()
+            line = await reader.readline()
+        finally:
+            writer.close()
+        if not line:
+            raise ConnectionError("Worker agent {0} closed the connection without a result".format(self.name))
+        reply = json.loads(line)
+        if "error" in reply:
+            raise PermissionError("Worker agent {0} refused the job: {1}".format(self.name, reply["error"]))
+        state["host"] = reply["host"]
+        state["pid"] = reply["pid"]
+        state["agent_seconds"] = reply["seconds"]
+        return base64.b64decode(reply["stdout"]), reply["returncode"]
+
+
+def parse_worker_agents(agents, secret=""):
+    """
+    Turn ``host:port:slots`` strings from the ``worker_agents`` option into backends.
+
+    Args:
+        agents (list): ``host:port:slots`` strings.
+        secret (str): Secret shared with the agents.
+    Returns:
+        list: ``(AgentBackend, slots)`` for each agent.
+    """
+    backends = []
+    for agent in agents:
+        host, port, slots = agent.rsplit(":", 2)
+        backends.append((AgentBackend(host, int(port), secret), int(slots)))
+    return backends
+
+
+class CistemScheduler():
+    """
+    Long lived scheduler for cisTEM2 subprocesses. A single instance is made when the server starts and reused by every cycle, so no worker processes are forked or torn down between cycles.
+
+    Jobs run on pluggable backends, each offering a number of slots, usually one per logical core: by default only :py:class:`LocalBackend`, with ``concurrency`` slots. Any :py:class:`AgentBackend` slots are added on top. A job running several threads takes that many slots on the backend it runs on (or all of them, on a backend with fewer), and goes to the first backend with enough free slots. A remote backend that can't be reached has the job's slots held back for ``unreachable_backoff`` seconds, so retries go elsewhere.
+
+    The state of every job of the current batch is kept in :py:attr:`slices`, keyed by job name, as a dict with ``program``, ``backend``, ``threads``, ``state`` (``queued``, ``running``, ``finished`` or ``failed``), ``queued``, ``started`` and ``finished`` timestamps, ``pid`` and ``returncode``.
+
+    Args:
+        concurrency (int): Number of local subprocesses to run at once.
+        backends (list): Extra ``(backend, slots)`` pairs.
+        unreachable_backoff (float): Seconds to hold back the slot of a remote backend that couldn't be reached.
+    """
+    def __init__(self, concurrency=32, backends=None, unreachable_backoff=60.0):
+        self.backends = [(LocalBackend(), concurrency)] + list(backends or [])
+        self.concurrency = sum(slots for _, slots in self.backends)
+        self.free_slots = {backend.name: slots for backend, slots in self.backends}
+        self._slot_waiters = []
+        self.unreachable_backoff = unreachable_backoff
+        self.slices = {}
+
+    def process_count(self, threads=1):
+        """
+        Number of jobs of ``threads`` threads each that fit on the backends at once.
+
+        Args:
+            threads (int): Threads per job.
+        Returns:
+            int: Number of jobs.
+        """
+        return max(sum(max(slots // threads, 1) for _, slots in self.backends if slots), 1)
+
+    async def acquire(self, threads=1, local=False):
+        """
+        Wait until a backend has the slots for a job free, and take them.
+
+        Args:
+            threads (int): Threads the job runs.
+            local (bool): Only run the job on the :py:class:`LocalBackend`.
+        Returns:
+            backend: Backend to run the job on.
+            int: Number of slots taken, to give back with :py:meth:`release`.
+        """
+        while True:
+            for backend, slots in self.backends:
+                wanted = min(threads, slots)
+                if slots and (not local or not backend.remote) and self.free_slots[backend.name] >= wanted:
+                    self.free_slots[backend.name] -= wanted
+                    return backend, wanted
+            waiter = asyncio.get_event_loop().create_future()
+            self._slot_waiters.append(waiter)
+            await waiter
+
+    def release(self, backend, slots):
+        """
+        Give back slots taken with :py:meth:`acquire`, and wake up the jobs waiting for slots.
+
+        Args:
+            backend: Backend the slots are on.
+            slots (int): Number of slots.
+        """
+        self.free_slots[backend.name] += slots
+        waiters, self._slot_waiters = self._slot_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def run(self, name, program, input_text, threads=1, local=False):
+        """
+        Run one cisTEM2 program once a backend has the slots free, feeding it ``input_text`` on stdin.
+
+        Args:
+            name (str): Unique name of the job within the current batch, used as its key in :py:attr:`slices`.
+            program (str): cisTEM2 executable to run (found on the ``PATH``).
+            input_text (str): Newline separated answers to the program's prompts.
+            threads (int): Threads the program runs with.
+            local (bool): Only run the program on the :py:class:`LocalBackend`.
+        Returns:
+            bytes: STDOUT of the program.
+        """
+        live2dlog = logging.getLogger("live_2d")
+        state = {"program": program, "backend": None, "threads": threads, "state": "queued", "queued": time.time(), "started": None, "finished": None, "pid": None, "returncode": None}
+        self.slices[name] = state
+        backend, slots = await self.acquire(threads, local=local)
+        state["backend"] = backend.name
+        state["state"] = "running"
+        state["started"] = time.time()
+        try:
+            out, returncode = await backend.execute(program, input_text, state)
+        except BaseException as err:
+            state["state"] = "failed"
+            state["finished"] = time.time()
+            if backend.remote and isinstance(err, OSError):
+                live2dlog.warn("Couldn't run {0} on {1}: {2}".format(name, backend.name, err))
+                asyncio.get_event_loop().call_later(self.unreachable_backoff, self.release, backend, slots)
+            else:
+                self.release(backend, slots)
+            raise
+        self.release(backend, slots)
+        state["finished"] = time.time()
+        state["returncode"] = returncode
+        if returncode == 0:
+            state["state"] = "finished"
+        else:
+            state["state"] = "failed"
+            live2dlog.warn("{0} job {1} exited with code {2}".format(program, name, returncode))
+        return out
+
+    async def map(self, program, inputs, label=None):
+        """
+        Run a batch of jobs of the same program, collecting each result as it finishes.
+        Clears :py:attr:`slices` so it only describes this batch.
+
+        Args:
+            program (str): cisTEM2 executable to run.
+            inputs (list): stdin text for each job.
+            label (str): Prefix of the job names, defaults to the program name. Jobs are named ``{label}_{index}``.
+        Returns:
+            list: STDOUT of each job, in the order of ``inputs``.
+        """
+        live2dlog = logging.getLogger("live_2d")
+        if label is None:
+            label = program
+        self.slices = {}
+        jobs = [asyncio.ensure_future(self.run("{0}_{1}".format(label, index), program, input_text)) for index, input_text in enumerate(inputs)]
+        names = {job: "{0}_{1}".format(label, index) for index, job in enumerate(jobs)}
+        pending = set(jobs)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for job in done:
+                    job.result()
+                    state = self.slices[names[job]]
+                    live2dlog.info("Successful return of {0} out of {1} in time {2:0.1f} seconds".format(names[job], len(jobs), state["finished"] - state["started"]))
+        except BaseException:
+            for job in pending:
+                job.cancel()
+            raise
+        return [job.result() for job in jobs]
+
+    async def map_chunks(self, program, particle_count, chunk_input, chunks_per_slot=4, min_chunk_size=1, label=None, chunk_files=None, timeout=None, retries=2, speculation_factor=None, threads=1, max_chunks=None):
+        """
+        Split a stack of ``particle_count`` particles into many more chunks than there are slots, and hand them out from a shared queue as slots free up, so that a slow region of the stack only holds up one small chunk instead of a whole process's slice.
+
+        Chunk sizes follow guided self-scheduling: each new chunk takes ``1/(chunks_per_slot * process_count)`` of the particles still left, where ``process_count`` is how many chunks fit on the backends at once (see :py:meth:`process_count`), so chunks shrink towards the end of the stack and the slots finish close together. Once chunks of different sizes have returned, their run times are fitted to a fixed startup cost plus a per-particle time (see :py:func:`fit_chunk_throughput`), and chunks are kept large enough that the startup cost stays under a tenth of their run time, up to an even share of the particles left per slot.
+
+        Chunks are numbered in particle order, which is the order their output files need to be merged in.
+
+        Each chunk is run as one or more attempts (see :py:meth:`run_chunk`): attempts that exit with an error, time out or leave output files missing are retried on the same particle range, and a chunk running longer than ``speculation_factor`` times the median time per particle of the finished chunks gets a duplicate attempt, with the first to finish kept.
+
+        Args:
+            program (str): cisTEM2 executable to run.
+            particle_count (int): Number of particles in the stack.
+            chunk_input (function): Called as ``chunk_input(index, first_particle, last_particle, attempt)`` (1-indexed, inclusive) to build the stdin text of each attempt at a chunk. Attempts after the first must write to their own output files.
+            chunks_per_slot (int): Number of chunks per running process in the first round. 1 gives one contiguous slice per process.
+            min_chunk_size (int): Smallest number of particles to put in a chunk.
+            label (str): Prefix of the job names, defaults to the program name.
+            chunk_files (function): Called as ``chunk_files(index, attempt)`` to list the output files an attempt writes. The winning attempt's files are moved to the names of attempt 0, and the files of every other attempt are deleted.
+            timeout (float): Seconds after which an attempt is killed and counts as failed. None for no limit.
+            retries (int): Number of failed attempts to retry for each chunk before giving up on the cycle.
+            speculation_factor (float): Multiple of the expected run time after which a chunk gets a duplicate attempt. None or 0 disables duplicates.
+            threads (int): Threads each chunk runs with, and so the number of slots it takes.
+            max_chunks (int): Most chunks to split the stack into, since every chunk leaves a dump file for the single ``merge2d`` at the end of the cycle to read. Chunks grow past the guided size where needed to stay under it. None for no limit.
+        Returns:
+            list: STDOUT of each chunk, in particle order.
+            list: ``[first_particle, last_particle]`` of each chunk.
+        """
+        live2dlog = logging.getLogger("live_2d")
+        if label is None:
+            label = program
+        slot_count = self.process_count(threads)
+        self.slices = {}
+        chunks = []
+        results = []
+        timings = []
+        next_particle = 1
+        coalesced = False
+
+        def next_chunk_size():
+            nonlocal coalesced
+            remaining = particle_count - next_particle + 1
+            size = max(int(ceil(remaining / (chunks_per_slot * slot_count))), min_chunk_size, 1)
+            startup_time, particle_time = fit_chunk_throughput(timings)
+            if particle_time > 0:
+                size = max(size, min(int(ceil(9 * startup_time / particle_time)), int(ceil(remaining / slot_count))))
+            if max_chunks:
+                capped_size = int(ceil(remaining / max(max_chunks - len(chunks), 1)))
+                if capped_size > size and not coalesced:
+                    live2dlog.info("Enlarging {0} chunks from {1} particles to {2} to keep to {3} chunks".format(label, size, capped_size, max_chunks))
+                    coalesced = True
+                size = max(size, capped_size)
+            return min(size, remaining)
+
+        async def worker():
+            nonlocal next_particle
+            while next_particle <= particle_count:
+                size = next_chunk_size()
+                index = len(chunks)
+                first_particle, last_particle = next_particle, next_particle + size - 1
+                next_particle = last_particle + 1
+                chunks.append([first_particle, last_particle])
+                results.append(None)
+                name = "{0}_{1}".format(label, index)
+                results[index], run_time = await self.run_chunk(name, program, partial(chunk_input, index, first_particle, last_particle), partial(chunk_files, index) if chunk_files else None, size, timings, timeout=timeout, retries=retries, speculation_factor=speculation_factor, threads=threads)
+                timings.append((size, run_time))
+                live2dlog.info("Successful return of {0} (particles {1}-{2}) in time {3:0.1f} seconds".format(name, first_particle, last_particle, run_time))
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(slot_count, max(particle_count, 1)))]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for job in workers:
+                job.cancel()
+            raise
+        live2dlog.info("Classified {0} particles in {1} chunks".format(particle_count, len(chunks)))
+        return results, chunks
+
+    async def run_attempt(self, name, program, input_text, output_files, timeout=None, threads=1):
+        """
+        Run one attempt at a chunk, and check that it succeeded.
+
+        Args:
+            name (str): Job name of the attempt.
+            program (str): cisTEM2 executable to run.
+            input_text (str): stdin text of the attempt.
+            output_files (list): Files the attempt has to leave behind to count as successful.
+            timeout (float): Seconds after which the attempt is killed. None for no limit.
+            threads (int): Threads the attempt runs with.
+        Returns:
+            bytes: STDOUT of the attempt, or None if it failed.
+        """
+        live2dlog = logging.getLogger("live_2d")
+        try:
+            out = await asyncio.wait_for(self.run(name, program, input_text, threads=threads), timeout)
+        except asyncio.TimeoutError:
+            live2dlog.warn("{0} timed out after {1:0.0f} seconds".format(name, timeout))
+            return None
+        except (OSError, ValueError, KeyError) as err:
+            if self.slices[name]["backend"] == LocalBackend.name:
+                raise
+            live2dlog.warn("{0} failed on {1}: {2}".format(name, self.slices[name]["backend"], err))
+            return None
+        if self.slices[name]["state"] != "finished":
+            return None
+        missing = [filename for filename in output_files if not os.path.isfile(filename)]
+        if missing:
+            live2dlog.warn("{0} returned without writing {1}".format(name, ", ".join(missing)))
+            self.slices[name]["state"] = "failed"
+            return None
+        return out
+
+    async def run_chunk(self, name, program, attempt_input, attempt_files, size, timings, timeout=None, retries=2, speculation_factor=None, threads=1):
+        """
+        Run attempts at one chunk until one succeeds, retrying failures and starting a duplicate if the chunk runs long. Used by :py:meth:`map_chunks`.
+
+        Args:
+            name (str): Job name of the chunk. Attempts after the first are named ``{name}_attempt{attempt}``.
+            program (str): cisTEM2 executable to run.
+            attempt_input (function): Called with the attempt number to build its stdin text.
+            attempt_files (function): Called with the attempt number to list its output files, or None if there are none to check.
+            size (int): Number of particles in the chunk.
+            timings (list): ``(particles, seconds)`` of the chunks finished so far, to compare this chunk's run time against.
+            timeout (float): Seconds after which an attempt is killed. None for no limit.
+            retries (int): Number of failed attempts to retry before giving up.
+            speculation_factor (float): Multiple of the expected run time after which a duplicate attempt is started. None or 0 disables duplicates.
+            threads (int): Threads each attempt runs with.
+        Returns:
+            bytes: STDOUT of the winning attempt.
+            float: Run time of the winning attempt in seconds.
+        """
+        live2dlog = logging.getLogger("live_2d")
+        attempts = {}
+        launched = []
+        failures = 0
+        speculated = False
+
+        def attempt_name(attempt):
+            return name if attempt == 0 else "{0}_attempt{1}".format(name, attempt)
+
+        def files(attempt):
+            return attempt_files(attempt) if attempt_files else []
+
+        def launch():
+            attempt = len(launched)
+            launched.append(attempt)
+            attempts[asyncio.ensure_future(self.run_attempt(attempt_name(attempt), program, attempt_input(attempt), files(attempt), timeout=timeout, threads=threads))] = attempt
+
+        def discard(attempt):
+            for filename in files(attempt):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+        launch()
+        try:
+            while True:
+                wait_time = None
+                ready_to_speculate = False
+                if speculation_factor and not speculated:
+                    # Check back every few seconds until the chunk has started and enough chunks have finished to compare against.
+                    wait_time = 5.0
+                    started = self.slices.get(name, {}).get("started")
+                    if started is not None and len(timings) >= 3:
+                        expected = speculation_factor * median([seconds / particles for particles, seconds in timings]) * size
+                        wait_time = max(expected - (time.time() - started), 0.0)
+                        ready_to_speculate = True
+                done, _ = await asyncio.wait(set(attempts), timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if ready_to_speculate:
+                        live2dlog.info("{0} is running longer than {1:0.1f} times the median, starting a duplicate".format(name, speculation_factor))
+                        speculated = True
+                        launch()
+                    continue
+                for job in done:
+                    attempt = attempts.pop(job)
+                    out = job.result()
+                    if out is not None:
+                        for loser in attempts:
+                            loser.cancel()
+                        if attempts:
+                            await asyncio.wait(set(attempts))
+                        for loser_attempt in attempts.values():
+                            discard(loser_attempt)
+                        attempts.clear()
+                        if attempt != 0:
+                            discard(0)
+                            for filename, final_filename in zip(files(attempt), files(0)):
+                                os.replace(filename, final_filename)
+                        state = self.slices[attempt_name(attempt)]
+                        return out, state["finished"] - state["started"]
+                    discard(attempt)
+                    failures += 1
+                    if attempts:
+                        continue
+                    if failures > retries:
+                        raise RuntimeError("{0} failed {1} times, giving up on particles it covers".format(name, failures))
+                    live2dlog.warn("Retrying {0} ({1} of {2} retries)".format(name, failures, retries))
+                    launch()
+        except BaseException:
+            for job in attempts:
+                job.cancel()
+            raise
+
+
+def fit_chunk_throughput(timings):
+    """
+    Least squares fit of chunk run times to ``startup_time + particle_time * particles``.
+
+    Args:
+        timings (list): ``(particles, seconds)`` of each finished chunk.
+    Returns:
+        float: Fixed startup time of a chunk in seconds (0 until chunks of at least two sizes have returned).
+        float: Time per particle in seconds (0 until any chunk has returned).
+    """
+    if not timings:
+        return 0.0, 0.0
+    count = len(timings)
+    mean_size = sum(size for size, _ in timings) / count
+    mean_time = sum(seconds for _, seconds in timings) / count
+    size_variance = sum((size - mean_size)**2 for size, _ in timings)
+    if size_variance == 0:
+        return 0.0, mean_time / mean_size
+    particle_time = sum((size - mean_size) * (seconds - mean_time) for size, seconds in timings) / size_variance
+    if particle_time <= 0:
+        return 0.0, mean_time / mean_size
+    startup_time = max(mean_time - particle_time * mean_size, 0.0)
+    return startup_time, particle_time
+
+
+def layout_candidates(core_count):
+    """
+    Threads per process to try when tuning the process × thread layout of ``refine2d`` jobs: the powers of two up to 16 that split ``core_count`` evenly.
+
+    Args:
+        core_count (int): Number of logical cores given to ``refine2d`` jobs.
+    Returns:
+        list: Candidate numbers of threads per process.
+    """
+    return [threads for threads in (1, 2, 4, 8, 16) if threads <= core_count and core_count % threads == 0]
+
+
+def layout_bucket(box_size, particle_count, bin_factor=1, high_res_limit=None):
+    """
+    Key of the bucket a ``refine2d`` job's best layout is stored under: its box size, the binning of the stack it reads, its high resolution limit and the number of particles it classifies, both rounded to a power of two so that the startup cycles stepping through resolution limits share a few buckets.
+
+    Args:
+        box_size (int): Box size of the particle stack in pixels.
+        particle_count (int): Number of particles classified by the job.
+        bin_factor (int): Binning of the particle stack (see :py:func:`live2d.processing_functions.prepare_pyramid_cycle`).
+        high_res_limit (float): High resolution limit of the job, in Å.
+    Returns:
+        str: Bucket key.
+    """
+    return "box{0}_bin{1}_res{2}_particles{3}".format(box_size, bin_factor, 2**int(round(log2(high_res_limit))) if high_res_limit else 0, 2**int(round(log2(max(particle_count, 1)))))
+
+
+def load_layouts(filename):
+    """
+    Load the stored layout tuning results.
+
+    Args:
+        filename (str): Layout tuning json file (``~/.live2d/layout_tuning.json`` on the server).
+    Returns:
+        dict: ``{bucket: {"trials": {threads_per_process: particles_per_second}, "best": threads_per_process}}``, with ``best`` only set once every candidate has been tried.
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def choose_threads_per_process(filename, bucket, candidates, default, tune=False):
+    """
+    Pick the number of threads per process for a ``refine2d`` job.
+    Uses the best stored layout for the job's bucket if there is one. Otherwise, in tuning mode, the next candidate that hasn't been timed in this bucket yet, so that tuning happens on the real stack over the course of a few cycles.
+
+    Args:
+        filename (str): Layout tuning json file.
+        bucket (str): Bucket key from :py:func:`layout_bucket`.
+        candidates (list): Candidate numbers of threads per process.
+        default (int): Threads per process to use when there is nothing stored and tuning is off.
+        tune (bool): Try untimed candidates.
+    Returns:
+        int: Threads per process.
+    """
+    entry = load_layouts(filename).get(bucket, {})
+    if "best" in entry:
+        return int(entry["best"])
+    if tune:
+        for threads in candidates:
+            if str(threads) not in entry.get("trials", {}):
+                return threads
+    return default
+
+
+def record_layout_trial(filename, bucket, threads, particles_per_second, candidates):
+    """
+    Store the throughput of a ``refine2d`` job run with ``threads`` threads per process, and settle the bucket's best layout once every candidate has been timed.
+
+    Args:
+        filename (str): Layout tuning json file.
+        bucket (str): Bucket key from :py:func:`layout_bucket`.
+        threads (int): Threads per process the job ran with.
+        particles_per_second (float): Classified particles per second of wall time.
+        candidates (list): Candidate numbers of threads per process.
+    Returns:
+        int: Best threads per process for the bucket, or None if some candidates are still untimed.
+    """
+    layouts = load_layouts(filename)
+    entry = layouts.setdefault(bucket, {"trials": {}})
+    entry.setdefault("trials", {})[str(threads)] = particles_per_second
+    if all(str(candidate) in entry["trials"] for candidate in candidates):
+        entry["best"] = int(max(entry["trials"], key=lambda candidate: entry["trials"][candidate]))
+    with open(filename + ".tmp", "w") as f:
+        json.dump(layouts, f, indent=2)
+    os.replace(filename + ".tmp", filename)
+    return entry.get("best")
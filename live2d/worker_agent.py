@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+
+#
+# Copyright 2019 Genentech Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Worker agent for Live 2D Classification
+=======================================
+A small server that runs cisTEM2 jobs for a Live2D server on another machine, so a session can borrow the cores of idle workstations. Start it with ``live2d-worker --host 0.0.0.0 --port 8182 --slots 16 --root /path/to/live2d_prefix``, with the shared secret in the ``LIVE2D_WORKER_SECRET`` environment variable, and list it in the Live2D server's ``worker_agents`` option as ``hostname:8182:16``, with the same secret in its ``worker_agent_secret`` option.
+
+Each job arrives on its own TCP connection as one json line, ``{"program": "refine2d", "input": stdin_text, "slots": threads, "secret": secret}``. The agent answers with one json line, ``{"returncode": int, "stdout": base64_stdout, "seconds": float, "host": hostname, "pid": int}``, once the program finishes, or ``{"error": message}`` if it refuses the job. If the server closes the connection before that, the program is killed.
+
+The agent runs the programs with the paths the server sends, so the Live2D working directory has to be mounted at the same path on both machines. Only the programs given with ``--programs`` are run, in ``--root`` and only with paths inside it, and only for requests carrying the shared secret. The agent listens on localhost unless ``--host`` says otherwise. A job takes as many of the agent's ``--slots`` as the threads it runs with.
+
+Several agents on different ports of one machine work as a stand-in for a cluster. ``python -m live2d.agent_check`` starts a few of them on localhost and runs a batch of chunks through them with the same scheduler the server uses, as a check of the setup.
+
+Author: Benjamin Barad <benjamin.barad@gmail.com>/<baradb@gene.com>
+"""
+import argparse
+import asyncio
+import base64
+import hmac
+import json
+import logging
+import os
+import socket
+import time
+
+from .scheduling import run_program
+
+
+def paths_outside_root(input_text, root):
+    """
+    Find the paths in a job's stdin text that aren't inside the agent's root folder.
+
+    Any line could be a path, so every line is resolved, relative ones against the root, which is where the agent runs its programs.
+
+    Args:
+        input_text (str): Newline separated answers to the program's prompts.
+        root (str): Folder the agent may read and write in.
+    Returns:
+        list: The offending paths.
+    """
+    root = os.path.realpath(root)
+    return [line for line in input_text.split("\n") if line.strip() and not os.path.commonpath([os.path.realpath(os.path.join(root, line.strip())), root]) == root]
+
+
+async def handle_job(reader, writer, budget, programs, secret, root):
+    """
+    Run the job sent over one connection and reply with its result.
+
+    Args:
+        reader (asyncio.StreamReader): Connection from the server.
+        writer (asyncio.StreamWriter): Connection to the server.
+        budget (dict): ``slots`` of the agent, ``free`` slots and the ``changed`` :py:class:`asyncio.Condition`, shared by all jobs.
+        programs (list): Programs the agent is allowed to run.
+        secret (str): Secret the server has to send.
+        root (str): Folder the jobs' paths have to be in.
+    """
+    live2dlog = logging.getLogger("live_2d")
+    try:
+        request = json.loads(await reader.readline())
+        refusal = None
+        if not hmac.compare_digest(str(request.get("secret", "")).encode('utf-8'), secret.encode('utf-8')):
+            refusal = "Wrong secret from {}".format(writer.get_extra_info("peername"))
+        elif request["program"] not in programs:
+            refusal = "Refusing to run {}".format(request["program"])
+        elif paths_outside_root(request["input"], root):
+            refusal = "Refusing paths outside {0}: {1}".format(root, ", ".join(paths_outside_root(request["input"], root)))
+        if refusal is not None:
+            live2dlog.warn(refusal)
+            writer.write(json.dumps({"error": refusal}).encode('utf-8') + b"\n")
+            await writer.drain()
+            return
+        slots = min(max(int(request.get("slots", 1)), 1), budget["slots"])
+        async with budget["changed"]:
+            await budget["changed"].wait_for(lambda: budget["free"] >= slots)
+            budget["free"] -= slots
+        try:
+            start_time = time.time()
+            state = {"pid": None}
+            job = asyncio.ensure_future(run_program(request["program"], request["input"], state))
+            hangup = asyncio.ensure_future(reader.read())
+            await asyncio.wait({job, hangup}, return_when=asyncio.FIRST_COMPLETED)
+            if not job.done():
+                live2dlog.info("Server hung up, killing {0} process {1}".format(request["program"], state["pid"]))
+                job.cancel()
+                await asyncio.wait({job})
+                return
+            hangup.cancel()
+            try:
+                out, returncode = job.result()
+            except OSError as err:
+                live2dlog.warn("Couldn't run {0}: {1}".format(request["program"], err))
+                out, returncode = str(err).encode('utf-8'), 127
+            seconds = time.time() - start_time
+        finally:
+            async with budget["changed"]:
+                budget["free"] += slots
+                budget["changed"].notify_all()
+        live2dlog.info("{0} process {1} returned {2} in {3:0.1f} seconds".format(request["program"], state["pid"], returncode, seconds))
+        reply = {"returncode": returncode, "stdout": base64.b64encode(out).decode('ascii'), "seconds": seconds, "host": socket.gethostname(), "pid": state["pid"]}
+        writer.write(json.dumps(reply).encode('utf-8') + b"\n")
+        await writer.drain()
+    except (ValueError, KeyError, TypeError, ConnectionError) as err:
+        live2dlog.warn("Bad job request: {}".format(err))
+    finally:
+        writer.close()
+
+
+async def serve(host, port, slots, programs, secret, root):
+    """
+    Accept jobs until the agent is stopped.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        slots (int): Number of threads to run at once.
+        programs (list): Programs the agent is allowed to run.
+        secret (str): Secret the server has to send with every job.
+        root (str): Folder the jobs' paths have to be in.
+    """
+    budget = {"slots": slots, "free": slots, "changed": asyncio.Condition()}
+    server = await asyncio.start_server(lambda reader, writer: handle_job(reader, writer, budget, programs, secret, root), host, port)
+    logging.getLogger("live_2d").info("Live2D worker agent listening on {0}:{1} with {2} slots for jobs in {3}".format(host, port, slots, root))
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run cisTEM2 jobs for a Live2D server on another machine.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on. Use 0.0.0.0 to accept jobs from other machines.")
+    parser.add_argument("--port", default=8182, type=int, help="Port to listen on")
+    parser.add_argument("--slots", default=os.cpu_count(), type=int, help="Number of threads to run at once, usually the number of logical cores")
+    parser.add_argument("--programs", default=["refine2d"], nargs="+", help="cisTEM2 programs the agent may run")
+    parser.add_argument("--root", required=True, help="Folder that every path in a job has to be in, usually the server's live2d_prefix")
+    parser.add_argument("--secret", default=os.environ.get("LIVE2D_WORKER_SECRET"), help="Secret shared with the server's worker_agent_secret option. Defaults to the LIVE2D_WORKER_SECRET environment variable, which keeps it out of the process list.")
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error("a shared secret is required, with --secret or LIVE2D_WORKER_SECRET")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    # Relative paths in jobs are checked against the root, so they have to mean the same thing to the programs.
+    os.chdir(args.root)
+    asyncio.get_event_loop().run_until_complete(serve(args.host, args.port, args.slots, args.programs, args.secret, os.path.realpath(args.root)))
+
+
+if __name__ == "__main__":
+    main()
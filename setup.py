@@ -51,6 +51,7 @@ setup(
     entry_points={
         'console_scripts': [
             'live2d = live2d:main',
+            'live2d-worker = live2d.worker_agent:main',
         ]
     }
 )
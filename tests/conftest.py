@@ -0,0 +1,91 @@
+#
+# Copyright 2019 Genentech Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Shared fixtures for the Live2D tests.
+
+The tested modules don't need the web server, so the ``live2d`` package is registered here without running its ``__init__``, which starts with the tornado imports. ``live2d.processing_functions``, ``live2d.scheduling`` and ``live2d.worker_agent`` then import as usual.
+"""
+import os
+import sys
+import types
+
+import mrcfile
+import numpy as np
+import pytest
+
+package_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "live2d")
+if "live2d" not in sys.modules:
+    package = types.ModuleType("live2d")
+    package.__path__ = [package_directory]
+    sys.modules["live2d"] = package
+
+from live2d import processing_functions  # noqa: E402
+
+warp_star_header = "\ndata_\n\nloop_\n_rlnMicrographName #1\n_rlnCoordinateX #2\n_rlnImageName #3\n_rlnDefocusU #4\n_rlnDefocusV #5\n_rlnDefocusAngle #6\n_rlnVoltage #7\n_rlnSphericalAberration #8\n_rlnAmplitudeContrast #9\n_rlnDetectorPixelSize #10\n"
+
+
+class WarpFolder():
+    """
+    A warp output folder that particle stacks are added to one micrograph at a time, and a Live2D working directory next to it.
+
+    Particle ``p`` of micrograph ``i`` is filled with ``i + p/100``, and every particle of micrograph ``i`` has a defocus of ``15000.5 + i``, so the combined stack and star file can be checked against each other.
+    """
+    star_name = "allparticles_net.star"
+
+    def __init__(self, root):
+        self.folder = str(root / "warp")
+        self.working_directory = str(root / "live2d")
+        os.makedirs(os.path.join(self.folder, "particles"))
+        os.makedirs(self.working_directory)
+        with open(self.star_filename, "w") as f:
+            f.write(warp_star_header)
+        self.micrograph_count = 0
+
+    @property
+    def star_filename(self):
+        return os.path.join(self.folder, self.star_name)
+
+    def add_micrograph(self, particle_count, box_size=16):
+        """Write a particle stack for a new micrograph and append its particles to the warp star file, and return the stack's name."""
+        index = self.micrograph_count
+        self.micrograph_count += 1
+        name = "particles/mic{}.mrcs".format(index)
+        data = np.full((particle_count, box_size, box_size), index, dtype=np.float32) + np.arange(particle_count, dtype=np.float32)[:, None, None] / 100
+        with mrcfile.new(os.path.join(self.folder, name), overwrite=True) as mrcs:
+            mrcs.set_data(data)
+        with open(self.star_filename, "a") as f:
+            for particle in range(particle_count):
+                f.write("mic{0}.tif 1.0 {1:06d}@{2} {3} {4} 45.1 300.0 2.7 0.07 1.0\n".format(index, particle+1, name, 15000.5+index, 14000.25+index))
+        return name
+
+    def import_particles(self, **kwargs):
+        """Import the finished stacks into the combined stack with :py:func:`live2d.processing_functions.import_new_particles`, without preallocating space unless asked to."""
+        kwargs.setdefault("preallocation_bytes", 0)
+        return processing_functions.import_new_particles("combined_stack", self.folder, self.star_name, self.working_directory, **kwargs)
+
+    def combined_micrographs(self):
+        """Micrograph of each particle in the combined stack, read from the stack and from its star file."""
+        combined_filename = os.path.join(self.working_directory, "combined_stack.mrcs")
+        x, y, z, dtype, data_offset = processing_functions.read_particle_stack_header(combined_filename)
+        stack = np.memmap(combined_filename, dtype=dtype, mode="r", offset=data_offset, shape=(z, y, x))
+        star = processing_functions.load_star_as_dataframe(os.path.join(self.working_directory, "combined_stack.star"))
+        return stack[:, 0, 0].astype(int).tolist(), (star["cisTEMDefocus1"] - 15000.5).round().astype(int).tolist()
+
+
+@pytest.fixture
+def warp(tmp_path):
+    return WarpFolder(tmp_path)
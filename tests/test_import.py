@@ -0,0 +1,136 @@
+"""Tests for importing warp particle stacks into the combined stack, and for resuming and rolling back imports."""
+import json
+import os
+
+import pytest
+
+from live2d import processing_functions
+
+
+def test_import_appends_new_stacks(warp):
+    for _ in range(3):
+        warp.add_micrograph(3)
+    assert warp.import_particles() == 9
+    warp.add_micrograph(2)
+    warp.add_micrograph(4)
+    assert warp.import_particles() == 15
+    stack, star = warp.combined_micrographs()
+    assert stack == star == [0]*3 + [1]*3 + [2]*3 + [3]*2 + [4]*4
+    assert processing_functions.pop_import_rollback("combined_stack", warp.working_directory) is None
+
+
+def test_unfinished_stack_is_deferred(warp):
+    warp.add_micrograph(3)
+    unfinished = os.path.join(warp.folder, warp.add_micrograph(3))
+    warp.add_micrograph(3)
+    data = open(unfinished, "rb").read()
+    with open(unfinished, "wb") as f:
+        f.write(data[:-100])
+    assert warp.import_particles() == 6
+    with open(unfinished, "wb") as f:
+        f.write(data)
+    assert warp.import_particles() == 9
+    stack, star = warp.combined_micrographs()
+    assert stack == star == [0]*3 + [2]*3 + [1]*3
+
+
+def test_rewritten_stack_is_rolled_back(warp):
+    names = [warp.add_micrograph(3) for _ in range(4)]
+    warp.import_particles()
+    rewritten = os.path.join(warp.folder, names[1])
+    data = open(rewritten, "rb").read()
+    with open(rewritten, "wb") as f:
+        f.write(data[:-100])
+    assert warp.import_particles() == 9
+    stack, star = warp.combined_micrographs()
+    assert stack == star == [0]*3 + [2]*3 + [3]*3
+    assert processing_functions.pop_import_rollback("combined_stack", warp.working_directory) == 3
+    assert processing_functions.pop_import_rollback("combined_stack", warp.working_directory) is None
+    with open(rewritten, "wb") as f:
+        f.write(data)
+    assert warp.import_particles() == 12
+    stack, star = warp.combined_micrographs()
+    assert stack == star == [0]*3 + [2]*3 + [3]*3 + [1]*3
+
+
+def test_regenerated_stack_counts_as_rolled_back(warp):
+    warp.add_micrograph(3)
+    warp.import_particles()
+    os.remove(processing_functions.import_manifest_filename("combined_stack", warp.working_directory))
+    os.remove(os.path.join(warp.working_directory, "combined_stack.star"))
+    warp.add_micrograph(2)
+    assert warp.import_particles() == 5
+    assert processing_functions.pop_import_rollback("combined_stack", warp.working_directory) == 0
+
+
+def test_interrupted_import_resumes_from_manifest(warp, monkeypatch):
+    warp.add_micrograph(3)
+    warp.import_particles()
+    for _ in range(4):
+        warp.add_micrograph(2)
+    copy_particle_stack = processing_functions.copy_particle_stack
+
+    def failing_copy(source_filename, *args):
+        if source_filename.endswith("mic3.mrcs"):
+            raise OSError("Interrupted")
+        return copy_particle_stack(source_filename, *args)
+
+    monkeypatch.setattr(processing_functions, "copy_particle_stack", failing_copy)
+    with pytest.raises(OSError):
+        warp.import_particles(thread_count=1, checkpoint_seconds=0)
+    manifest = processing_functions.load_import_manifest("combined_stack", warp.working_directory)
+    assert manifest["particles"] == 7
+    assert processing_functions.read_particle_stack_header(os.path.join(warp.working_directory, "combined_stack.mrcs"))[2] == 3
+    monkeypatch.setattr(processing_functions, "copy_particle_stack", copy_particle_stack)
+    assert warp.import_particles() == 11
+    stack, star = warp.combined_micrographs()
+    assert stack == star == [0]*3 + [1]*2 + [2]*2 + [3]*2 + [4]*2
+    assert processing_functions.pop_import_rollback("combined_stack", warp.working_directory) is None
+
+
+def test_header_ahead_of_manifest_is_reset(warp):
+    warp.add_micrograph(3)
+    warp.import_particles(preallocation_bytes=1024*1024)
+    combined_filename = os.path.join(warp.working_directory, "combined_stack.mrcs")
+    processing_functions.set_stack_particle_count(combined_filename, 10)
+    warp.add_micrograph(2)
+    assert warp.import_particles(preallocation_bytes=1024*1024) == 5
+    stack, star = warp.combined_micrographs()
+    assert stack == star == [0]*3 + [1]*2
+
+
+def test_trim_combined_stack(warp):
+    warp.add_micrograph(3)
+    warp.add_micrograph(2)
+    warp.import_particles(preallocation_bytes=1024*1024)
+    combined_filename = os.path.join(warp.working_directory, "combined_stack.mrcs")
+    x, y, z, dtype, data_offset = processing_functions.read_particle_stack_header(combined_filename)
+    assert os.path.getsize(combined_filename) > data_offset + z*x*y*dtype.itemsize
+    processing_functions.trim_combined_stack("combined_stack", warp.working_directory)
+    assert os.path.getsize(combined_filename) == data_offset + z*x*y*dtype.itemsize
+
+
+def test_interrupted_shadow_swap_is_finished(tmp_path, monkeypatch):
+    suffixes = (".mrcs", ".star", "_offsets.npy", "_import.json")
+    for label in ("combined_stack", "shadow"):
+        for suffix in suffixes:
+            (tmp_path / (label + suffix)).write_text(label)
+    replace = os.replace
+    renames = []
+
+    def interrupted_replace(source, destination):
+        if "shadow" in source:
+            renames.append(source)
+            if len(renames) == 3:
+                raise KeyboardInterrupt
+        replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", interrupted_replace)
+    with pytest.raises(KeyboardInterrupt):
+        processing_functions.swap_in_shadow_stack("combined_stack", "shadow", str(tmp_path))
+    monkeypatch.setattr(os, "replace", replace)
+    assert json.loads((tmp_path / "combined_stack_swap.json").read_text())["renames"][0] == ["shadow.mrcs", "combined_stack.mrcs"]
+    assert processing_functions.finish_shadow_swap("combined_stack", str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == sorted("combined_stack" + suffix for suffix in suffixes)
+    assert all((tmp_path / ("combined_stack" + suffix)).read_text() == "shadow" for suffix in suffixes)
+    assert not processing_functions.finish_shadow_swap("combined_stack", str(tmp_path))
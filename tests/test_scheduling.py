@@ -0,0 +1,83 @@
+"""Tests for splitting refine2d jobs into chunks, layout tuning buckets and the worker agent's path check."""
+import asyncio
+import logging
+
+from live2d import scheduling, worker_agent
+
+
+class FakeBackend():
+    """A remote backend that answers every job straight away with its own name."""
+    remote = True
+
+    def __init__(self, name):
+        self.name = name
+        self.inputs = []
+
+    async def execute(self, program, input_text, state):
+        self.inputs.append(input_text)
+        await asyncio.sleep(0.001)
+        return self.name.encode('utf-8'), 0
+
+
+def run_chunks(particle_count, slots=(4,), **kwargs):
+    """Split a job over fake backends with the given slots, and return the chunks and the scheduler."""
+    async def run():
+        scheduler = scheduling.CistemScheduler(concurrency=0, backends=[(FakeBackend("agent{}".format(index)), count) for index, count in enumerate(slots)])
+        results, chunks = await scheduler.map_chunks("refine2d", particle_count, lambda index, first, last, attempt: "{0} {1}".format(first, last), **kwargs)
+        return results, chunks, scheduler
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_map_chunks_covers_every_particle_once():
+    results, chunks, scheduler = run_chunks(10000, slots=(4, 2))
+    assert chunks[0][0] == 1
+    assert all(previous[1] + 1 == chunk[0] for previous, chunk in zip(chunks, chunks[1:]))
+    assert chunks[-1][1] == 10000
+    assert len(results) == len(chunks)
+    assert {result.decode('utf-8') for result in results} == {"agent0", "agent1"}
+
+
+def test_map_chunks_guided_sizes_shrink():
+    _, chunks, _ = run_chunks(10000, slots=(4,), chunks_per_slot=4)
+    sizes = [last - first + 1 for first, last in chunks]
+    assert sizes[0] == 625
+    assert sizes[-1] < sizes[0]
+    assert len(chunks) > 16
+
+
+def test_map_chunks_respects_min_chunk_size():
+    _, chunks, _ = run_chunks(1000, slots=(4,), min_chunk_size=300)
+    assert [last - first + 1 for first, last in chunks] == [300, 300, 300, 100]
+
+
+def test_map_chunks_coalesces_to_max_chunks(caplog):
+    with caplog.at_level(logging.INFO, logger="live_2d"):
+        _, chunks, _ = run_chunks(10000, slots=(4,), max_chunks=8)
+    assert len(chunks) == 8
+    assert chunks[-1][1] == 10000
+    assert sum("to keep to 8 chunks" in message for message in caplog.messages) == 1
+
+
+def test_process_count_with_threads():
+    scheduler = scheduling.CistemScheduler(concurrency=0, backends=[(FakeBackend("a"), 8), (FakeBackend("b"), 3)])
+    assert scheduler.process_count(1) == 11
+    assert scheduler.process_count(4) == 3
+
+
+def test_layout_bucket_bands():
+    assert scheduling.layout_bucket(200, 3000, 2, 40) == scheduling.layout_bucket(200, 4000, 2, 30) == "box200_bin2_res32_particles4096"
+    assert scheduling.layout_bucket(200, 3000, 2, 20) == "box200_bin2_res16_particles4096"
+    assert scheduling.layout_bucket(200, 3000) == "box200_bin1_res0_particles4096"
+
+
+def test_paths_outside_root(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    (tmp_path / "outside").mkdir()
+    (root / "link").symlink_to(tmp_path / "outside")
+    input_text = "\n".join([str(root / "cycle_1.star"), "cycle_1.star", "40", "yes", "", str(tmp_path / "outside"), "../outside/x", "sub/../../outside", "link/x"])
+    assert worker_agent.paths_outside_root(input_text, str(root)) == [str(tmp_path / "outside"), "../outside/x", "sub/../../outside", "link/x"]
@@ -0,0 +1,86 @@
+"""Tests for counting and indexing the rows of star files."""
+import os
+
+import pytest
+
+from live2d import processing_functions
+
+header = "\ndata_\n\nloop_\n_cisTEMPositionInStack #1\n_cisTEMBest2DClass #2\n"
+
+
+@pytest.fixture(autouse=True)
+def clear_row_counters():
+    processing_functions._star_row_counters.clear()
+    yield
+    processing_functions._star_row_counters.clear()
+
+
+def write_rows(filename, first, last, mode="a"):
+    with open(filename, mode) as f:
+        if mode == "w":
+            f.write(header)
+        f.write("".join("{0}\t{1}\n".format(row, row % 3) for row in range(first, last + 1)))
+
+
+def test_count_star_rows_incrementally(tmp_path):
+    star = str(tmp_path / "particles.star")
+    write_rows(star, 1, 10, "w")
+    assert processing_functions.count_star_rows(star, incremental=True) == 10
+    offset = processing_functions._star_row_counters[star]["offset"]
+    write_rows(star, 11, 15)
+    with open(star, "a") as f:
+        f.write("\n16\t1")
+    assert processing_functions.count_star_rows(star, incremental=True) == 16
+    assert processing_functions._star_row_counters[star]["offset"] > offset
+    with open(star, "a") as f:
+        f.write("\n")
+    assert processing_functions.count_star_rows(star, incremental=True) == 16
+    assert processing_functions.count_star_rows(star) == 16
+
+
+def test_count_star_rows_notices_rewrites(tmp_path):
+    star = str(tmp_path / "particles.star")
+    write_rows(star, 1, 10, "w")
+    assert processing_functions.count_star_rows(star, incremental=True) == 10
+    # Rewritten in place with the same inode and more rows, but different bytes before the remembered offset.
+    with open(star, "r+") as f:
+        f.write(header + "".join("{0}\t{1}\n".format(row, 99) for row in range(1, 13)))
+    assert processing_functions.count_star_rows(star, incremental=True) == 12
+    # Replaced by a new file.
+    write_rows(str(tmp_path / "new.star"), 1, 4, "w")
+    os.replace(str(tmp_path / "new.star"), star)
+    assert processing_functions.count_star_rows(star, incremental=True) == 4
+
+
+def test_count_warp_particles_resumes_from_particle_cache(warp):
+    warp.add_micrograph(5)
+    warp.add_micrograph(3)
+    processing_functions.update_particle_cache(warp.star_filename, warp.working_directory)
+    assert processing_functions.count_warp_particles(warp.star_filename, warp.working_directory) == 8
+    assert processing_functions._star_row_counters[warp.star_filename]["rows"] == 8
+    processing_functions._star_row_counters.clear()
+    with open(warp.star_filename) as f:
+        lines = f.readlines()
+    with open(warp.star_filename, "r+") as f:
+        f.write("".join(lines[:-2]).replace("mic1.tif", "mic9.tif"))
+        f.truncate()
+    warp.add_micrograph(1)
+    assert processing_functions.count_warp_particles(warp.star_filename, warp.working_directory) == 7
+
+
+def test_star_offset_index(tmp_path):
+    star = str(tmp_path / "particles.star")
+    write_rows(star, 1, 6, "w")
+    offsets = processing_functions.load_star_offset_index(star)
+    assert len(offsets) == 7
+    assert int(offsets[-1]) == os.path.getsize(star)
+    with open(star, "rb") as f:
+        data = f.read()
+    assert data[int(offsets[2]):int(offsets[3])] == b"3\t0\n"
+    write_rows(star, 7, 8)
+    offsets = processing_functions.load_star_offset_index(star)
+    assert len(offsets) == 9
+    assert processing_functions.truncate_star_rows(star, 4) == 4
+    assert processing_functions.count_star_rows(star) == 4
+    assert len(processing_functions.load_star_offset_index(star)) == 5
+    assert processing_functions.committed_star_offset("particles", str(tmp_path), 2) == int(offsets[2])
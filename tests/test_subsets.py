@@ -0,0 +1,95 @@
+"""Tests for classifying subsets of the particles: startup subsets, incremental refinement rows and the convergence metrics measured over them."""
+import os
+
+import numpy as np
+import pytest
+
+from live2d import processing_functions
+
+
+@pytest.fixture
+def combined_star(warp):
+    """A combined stack of 20 particles and the cisTEM star file for it."""
+    for particle_count in (3, 5, 4, 2, 6):
+        warp.add_micrograph(particle_count)
+    warp.import_particles()
+    return os.path.join(warp.working_directory, processing_functions.generate_star_file("combined_stack", warp.working_directory))
+
+
+def write_classified_star(template_star, filename, classes, score_changes=None, rows=None):
+    """Write a copy of a cisTEM star file with the given classes and score changes for its first rows."""
+    columns, data_start = processing_functions.read_star_header(template_star)
+    with open(template_star) as f:
+        header = f.read(data_start)
+        lines = [line.split() for line in f if line.strip()]
+    lines = lines[:len(classes) if rows is None else rows]
+    for index, fields in enumerate(lines[:len(classes)]):
+        fields[columns.index("cisTEMBest2DClass")] = str(classes[index])
+        if score_changes is not None:
+            fields[columns.index("cisTEMScoreChange")] = "{:.2f}".format(score_changes[index])
+    with open(filename, "w") as f:
+        f.write(header + "".join("\t".join(fields) + "\n" for fields in lines))
+    return filename
+
+
+def stack_values(filename):
+    """First pixel of every particle in a stack."""
+    x, y, z, dtype, data_offset = processing_functions.read_particle_stack_header(filename)
+    return np.memmap(filename, dtype=dtype, mode="r", offset=data_offset, shape=(z, y, x))[:, 0, 0].copy()
+
+
+def test_write_subset_stack_samples_rows(warp, combined_star):
+    subset_star, subset_count = processing_functions.write_subset_stack("combined_stack", warp.working_directory, combined_star, 0.25, seed=1)
+    positions = np.load(os.path.join(warp.working_directory, "startup_subset_positions.npy"))
+    assert subset_count == len(positions) == 5
+    assert (np.diff(positions) > 0).all()
+    full = stack_values(os.path.join(warp.working_directory, "combined_stack.mrcs"))
+    assert (stack_values(os.path.join(warp.working_directory, "startup_subset.mrcs")) == full[positions - 1]).all()
+    subset_positions = processing_functions.read_star_columns(subset_star, ["cisTEMPositionInStack"])[0]
+    assert subset_positions.tolist() == list(range(1, subset_count + 1))
+
+
+def test_map_subset_star_restores_positions(warp, combined_star):
+    rows = np.array([0, 1, 7, 12, 19])
+    subset_star, _ = processing_functions.write_subset_stack("combined_stack", warp.working_directory, combined_star, None, subset_label="refine_subset", rows=rows)
+    classified_subset = write_classified_star(subset_star, os.path.join(warp.working_directory, "classified_subset.star"), [3, 1, 4, 1, 5])
+    write_classified_star(combined_star, combined_star, [2]*20)
+    output_star = os.path.join(warp.working_directory, "mapped.star")
+    assert processing_functions.map_subset_star(classified_subset, combined_star, os.path.join(warp.working_directory, "refine_subset_positions.npy"), output_star) == 20
+    positions, classes = processing_functions.read_star_columns(output_star, ["cisTEMPositionInStack", "cisTEMBest2DClass"])
+    assert positions.tolist() == list(range(1, 21))
+    expected = np.full(20, 2)
+    expected[rows] = [3, 1, 4, 1, 5]
+    assert classes.tolist() == expected.tolist()
+
+
+def test_select_incremental_rows(warp, combined_star):
+    rng = np.random.default_rng(0)
+    classes = rng.integers(1, 5, 16)
+    score_changes = rng.normal(0, 1, 16)
+    earlier_star = write_classified_star(combined_star, os.path.join(warp.working_directory, "cycle_3.star"), classes, score_changes)
+    classes[5] = classes[5] % 4 + 1
+    score_changes[8] = 50.0
+    previous_star = write_classified_star(combined_star, os.path.join(warp.working_directory, "cycle_4.star"), classes, score_changes)
+    # The cycle starts from the previous results with four new, unclassified particles appended.
+    start_star = write_classified_star(combined_star, os.path.join(warp.working_directory, "cycle_4_start.star"), np.append(classes, [0]*4), np.append(score_changes, [0]*4), rows=20)
+    rows = processing_functions.select_incremental_rows(start_star, previous_star, earlier_star, 4, revisit_fraction=0.1, score_change_factor=3)
+    assert (np.diff(rows) > 0).all()
+    assert {5, 8, 16, 17, 18, 19} <= set(rows.tolist())
+    assert len(rows) < 20
+    assert not set(rows.tolist()) == set(processing_functions.select_incremental_rows(start_star, previous_star, earlier_star, 5, revisit_fraction=0.1, score_change_factor=3).tolist())
+
+
+def test_convergence_metrics(warp, combined_star):
+    previous_star = write_classified_star(combined_star, os.path.join(warp.working_directory, "cycle_1.star"), [1]*10 + [2]*10, [0.5]*20)
+    star = write_classified_star(combined_star, os.path.join(warp.working_directory, "cycle_2.star"), [1]*8 + [2]*12, [1.0]*10 + [-3.0]*10)
+    metrics = processing_functions.convergence_metrics(star, previous_star)
+    assert metrics["compared_particles"] == 20
+    assert metrics["class_change_fraction"] == pytest.approx(0.1)
+    assert metrics["mean_score_change"] == pytest.approx(2.0)
+    assert metrics["occupancy_drift"] == pytest.approx(0.1)
+    rows = processing_functions.convergence_metrics(star, previous_star, rows=[0, 8, 9, 10])
+    assert rows["compared_particles"] == 4
+    assert rows["class_change_fraction"] == pytest.approx(0.5)
+    missing = processing_functions.convergence_metrics(star, os.path.join(warp.working_directory, "missing.star"))
+    assert missing["class_change_fraction"] is None